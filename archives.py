@@ -0,0 +1,195 @@
+# Source files inside tar and zip archives
+#
+# Members of archives are analyzed without unpacking them to disk. A member
+# is named "archive!member", so that its diagnostics are reported as
+# archive!member:line. Contents of members of a compressed tar archive can
+# only be reached by decompressing everything before them, so members are
+# read in one pass over the archive, in the order they are stored in it.
+# Members passed over on the way are kept for their reads, as long as they fit
+# into the memory cap of reading ahead, see MemoryCap. Sizes of members are
+# known from the archive without reading them: members over --max-file-size
+# are not read at all, only their beginning is. The same goes for files, sized
+# by stat() of the opened file. Modules of archive formats are only imported
+# once an archive is given.
+
+import os
+import fnmatch
+import threading
+
+from sourcetext import source_size
+
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".zip")
+
+# Members analyzed by default, other members of archives are skipped
+DEFAULT_MEMBER_PATTERNS = ("*.c", "*.h", "*.cc", "*.cpp", "*.cxx", "*.hh",
+                           "*.hpp", "*.hxx", "*.inc", "*.inl")
+
+def is_archive(input_file):
+    return input_file.endswith(ARCHIVE_SUFFIXES)
+
+# Bytes read of members too large to be analyzed, enough for the first line
+# shown in their note
+TOO_LARGE_PREFIX = 4096
+
+def is_zip(input_file):
+    return input_file.endswith(".zip")
+
+def archive_members(archive):
+    """Return a list of (name, size) of regular files in archive, in the
+       order they are stored"""
+    import tarfile
+    import zipfile
+    if is_zip(archive):
+        with zipfile.ZipFile(archive) as z:
+            return list((info.filename, info.file_size)
+                        for info in z.infolist() if not info.is_dir())
+    with tarfile.open(archive) as tar:
+        return list((info.name, info.size) for info in tar if info.isfile())
+
+class ArchiveSources:
+    """Reads input files, also ones given as members of archives, see
+       expand(). Of files and members over max_size bytes, 0 for no limit,
+       only the beginning is read. Safe to use from several reader threads"""
+    def __init__(self, patterns=DEFAULT_MEMBER_PATTERNS, max_size=0):
+        self.patterns = patterns
+        self.max_size = max_size
+        self.members = dict() # name -> (archive, member, size)
+        self.lock = threading.Lock()
+        self.zips = dict() # archive -> open ZipFile
+        self.tars = dict() # archive -> (open TarFile, iterator over it)
+        # Members passed over while looking for another one, wanted soon
+        # by other reader threads
+        self.read_ahead = dict() # name -> raw contents
+        self.memory = None # MemoryCap taking bytes of read_ahead
+        self.expected = None # names still going to be read, None for all
+        self.truncated = dict() # name -> size, of ones read only in part
+
+    def expand(self, input_files):
+        """Return input_files with archives replaced by names of their
+           members matching patterns"""
+        res = list()
+        for input_file in input_files:
+            if not is_archive(input_file):
+                res.append(input_file)
+                continue
+            for (member, size) in archive_members(input_file):
+                if not any(fnmatch.fnmatch(member, pattern)
+                           for pattern in self.patterns):
+                    continue
+                name = "%s!%s" % (input_file, member)
+                self.members[name] = (input_file, member, size)
+                res.append(name)
+        return res
+
+    def expect(self, input_files, memory=None):
+        """Only input_files are going to be read, e.g. in a shard, each
+           once. Other members are not kept when passed over. Bytes of kept
+           ones are taken from memory, a MemoryCap, if given"""
+        self.expected = set(input_files)
+        self.memory = memory
+
+    def in_archive(self, input_file):
+        return input_file in self.members
+
+    def member_size(self, input_file):
+        "Return the size of a member of an archive, None for other files"
+        if input_file not in self.members:
+            return None
+        return self.members[input_file][2]
+
+    def truncated_size(self, input_file):
+        """Return the size of input_file if read() returned only its
+           beginning, None if it returned all of it"""
+        with self.lock:
+            return self.truncated.get(input_file)
+
+    def size(self, input_file):
+        "Return the number of bytes read(input_file) is going to return"
+        if input_file not in self.members:
+            return self.read_size(source_size(input_file))
+        return self.read_size(self.members[input_file][2])
+
+    def read_size(self, size):
+        if 0 < self.max_size < size:
+            return min(size, TOO_LARGE_PREFIX)
+        return size
+
+    def read(self, input_file):
+        """Return raw contents of input_file, same as read_source(). Of a
+           file or member over max_size bytes only the beginning"""
+        if input_file not in self.members:
+            return self.read_file(input_file)
+        (archive, member, size) = self.members[input_file]
+        with self.lock:
+            if self.expected is not None:
+                self.expected.discard(input_file)
+            if self.read_size(size) < size:
+                self.truncated[input_file] = size
+        if is_zip(archive):
+            import zipfile
+            # ZipFile serializes reads of members itself
+            with self.lock:
+                if archive not in self.zips:
+                    self.zips[archive] = zipfile.ZipFile(archive)
+                z = self.zips[archive]
+            with z.open(member) as f:
+                return f.read(self.read_size(size))
+        with self.lock:
+            if input_file in self.read_ahead:
+                raw = self.read_ahead.pop(input_file)
+                if self.memory is not None:
+                    # Counted by the caller of read() from now on
+                    self.memory.release_ahead(len(raw))
+                return raw
+            # A member before the current position, or one passed over
+            # without room to keep it, is only found by starting over
+            for restart in (False, True):
+                raw = self.read_tar_member(archive, input_file, restart)
+                if raw is not None:
+                    return raw
+        raise FileNotFoundError("%s is not found in %s" % (member, archive))
+
+    def read_file(self, input_file):
+        with open(input_file, "rb") as f:
+            # Not known before opening it, the file may change in between
+            size = os.fstat(f.fileno()).st_size
+            if self.read_size(size) == size:
+                return f.read()
+            with self.lock:
+                self.truncated[input_file] = size
+            return f.read(self.read_size(size))
+
+    def read_tar_member(self, archive, input_file, restart):
+        # Called with the lock held
+        if restart or archive not in self.tars:
+            import tarfile
+            self.close_tar(archive)
+            tar = tarfile.open(archive, "r|*")
+            self.tars[archive] = (tar, iter(tar))
+        (tar, members) = self.tars[archive]
+        for info in members:
+            name = "%s!%s" % (archive, info.name)
+            if not info.isfile() or name not in self.members:
+                continue
+            size = self.read_size(info.size)
+            if name == input_file:
+                return tar.extractfile(info).read(size)
+            if name in self.read_ahead:
+                continue
+            if self.expected is not None and name not in self.expected:
+                continue
+            if self.memory is not None and not self.memory.take_ahead(size):
+                continue
+            self.read_ahead[name] = tar.extractfile(info).read(size)
+        return None
+
+    def close_tar(self, archive):
+        if archive in self.tars:
+            self.tars.pop(archive)[0].close()
+
+    def close(self):
+        for archive in list(self.tars):
+            self.close_tar(archive)
+        for z in self.zips.values():
+            z.close()
+        self.zips = dict()
@@ -0,0 +1,93 @@
+# Fingerprints of diagnostics, for reporting only findings not seen before
+#
+# The whitelist matches diagnostics by line number, so editing anything above
+# a whitelisted finding makes it new again. A fingerprint instead combines
+# the file, the code, the normalized text of the line and its block context:
+# the condition of the directive opening the innermost block around it.
+# Identical findings in one block are told apart by their order.
+
+import re
+
+from keywords import is_open_directive, is_close_directive, whitespace
+
+# Only ASCII whitespace separates tokens, see tokenize_directive(). Bytes
+# such as 0x85 and 0xA0 of UTF-8 text read as latin-1 are kept
+ascii_spaces = re.compile(r"\s+", re.ASCII)
+
+def normalized(txt):
+    return ascii_spaces.sub(" ", txt.strip(whitespace))
+
+def block_contexts(pre_lines, linenos):
+    """Return a dict mapping each of linenos to tokens of the innermost #if,
+       #ifdef or #ifndef around it, or "" if there is none.
+       An opening directive is in the block around it, a closing one in the
+       block it closes"""
+    wanted = sorted(set(linenos))
+    res = dict()
+    stack = list()
+    pos = 0
+    for directive in pre_lines:
+        while pos < len(wanted) and wanted[pos] <= directive.lineno:
+            res[wanted[pos]] = stack[-1] if stack else ""
+            pos += 1
+        if is_open_directive(directive.hashword):
+            # Comments and spacing may change, the condition stays
+            stack.append(" ".join(directive.tokens_without_comment()))
+        elif is_close_directive(directive.hashword) and stack:
+            stack.pop()
+    for lineno in wanted[pos:]:
+        res[lineno] = stack[-1] if stack else ""
+    return res
+
+def add_block_contexts(diagnostics, pre_lines):
+    "Remember block contexts of diagnostics of a file as their block"
+    if not diagnostics:
+        return
+    blocks = block_contexts(pre_lines, (diag.lineno for diag in diagnostics))
+    for diag in diagnostics:
+        diag.block = blocks[diag.lineno]
+
+def fingerprints(input_file, diagnostics):
+    """Return a dict mapping id() of each of diagnostics of input_file to its
+       fingerprint. Diagnostics without a block, e.g. ones of the whole tree,
+       use the empty one"""
+    import hashlib
+    res = dict()
+    seen = dict() # (wcode, text, block) -> count
+    for diag in sorted(diagnostics, key=lambda d: d.lineno):
+        key = (int(diag.wcode), normalized(diag.first_line),
+               getattr(diag, "block", ""))
+        seen[key] = seen.get(key, 0) + 1
+        txt = "\0".join((input_file, str(key[0]), key[1], key[2],
+                         str(seen[key])))
+        res[id(diag)] = hashlib.blake2b(txt.encode("utf-8", "surrogateescape"),
+                                        digest_size=8).hexdigest()
+    return res
+
+def filter_baseline(diagnostics, prints, baseline, counters=None):
+    "Return diagnostics whose fingerprints in prints are not in baseline"
+    res = list(diag for diag in diagnostics
+               if prints[id(diag)] not in baseline)
+    if counters is not None:
+        counters.add("baseline_hits_total", len(diagnostics) - len(res))
+    return res
+
+def load_baseline(file_name):
+    "Return the set of fingerprints in a baseline file"
+    res = set()
+    with open(file_name, encoding="utf-8", errors="surrogateescape") as f:
+        for line in f:
+            tokens = line.split(None, 1)
+            if tokens and not tokens[0].startswith("#"):
+                res.add(tokens[0])
+    return res
+
+def write_baseline(file_name, entries):
+    """Write entries (fingerprint, input_file, diagnostic) to a baseline
+       file, one per line with the location for people to read"""
+    with open(file_name, "w", encoding="utf-8",
+              errors="surrogateescape") as f:
+        f.write("# cppsa baseline: fingerprint file:line: code\n")
+        for (fingerprint, input_file, diag) in entries:
+            f.write("%s %s:%d: W%d\n" % (fingerprint, input_file, diag.lineno,
+                                         diag.wcode))
@@ -0,0 +1,24 @@
+# Columnar storage of directives of a single file
+
+from array import array
+
+from keywords import hashword_code
+from rolling import context_codes
+
+class DirectiveColumns:
+    """Parallel integer columns describing directives of one file: line
+       number, hashword code, context code and number of lines. Checks scan
+       these columns and only reach for a directive's text with directive()
+       when they need to look closer or to report a diagnostic"""
+    def __init__(self, pre_lines):
+        self.pre_lines = pre_lines
+        self.lineno = array('L', (d.lineno for d in pre_lines))
+        self.code = array('B', (hashword_code(d.hashword) for d in pre_lines))
+        self.context = array('B', (context_codes[d.context] for d in pre_lines))
+        self.line_count = array('L', (len(d.multi_lines) for d in pre_lines))
+
+    def __len__(self):
+        return len(self.code)
+
+    def directive(self, index):
+        return self.pre_lines[index]
@@ -2,22 +2,27 @@
 # C preprocessor static analyzer
 
 import sys
-import argparse
-import re
+from types import SimpleNamespace
 
-from tokenizer import PreprocessorDirective
-from tokenizer import extract_multiline_sequence
 from keywords import line_is_preprocessor_directive
-from diagcodes import all_wcodes
-from rolling import update_language_context, Context
+from registry import CheckRegistry, PluginError
+from diagcodes import update_diag_codes
+from dirconfig import DirConfigError
+from sourcetext import OutputDecoder
+from driver import Analysis, analyze_files, extract_preprocessor_lines
+from driver import add_tree_diagnostics
+from shards import parse_shard_spec, select_shard
+from shards import write_shard_result, read_shard_results
+from metrics import Counters, write_metrics
+from archives import DEFAULT_MEMBER_PATTERNS
+from baseline import fingerprints, filter_baseline, load_baseline
+from baseline import write_baseline
+from stats import Stats, stats_report, print_stats
 
-from simple import run_simple_checks
-from multichecks import run_complex_checks
-
-def read_whitelist(input_file, global_whitelist):
-    """global_whitelist contains lines for many files.
-       Return a collection of suppressed warnings for input_file"""
-    res = list()
+def load_whitelist(global_whitelist):
+    """Read the whitelist once for all files.
+       Return a dict mapping file names to lists of (line, wcode)"""
+    res = dict()
     with open(global_whitelist) as f:
         for line in f:
             # To make it compatible with cppsa's own output, ignore lines
@@ -31,55 +36,158 @@ def read_whitelist(input_file, global_whitelist):
             undecorated_wcode = (tokens[2][1:] if tokens[2][0] == 'W'
                                                else tokens[2])
             wcode = int(undecorated_wcode)
-            if fname != input_file:
-                continue
-            res.append((line, wcode))
+            res.setdefault(fname, list()).append((line, wcode))
     return res
 
-def extract_preprocessor_lines(input_file):
-    res = list()
-    with open(input_file) as f:
-        lines = f.readlines()
-    lineno = 0
-    context = Context.OUTSIDE
-    while lineno < len(lines):
-        cur_line = lines[lineno]
-        if line_is_preprocessor_directive(cur_line):
-            multi_lines = extract_multiline_sequence(lines, lineno)
-            human_lineno = lineno + 1
-            res.append(PreprocessorDirective(multi_lines,
-                                             human_lineno, context))
-            lineno += len(multi_lines)
-            context = update_language_context(multi_lines, context)
-        else:
-            lineno += 1
-            context = update_language_context([cur_line], context)
-    return res
+def read_whitelist(input_file, global_whitelist):
+    """global_whitelist contains lines for many files.
+       Return a collection of suppressed warnings for input_file"""
+    return load_whitelist(global_whitelist).get(input_file, list())
 
-def filter_diagnostics(diagnostics, whitelist):
+def filter_diagnostics(diagnostics, whitelist, counters=None):
+    suppressed = frozenset(whitelist)
     res = list()
     for diag in diagnostics:
-        lineno = diag.lineno
-        wcode = diag.wcode
-        suppressed = False
-        for (white_lineno, white_wcode) in whitelist:
-            if lineno == white_lineno and wcode == white_wcode:
-                suppressed = True
-                break
-        if not suppressed:
+        if (diag.lineno, diag.wcode) not in suppressed:
             res.append(diag)
+    if counters is not None:
+        counters.add("whitelist_hits_total", len(diagnostics) - len(res))
     return res
 
-def parse_args(argv):
-    parser = argparse.ArgumentParser(description=
-                                     "Analyze preprocessor directives")
+def add_output_args(parser):
+    # Options shared by analysis and merging of shard results
     parser.add_argument("-q", "--quiet", action="store_true",
                         help="Do not show diagnostics, only return error code")
     parser.add_argument("-v", "--verbose", action="store_true",
                 help="Be extra verbose (cannot be used together with --quiet)")
-    parser.add_argument("-W", "--whitelist", type=str, default=None,
+    parser.add_argument("-W", "--whitelist", type=str,
                         help="Whitelist of ignored warnings")
-    parser.add_argument("-D", "--diagnostics", type=str, default="",
+    parser.add_argument("--encoding", type=str,
+                        help="""Encodings of source files separated by commas,
+                                tried in order when displaying source text.
+                                Analysis itself does not depend on them""")
+    parser.add_argument("--encoding-errors", type=str,
+                        choices=("replace", "ignore", "backslashreplace"),
+                        help="""What to do with source text not fitting any
+                                of encodings. Diagnostics are shown after
+                                the analysis, so failing on such text, as
+                                "strict" would, is not offered""")
+    parser.add_argument("--baseline", type=str,
+                        help="""Only report diagnostics not in this baseline.
+                                Unlike the whitelist, it matches diagnostics
+                                by fingerprints surviving shifts of lines""")
+    parser.add_argument("--write-baseline", type=str,
+                        help="""Write fingerprints of all diagnostics not in
+                                the whitelist to this file, for later use
+                                with --baseline""")
+    parser.add_argument("--stats", action="store_true",
+                        help="""Instead of diagnostics, report numbers of
+                                them by code, directory and file, and
+                                distributions of nesting depth of conditional
+                                blocks and of lines of definitions""")
+    parser.add_argument("--stats-format", type=str,
+                        choices=("table", "json"),
+                        help="Format of the --stats report")
+    parser.add_argument("--metrics", type=str,
+                        help="""Write counters of work done to this file at
+                                exit: files, lines and directives analyzed,
+                                findings of each check, whitelist and cache
+                                hits""")
+    parser.add_argument("--metrics-format", type=str,
+                        choices=("prometheus", "json"),
+                        help="""Format of the --metrics file. The default is
+                                for the textfile collector of Prometheus'
+                                node_exporter""")
+    parser.set_defaults(**output_defaults)
+
+def check_output_args(parser, opts):
+    if opts.verbose and opts.quiet:
+        print("Flags --quiet and --verbose cannot be used together");
+        parser.print_help()
+        sys.exit(2)
+    import codecs
+    for encoding in opts.encoding.split(","):
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            print("Unknown encoding '%s'" % encoding)
+            sys.exit(2)
+
+# Calls by editors or pre-commit hooks on a few files use few options. They
+# are parsed without argparse: importing it and adding all options takes
+# about as long as checking a small file. parse_full_args() gives the same
+# options for the same argv
+common_flags = {
+    "-q": "quiet", "--quiet": "quiet",
+    "-v": "verbose", "--verbose": "verbose",
+    "-a": "analyze_true_preprocessor",
+    "--analyze-true-preprocessor": "analyze_true_preprocessor",
+    "-u": "unused_macros", "--unused-macros": "unused_macros",
+    "--stats": "stats",
+}
+common_values = {"-D": "diagnostics", "--diagnostics": "diagnostics",
+                 "-W": "whitelist", "--whitelist": "whitelist"}
+
+# Defaults of options of add_output_args() and of the analysis, registered
+# with argparse by set_defaults() and taken by parse_common_args() as they are
+output_defaults = {
+    "quiet": False, "verbose": False, "whitelist": None, "encoding": "utf-8",
+    "encoding_errors": "replace", "baseline": None, "write_baseline": None,
+    "stats": False, "stats_format": "table", "metrics": None,
+    "metrics_format": "prometheus",
+}
+analysis_defaults = {
+    "diagnostics": "", "analyze_true_preprocessor": False, "configs": None,
+    "unused_macros": False, "jobs": 1, "executor": "auto",
+    "split_lines": 100000, "prefetch": 0, "prefetch_memory": 256,
+    "max_file_size": 64 << 20, "max_directive_length": 64 << 10,
+    "max_continuation_lines": 1000, "file_time_budget": 0.0,
+    "plugins": None, "entry_point_plugins": False, "dir_config": ".cppsa",
+    "cache_dir": None,
+    "shard": None, "shard_output": None,
+    "archive_members": ",".join(DEFAULT_MEMBER_PATTERNS),
+}
+
+def parse_common_args(argv):
+    """Return options given in argv if it only has flags of common_flags
+       and common_values, or None if parse_full_args() is needed, also to
+       report errors"""
+    values = dict(output_defaults, **analysis_defaults)
+    input_files = list()
+    args = iter(argv)
+    for arg in args:
+        if arg in common_flags:
+            values[common_flags[arg]] = True
+        elif arg in common_values:
+            value = next(args, None)
+            if value is None or value.startswith("-"):
+                return None
+            values[common_values[arg]] = value
+        elif arg.startswith("-D") and arg != "-D":
+            values["diagnostics"] = arg[2:]
+        elif arg.startswith("-"):
+            return None
+        else:
+            input_files.append(arg)
+    if not input_files or (values["quiet"] and values["verbose"]):
+        return None
+    values["input_files"] = input_files
+    return SimpleNamespace(**values)
+
+def parse_args(argv):
+    opts = parse_common_args(argv)
+    if opts is None:
+        opts = parse_full_args(argv)
+    return opts
+
+def parse_full_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description=
+                                     "Analyze preprocessor directives",
+                                     epilog="""Use "%(prog)s merge --help" for
+                                     merging results of --shard runs""")
+    add_output_args(parser)
+    parser.add_argument("-D", "--diagnostics", type=str,
                         help='List of diagnostics separated by commas.'
                             ' Use word "all" to mean all of them, or negative'
                             ' number to disable a specific diagnostic.')
@@ -87,95 +195,263 @@ def parse_args(argv):
                         help="""Also look into directives that make use of
                                 preprocessor-specific operations, such as
                                 stringizing""")
+    parser.add_argument("-c", "--configs", type=str,
+                        help="""File with build configurations, one per line,
+                                each a list of -DNAME[=VALUE] macros. Report
+                                conditional blocks which are never or always
+                                active across all of them""")
+    parser.add_argument("-u", "--unused-macros", action="store_true",
+                        help="""Report macros that are defined but never
+                                used in any of the analyzed files""")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Number of parallel workers")
+    parser.add_argument("--executor", type=str,
+                        choices=("auto", "process", "thread"),
+                        help="""Kind of parallel workers. Threads share
+                                caches and need no copying of results, but
+                                only pay off on free-threaded Python builds;
+                                elsewhere processes are used instead.
+                                The default is threads when the interpreter
+                                runs without the GIL""")
+    parser.add_argument("--split-lines", type=int,
+                        help="""With --jobs, files having at least this many
+                                lines are split into chunks processed in
+                                parallel""")
+    parser.add_argument("--prefetch", type=int,
+                        help="""Read up to this many files ahead in
+                                background threads, overlapping slow file
+                                system access with analysis""")
+    parser.add_argument("--prefetch-memory", type=int,
+                        help="""Limit of memory taken by files read ahead,
+                                in megabytes""")
+    parser.add_argument("--max-file-size", type=int,
+                        help="""Files larger than this many bytes are not
+                                read nor analyzed, only noted with W21. 0 is
+                                no limit""")
+    parser.add_argument("--max-directive-length", type=int,
+                        help="""Directives longer than this many characters
+                                are noted with W21 and truncated before
+                                checks, they are still extracted whole. 0 is
+                                no limit""")
+    parser.add_argument("--max-continuation-lines", type=int,
+                        help="""Directives continued over more lines are
+                                noted with W21 and truncated before checks,
+                                they are still extracted whole. 0 is no
+                                limit""")
+    parser.add_argument("--file-time-budget", type=float,
+                        help="""Seconds of analysis of a single file, after
+                                which its remaining stages of checks are
+                                skipped and noted with W21. It is looked at
+                                between stages only: reading, extraction and
+                                a stage already started run to the end. 0 is
+                                no limit, the default""")
+    parser.add_argument("--plugins", type=str,
+                        help="""File of additional checks, one per line as
+                                "W<code> module:Class". Their modules are
+                                only imported if their codes are enabled""")
+    parser.add_argument("--entry-point-plugins", action="store_true",
+                        help="""Also use checks of installed packages,
+                                registered as entry points of the
+                                "cppsa.checks" group""")
+    parser.add_argument("--dir-config", type=str,
+                        help="""Name of files changing thresholds and
+                                enabled diagnostics for files of their
+                                directory and its subdirectories. An empty
+                                name disables them""")
+    parser.add_argument("--cache-dir", type=str,
+                        help="""Directory to keep extracted directives in
+                                between runs, keyed by contents of files""")
+    parser.add_argument("--shard", type=str,
+                        help="""Analyze only shard i of N, given as "i/N",
+                                of input files and save results to the
+                                --shard-output file instead of reporting them""")
+    parser.add_argument("--shard-output", type=str,
+                        help="Result file of a --shard run")
 
-    parser.add_argument('input_file', metavar='input_file', type=str,
-                        help='File to be analyzed')
+    parser.add_argument("--archive-members", type=str,
+                        help="""Patterns of names of members to analyze in
+                                .tar, .tar.gz and .zip input files, separated
+                                by commas""")
+
+    parser.add_argument('input_files', metavar='input_file', type=str,
+                        nargs='+', help="""File(s) to be analyzed. Archives
+                                           are read without unpacking, their
+                                           members are reported as
+                                           archive!member""")
+    parser.set_defaults(**analysis_defaults)
 
     opts = parser.parse_args(argv)
-    if opts.verbose and opts.quiet:
-        print("Flags --quiet and --verbose cannot be used together");
-        parser.print_help()
+    check_output_args(parser, opts)
+    if opts.shard is not None:
+        opts.shard = parse_shard_spec(opts.shard)
+        if opts.shard is None:
+            print("Shard must be given as i/N, with 1 <= i <= N")
+            sys.exit(2)
+        if opts.shard_output is None:
+            print("Flag --shard requires --shard-output")
+            sys.exit(2)
+    if opts.jobs < 1:
+        print("Number of jobs must be positive");
+        sys.exit(2)
+    if min(opts.max_file_size, opts.max_directive_length,
+           opts.max_continuation_lines, opts.file_time_budget) < 0:
+        print("Limits must not be negative");
         sys.exit(2)
+    if opts.prefetch < 0 or opts.prefetch_memory < 1:
+        print("Prefetch depth must not be negative, memory must be positive");
+        sys.exit(2)
+    return opts
+
+def parse_merge_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="cppsa merge", description=
+                                     "Report merged results of --shard runs")
+    add_output_args(parser)
+    parser.add_argument('result_files', metavar='result_file', type=str,
+                        nargs='+', help='Result files of all shards')
+    opts = parser.parse_args(argv)
+    check_output_args(parser, opts)
     return opts
 
 def parse_diag_spec_line(spec_string, all_wcodes):
     if spec_string == '':
         return (all_wcodes, None)
-    result = set()
-    tokens = spec_string.strip().split(",")
-    for token in tokens:
-        if token == "":
-            continue
-        if token == "all":
-            result.update(all_wcodes)
-        elif token == "-all":
-            result = set()
-        elif re.match(r"-?\d+", token):
-            num = int(token)
-            if num > 0:
-                result.add(num)
-            elif num < 0:
-                try:
-                    result.remove(-num)
-                except KeyError:
-                    pass # it's fine to attempt to remove non-present diag
-            else:
-                return (None, "invalid diagnostics code 0")
-        else:
-            return (None, "unrecognized token '%s'" % token)
+    return update_diag_codes(set(), spec_string, all_wcodes)
+
+def print_diagnostics(input_file, diagnostics, decode):
+    for diag in diagnostics:
+        (lineno, wcode, details) = (diag.lineno, diag.wcode, diag.details)
+        print("%s:%d: W%d: %s" % (input_file, lineno, wcode, decode(details)))
+        verbatim_text = diag.first_line.strip('\n')
+        print("    %s" % decode(verbatim_text))
+
+def select_diagnostics(input_file, diagnostics, whitelists, counters=None,
+                       baseline=None, new_baseline=None):
+    """Filter diagnostics against the whitelist and the baseline.
+       Fingerprints of diagnostics not in the whitelist are added to the
+       new_baseline list if given.
+       Return the list of diagnostics to display, sorted"""
+    whitelist = whitelists.get(input_file, list())
+
+    # Filter collected diagnostics against the whitelist
+    displayed_diagnostics = filter_diagnostics(diagnostics, whitelist,
+                                               counters)
+    # Sort the output by line number
+    displayed_diagnostics = sorted(displayed_diagnostics, key=lambda x:x.lineno)
+    if baseline is not None or new_baseline is not None:
+        # Counted over all diagnostics of the file, so that changes of the
+        # whitelist do not change fingerprints
+        prints = fingerprints(input_file, diagnostics)
+        if new_baseline is not None:
+            new_baseline += list((prints[id(diag)], input_file, diag)
+                                 for diag in displayed_diagnostics)
+        if baseline is not None:
+            displayed_diagnostics = filter_baseline(displayed_diagnostics,
+                                                    prints, baseline, counters)
+    return displayed_diagnostics
+
+def report_all(all_diagnostics, opts, counters=None):
+    """Report diagnostics of all files, return the exit code.
+       Whitelist and baseline hits are added to counters, written out with
+       --metrics"""
+    if counters is None:
+        counters = Counters()
+    if opts.whitelist is not None:
+        whitelists = load_whitelist(opts.whitelist)
+    else:
+        whitelists = dict()
+    baseline = None
+    if opts.baseline is not None:
+        baseline = load_baseline(opts.baseline)
+    new_baseline = list() if opts.write_baseline is not None else None
+    decode = OutputDecoder(opts.encoding.split(","), opts.encoding_errors)
+    stats = Stats()
+
+    displayed_count = 0
+    for (input_file, diagnostics) in all_diagnostics.items():
+        displayed_diagnostics = select_diagnostics(input_file, diagnostics,
+                                                   whitelists, counters,
+                                                   baseline, new_baseline)
+        displayed_count += len(displayed_diagnostics)
+        if opts.stats:
+            # Only counted, not formatted
+            stats.add_findings(input_file, displayed_diagnostics)
+        elif not opts.quiet:
+            print_diagnostics(input_file, displayed_diagnostics, decode)
 
-    # Check that only known numbers are in the set
-    extra_numbers = result.difference(all_wcodes)
-    if extra_numbers:
-        return (None, "unknown diagnostics codes %s" % extra_numbers)
-    return (result, None)
+    if opts.stats and not opts.quiet:
+        print_stats(stats_report(stats, counters), opts.stats_format)
+    if new_baseline is not None:
+        write_baseline(opts.write_baseline, new_baseline)
+    if opts.metrics is not None:
+        write_metrics(opts.metrics, counters, opts.metrics_format)
+    return 0 if displayed_count == 0 else 1
+
+def merge_main(argv):
+    opts = parse_merge_args(argv)
+    try:
+        (all_diagnostics, identifier_index, enabled_wcodes,
+         counters) = read_shard_results(opts.result_files)
+    except (OSError, ValueError) as e:
+        print("Merging shard results failed: %s" % e)
+        return 2
+    if identifier_index is not None:
+        add_tree_diagnostics(all_diagnostics, identifier_index, enabled_wcodes)
+    return report_all(all_diagnostics, opts, counters)
 
 def main(argv):
     # TODO have a separate whitelist of top level macrodefines: TARGET_HAS_ etc.
 
+    if len(argv) > 1 and argv[1] == "merge":
+        return merge_main(argv[2:])
+
     opts = parse_args(argv[1:])
 
-    input_file = opts.input_file
     verbose = opts.verbose
-    quiet = opts.quiet
-    whitelist_name = opts.whitelist
 
+    try:
+        registry = CheckRegistry(opts.plugins, opts.entry_point_plugins)
+    except (OSError, PluginError) as e:
+        print("Loading plugins failed: %s" % e)
+        return 2
     (enabled_wcodes, diag_err) = parse_diag_spec_line(opts.diagnostics,
-                                 all_wcodes)
+                                 registry.wcodes)
     if diag_err is not None:
         print("Parsing -D failed: %s" % diag_err)
         return 2
     if verbose:
         print("Enabled diagnostics: %s" % sorted(enabled_wcodes))
+    try:
+        checks = registry.load(enabled_wcodes)
+    except (ImportError, PluginError) as e:
+        print("Loading plugins failed: %s" % e)
+        return 2
 
-    if verbose:
-        print("Processing %s" % input_file)
-    if whitelist_name is not None:
-        whitelist = read_whitelist(input_file, whitelist_name)
-    else:
-        whitelist = list()
-
-    pre_lines = extract_preprocessor_lines(input_file)
-
-    if not opts.analyze_true_preprocessor:
-        pre_lines = list(filter(lambda l: not l.uses_macro_tricks(), pre_lines))
+    analysis = Analysis(opts, enabled_wcodes, registry, checks)
+    try:
+        all_input_files = analysis.sources.expand(opts.input_files)
+        input_files = all_input_files
+        if opts.shard is not None:
+            (shard_index, shard_count) = opts.shard
+            input_files = select_shard(input_files, shard_index, shard_count)
+        all_diagnostics = analyze_files(input_files, analysis)
+    except DirConfigError as e:
+        print("Reading directory configuration failed: %s" % e)
+        return 2
+    finally:
+        analysis.close()
 
-    diagnostics = list()
-    diagnostics += run_simple_checks(pre_lines, enabled_wcodes)
-    diagnostics += run_complex_checks(pre_lines, enabled_wcodes)
+    if opts.shard is not None:
+        # Whitelist and tree-wide checks are applied by merging
+        write_shard_result(opts.shard_output, opts.shard, all_input_files,
+                           all_diagnostics, analysis.identifier_index,
+                           enabled_wcodes, analysis.counters)
+        return 0
 
-    # Filter collected diagnostics against the whitelist
-    displayed_diagnostics = filter_diagnostics(diagnostics, whitelist)
-    # Sort the output by line number
-    displayed_diagnostics = sorted(displayed_diagnostics, key=lambda x:x.lineno)
-    if not quiet:
-        for diag in displayed_diagnostics:
-            (lineno, wcode, details) = (diag.lineno, diag.wcode, diag.details)
-            print("%s:%d: W%d: %s" % (input_file, lineno, wcode, details) )
-            verbatim_text = diag.first_line.strip('\n')
-            print("    %s" % verbatim_text)
-
-    return 0 if len(displayed_diagnostics) == 0 else 1
+    if analysis.identifier_index is not None:
+        add_tree_diagnostics(all_diagnostics, analysis.identifier_index,
+                             enabled_wcodes)
+    return report_all(all_diagnostics, opts, analysis.counters)
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
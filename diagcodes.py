@@ -1,6 +1,7 @@
 # Symbolic names for diagnostics
 
-from enum import IntEnum, unique
+import re
+from enum import IntEnum, IntFlag, unique
 
 @unique
 class DiagCodes(IntEnum):
@@ -21,8 +22,60 @@ class DiagCodes(IntEnum):
     too_long_define = 15
     multiline_conditional = 16
     wrong_context = 17
+    never_active_in_configs = 18
+    always_active_in_configs = 19
+    unused_macro = 20
+    analysis_limits = 21
 
 all_wcodes = frozenset(int(m) for m in DiagCodes.__members__.values())
 
+def update_diag_codes(result, spec_string, all_wcodes):
+    """Enable and disable codes in the set result as listed in spec_string,
+       separated by commas. Return tuple (result, None), or (None, error
+       message) if spec_string is malformed"""
+    tokens = spec_string.strip().split(",")
+    for token in tokens:
+        if token == "":
+            continue
+        if token == "all":
+            result.update(all_wcodes)
+        elif token == "-all":
+            result = set()
+        elif re.match(r"-?\d+", token):
+            num = int(token)
+            if num > 0:
+                result.add(num)
+            elif num < 0:
+                try:
+                    result.remove(-num)
+                except KeyError:
+                    pass # it's fine to attempt to remove non-present diag
+            else:
+                return (None, "invalid diagnostics code 0")
+        else:
+            return (None, "unrecognized token '%s'" % token)
+
+    # Check that only known numbers are in the set
+    extra_numbers = result.difference(all_wcodes)
+    if extra_numbers:
+        return (None, "unknown diagnostics codes %s" % extra_numbers)
+    return (result, None)
+
 def filter_diag_codes(full_list, enabled_wcodes):
     return set(diag for diag in full_list if diag.wcode in enabled_wcodes)
+
+class Feature(IntFlag):
+    """Parts of directives a diagnostic reads, declared by its "needs".
+       The hashword, lines and line numbers are always available. Parts no
+       enabled diagnostic needs are not computed in advance"""
+    HASHWORD = 0
+    CONTEXT = 1 # directive.context, needs tracking comments and strings
+    TOKENS = 2 # directive.tokens of every directive
+
+ALL_FEATURES = Feature.CONTEXT | Feature.TOKENS
+
+def required_features(full_list, enabled_wcodes):
+    res = Feature.HASHWORD
+    for diag in filter_diag_codes(full_list, enabled_wcodes):
+        res |= diag.needs
+    return res
@@ -0,0 +1,99 @@
+# Configuration of directories
+#
+# A file named .cppsa in a directory changes thresholds and enabled
+# diagnostics of files in it and in all of its subdirectories, e.g. allows
+# deeper nesting in legacy code:
+#
+#     diagnostics = -8,-16
+#     IFDEF_NESTING = 4
+#
+# Settings are names of Threshold and "diagnostics", a list like the one of
+# -D applied to codes enabled for the parent directory. Codes not enabled by
+# -D stay disabled. Configurations are merged from the root down, and each
+# directory is resolved once per process, not once per file.
+
+import os
+
+from diagcodes import update_diag_codes
+from threshold import Threshold, Thresholds
+
+class DirConfigError(Exception):
+    pass
+
+class DirConfig:
+    "Settings in effect for files of a directory"
+    def __init__(self, wcodes, thresholds):
+        self.wcodes = frozenset(wcodes)
+        self.thresholds = thresholds
+        # Files of identical contents only share results with equal keys
+        self.key = (self.wcodes, thresholds.key())
+
+def read_dir_config(file_name):
+    """Return a list of (lineno, name, value) of settings in a configuration
+       file, or None if there is no such file"""
+    try:
+        f = open(file_name)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    res = list()
+    with f:
+        for (lineno, line) in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            (name, sep, value) = line.partition("=")
+            if not sep:
+                raise DirConfigError("%s:%d: expected NAME = VALUE, got '%s'"
+                                     % (file_name, lineno, line))
+            res.append((lineno, name.strip(), value.strip()))
+    return res
+
+class DirConfigs:
+    "Resolved configurations of directories, see config_of()"
+    def __init__(self, config_name, enabled_wcodes, all_wcodes):
+        self.config_name = config_name
+        self.enabled_wcodes = frozenset(enabled_wcodes)
+        self.all_wcodes = all_wcodes
+        self.root = DirConfig(enabled_wcodes, Thresholds())
+        # Threads may resolve a directory twice, to equal configurations
+        self.resolved = dict() # directory -> DirConfig
+
+    def config_of(self, input_file):
+        """Return the DirConfig of input_file. Members of archives are in
+           directories such as "x.tar!dir", which never exist on disk, so
+           they get the configuration of the archive"""
+        if not self.config_name:
+            return self.root
+        return self.resolve(os.path.dirname(os.path.abspath(input_file)))
+
+    def resolve(self, directory):
+        config = self.resolved.get(directory)
+        if config is None:
+            parent = os.path.dirname(directory)
+            config = self.root if parent == directory else self.resolve(parent)
+            file_name = os.path.join(directory, self.config_name)
+            settings = read_dir_config(file_name)
+            if settings is not None:
+                config = self.merged(config, file_name, settings)
+            self.resolved[directory] = config
+        return config
+
+    def merged(self, config, file_name, settings):
+        "Return config changed by settings read from file_name"
+        wcodes = set(config.wcodes)
+        values = dict(vars(config.thresholds))
+        for (lineno, name, value) in settings:
+            where = "%s:%d" % (file_name, lineno)
+            if name == "diagnostics":
+                (wcodes, err) = update_diag_codes(wcodes, value,
+                                                  self.all_wcodes)
+                if err is not None:
+                    raise DirConfigError("%s: %s" % (where, err))
+            elif name in Threshold.__members__:
+                if not value.isdigit():
+                    raise DirConfigError("%s: %s must be a non-negative"
+                                         " integer" % (where, name))
+                values[name] = int(value)
+            else:
+                raise DirConfigError("%s: unknown setting %s" % (where, name))
+        return DirConfig(wcodes & self.enabled_wcodes, Thresholds(values))
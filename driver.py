@@ -0,0 +1,412 @@
+# Driver running the analysis over many files
+
+from tokenizer import extract_directives
+from columns import DirectiveColumns
+from multiconfig import read_configs, ConfigSet, run_config_checks
+from multiconfig import config_diagnostics
+from diagcodes import ALL_FEATURES, required_features
+from macroindex import IdentifierIndex, run_tree_checks
+from sourcetext import read_source, split_source_lines, prefetch_sources
+from sourcetext import MemoryCap
+from ircache import DirectiveCache, content_hash
+from parallel import extract_directives_parallel, executor_kind
+from schedule import schedule_order, TimingCache, WorkerStats
+from schedule import timed_call, PARENT_WORKER
+from packed import DiagnosticBatch
+from metrics import Counters, TokenizeCacheTracker, line_count
+from limits import AnalysisLimits, FileBudget
+from archives import ArchiveSources
+from baseline import add_block_contexts
+from stats import count_directive_shapes, copy_counters
+from registry import CheckRegistry
+from dirconfig import DirConfigs
+
+class Analysis:
+    """Settings and state shared by all files of one run.
+       A worker's Analysis has neither an executor nor an identifier index,
+       its tasks return identifiers and counters of each file instead.
+       registry and checks are a CheckRegistry and what its load() returned
+       for enabled_wcodes, by default of built-in checks only"""
+    def __init__(self, opts, enabled_wcodes, registry=None, checks=None,
+                 worker=False):
+        self.opts = opts
+        self.enabled_wcodes = enabled_wcodes
+        self.limits = AnalysisLimits(opts)
+        # Input files, also members of archives, are read through it
+        self.sources = ArchiveSources(opts.archive_members.split(","),
+                                      opts.max_file_size)
+
+        if opts.configs is not None:
+            self.config_set = ConfigSet(read_configs(opts.configs))
+        else:
+            self.config_set = None
+
+        # Checks applied to each directive and to whole files
+        if registry is None:
+            registry = CheckRegistry()
+        if checks is None:
+            checks = registry.load(enabled_wcodes)
+        (self.directive_checks, self.file_checks, self.run_directive_checks,
+         self.run_file_checks) = checks
+        all_checks = self.directive_checks + self.file_checks
+        if self.config_set is not None:
+            all_checks += config_diagnostics
+        self.features = required_features(all_checks, enabled_wcodes)
+        self.dir_configs = DirConfigs(opts.dir_config, enabled_wcodes,
+                                      registry.wcodes)
+
+        if opts.unused_macros and not worker:
+            self.identifier_index = IdentifierIndex()
+        else:
+            self.identifier_index = None
+
+        if opts.cache_dir is not None:
+            self.directive_cache = DirectiveCache(opts.cache_dir)
+        else:
+            self.directive_cache = None
+
+        if opts.cache_dir is not None and not worker:
+            self.timing_cache = TimingCache(opts.cache_dir)
+        else:
+            self.timing_cache = None
+
+        # Counters of the whole run. Tasks of workers count into their own,
+        # merged here in analyze_files_parallel()
+        self.counters = Counters()
+        self.tokenize_tracker = TokenizeCacheTracker()
+
+        self.executor = None
+        self.threads = False
+        if opts.jobs > 1 and not worker:
+            # Importing multiprocessing alone takes longer than analyzing a
+            # small file, runs without --jobs do without it
+            from concurrent.futures import ProcessPoolExecutor
+            from concurrent.futures import ThreadPoolExecutor
+            if executor_kind(opts.executor) == "thread":
+                # Workers share this Analysis and all module caches
+                self.executor = ThreadPoolExecutor(opts.jobs)
+                self.threads = True
+            else:
+                self.executor = ProcessPoolExecutor(opts.jobs,
+                                    initializer=init_worker,
+                                    initargs=(opts, enabled_wcodes,
+                                              registry, checks))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.sources.close()
+
+def extract_preprocessor_lines(input_file, identifier_index=None,
+                               executor=None, jobs=1, split_lines=0,
+                               directive_cache=None, raw=None,
+                               features=ALL_FEATURES, counters=None):
+    """Return the list of directives of input_file. If identifier_index
+       is given, identifiers used in the file are added to it on the way.
+       With an executor, files of at least split_lines lines are split into
+       chunks processed by jobs workers in parallel.
+       With a directive_cache, directives of already seen contents are
+       loaded from it instead. The identifier index is not cached, so the
+       cache is bypassed when it is requested.
+       raw contents of the file can be passed if they are already read.
+       Parts of directives not in features may be left out, see Feature.
+       The file is counted in counters if they are given"""
+    if raw is None:
+        raw = read_source(input_file)
+    cache_key = None
+    if directive_cache is not None and identifier_index is None:
+        cache_key = content_hash(raw)
+        res = directive_cache.load(cache_key)
+        if counters is not None:
+            counters.add("directive_cache_hits_total" if res is not None
+                         else "directive_cache_misses_total")
+        if res is not None:
+            count_file(counters, raw, res)
+            return res
+        # Entries serve later runs with any checks enabled
+        features = ALL_FEATURES
+
+    lines = split_source_lines(raw)
+    if executor is not None and split_lines > 0 and len(lines) >= split_lines:
+        res = extract_directives_parallel(lines, input_file, identifier_index,
+                                          executor, jobs, features)
+    else:
+        res = extract_directives(lines, input_file, identifier_index,
+                                 features=features)
+    if cache_key is not None:
+        directive_cache.store(cache_key, res)
+    count_file(counters, raw, res)
+    return res
+
+def count_file(counters, raw, pre_lines):
+    if counters is not None:
+        counters.add("files_total")
+        counters.add("lines_total", line_count(raw))
+        counters.add("directives_total", len(pre_lines))
+
+worker_analysis = None # Analysis of a worker process, see init_worker()
+
+def init_worker(opts, enabled_wcodes, registry, checks):
+    global worker_analysis
+    worker_analysis = Analysis(opts, enabled_wcodes, registry, checks,
+                               worker=True)
+
+def check_directives(pre_lines, analysis, counters=None, budget=None,
+                     config=None):
+    """Run all per-file checks over directives of a file, within the limits
+       of its budget if given. config is the DirConfig of the file, by
+       default the one of options alone"""
+    opts = analysis.opts
+    if config is None:
+        config = analysis.dir_configs.root
+    enabled_wcodes = config.wcodes
+    if budget is not None:
+        pre_lines = budget.truncate(pre_lines)
+    all_lines = pre_lines
+    if opts.stats and counters is not None:
+        count_directive_shapes(counters, all_lines)
+    if not opts.analyze_true_preprocessor:
+        pre_lines = list(filter(lambda l: not l.uses_macro_tricks(), pre_lines))
+
+    columns = DirectiveColumns(pre_lines)
+    diagnostics = list()
+    run_checks = analysis.run_directive_checks
+    if run_checks is not None and (budget is None
+                                   or not budget.expired("simple")):
+        diagnostics += run_checks(columns, enabled_wcodes, counters,
+                                  analysis.directive_checks, config.thresholds)
+    run_checks = analysis.run_file_checks
+    if run_checks is not None and (budget is None
+                                   or not budget.expired("complex")):
+        diagnostics += run_checks(columns, enabled_wcodes, counters,
+                                  analysis.file_checks, config.thresholds)
+    if analysis.config_set is not None and (budget is None
+                                            or not budget.expired("config")):
+        diagnostics += run_config_checks(pre_lines, enabled_wcodes,
+                                         analysis.config_set, counters)
+    if budget is not None:
+        diagnostics += limit_notes(budget, enabled_wcodes)
+    add_block_contexts(diagnostics, all_lines)
+    return diagnostics
+
+def limit_notes(budget, enabled_wcodes):
+    # Limits apply even with their notes disabled
+    return list(note for note in budget.notes
+                if note.wcode in enabled_wcodes)
+
+def analyze_file(input_file, analysis, raw=None, counters=None):
+    """Return the list of diagnostics for input_file, not yet filtered against
+       the whitelist. The file is counted into counters, by default the ones
+       of analysis"""
+    opts = analysis.opts
+    if counters is None:
+        counters = analysis.counters
+    if raw is None:
+        raw = analysis.sources.read(input_file)
+    config = analysis.dir_configs.config_of(input_file)
+    budget = FileBudget(analysis.limits, raw,
+                        analysis.sources.truncated_size(input_file))
+    if budget.too_large():
+        return limit_notes(budget, config.wcodes)
+    pre_lines = extract_preprocessor_lines(input_file,
+                                           analysis.identifier_index,
+                                           analysis.executor, opts.jobs,
+                                           opts.split_lines,
+                                           analysis.directive_cache, raw,
+                                           analysis.features, counters)
+    return check_directives(pre_lines, analysis, counters, budget, config)
+
+def analyze_file_task(input_file, raw, analysis=None, executor=None,
+                      size=None):
+    """Analyze a file as a task of the executor. Return tuple (diagnostics,
+       identifier index of the file or None, counters of the file), so that
+       tasks never update shared state. Thread workers pass the parent's
+       analysis, process workers use the one made by init_worker(). size is
+       the one of the whole file if raw is only its beginning"""
+    if analysis is None:
+        analysis = worker_analysis
+    opts = analysis.opts
+    identifier_index = IdentifierIndex() if opts.unused_macros else None
+    counters = Counters()
+    config = analysis.dir_configs.config_of(input_file)
+    budget = FileBudget(analysis.limits, raw, size)
+    if budget.too_large():
+        return (limit_notes(budget, config.wcodes), identifier_index,
+                counters)
+    pre_lines = extract_preprocessor_lines(input_file, identifier_index,
+                                           executor, opts.jobs,
+                                           opts.split_lines,
+                                           analysis.directive_cache, raw,
+                                           analysis.features, counters)
+    return (check_directives(pre_lines, analysis, counters, budget, config),
+            identifier_index, counters)
+
+def packed_file_task(input_file, raw):
+    "Same as analyze_file_task() in a worker process, with a packed result"
+    (diagnostics, identifier_index, counters) = analyze_file_task(input_file,
+                                                                  raw)
+    # The tokenizer cache of a thread worker is the parent's, counted there
+    worker_analysis.tokenize_tracker.count(counters)
+    return (DiagnosticBatch(diagnostics), identifier_index, counters)
+
+def submit_file(input_file, raw, analysis, done):
+    """Start analysis of a file by the executor. Return a callable giving
+       the result of timed_call() of analyze_file_task(). done() is called
+       once raw contents are no longer referenced by the task"""
+    executor = analysis.executor
+    size = analysis.sources.truncated_size(input_file)
+    if (size is not None
+            or raw.count(b"\n") + 1 >= analysis.opts.split_lines > 0):
+        # A file too large to be read only gets its note. A huge file is
+        # split into chunks for the workers instead, here. Its task waiting
+        # for chunks inside a worker could take up all of them and never
+        # finish
+        (_, elapsed, result) = timed_call(analyze_file_task, input_file, raw,
+                                          analysis, executor, size)
+        done()
+        return lambda: (PARENT_WORKER, elapsed, result)
+    if analysis.threads:
+        future = executor.submit(timed_call, analyze_file_task, input_file,
+                                 raw, analysis)
+        future.add_done_callback(lambda future: done())
+        return future.result
+    from concurrent.futures import Future
+    future = executor.submit(timed_call, packed_file_task, input_file, raw)
+    # Unpacked as soon as the worker is done. The callback stays referenced
+    # by the future, so it takes raw contents out of source
+    source = [raw]
+    unpacked = Future()
+    def unpack(future):
+        try:
+            raw = source.pop()
+            if future.exception() is not None:
+                unpacked.set_exception(future.exception())
+                return
+            (worker, elapsed, (batch, identifier_index,
+                               counters)) = future.result()
+            unpacked.set_result((worker, elapsed, (batch.unpack(raw),
+                                                   identifier_index,
+                                                   counters)))
+        finally:
+            done()
+    future.add_done_callback(unpack)
+    return unpacked.result
+
+def result_key(input_file, raw, analysis):
+    "Key of results shared by files of identical contents and settings"
+    # Of files too large to be read, only beginnings are hashed
+    return (content_hash(raw), analysis.sources.truncated_size(input_file),
+            analysis.dir_configs.config_of(input_file).key)
+
+def read_sources(input_files, analysis):
+    """Return prefetch_sources() of input_files, also of members of
+       archives, as set by --prefetch and --prefetch-memory"""
+    opts = analysis.opts
+    memory = MemoryCap(opts.prefetch_memory << 20)
+    analysis.sources.expect(input_files, memory)
+    return prefetch_sources(input_files, opts.prefetch, memory,
+                            analysis.sources.read, analysis.sources.size)
+
+def analyze_files(input_files, analysis):
+    """Return a dict mapping every input file to its list of diagnostics.
+       Files with identical contents and directory configurations, e.g.
+       vendored copies of the same header, are analyzed once and share one
+       list of diagnostics; it is up to the caller to apply each file's
+       whitelist to it.
+       With an executor, files are analyzed by its workers in parallel"""
+    if analysis.executor is not None:
+        return analyze_files_parallel(input_files, analysis)
+    opts = analysis.opts
+    res = dict()
+    # A single file has no copies to share results with, nor to hash
+    single = len(input_files) == 1
+    # result key or file -> (first file, diagnostics, its copy_counters())
+    analyzed = dict()
+    for (input_file, raw, done) in read_sources(input_files, analysis):
+        key = input_file if single else result_key(input_file, raw, analysis)
+        if key in analyzed:
+            (first_file, diagnostics, copied) = analyzed[key]
+            if opts.verbose:
+                print("Skipping %s, same contents as %s" % (input_file,
+                                                            first_file))
+            analysis.counters.merge(copied)
+        else:
+            if opts.verbose:
+                print("Processing %s" % input_file)
+            counters = Counters()
+            diagnostics = analyze_file(input_file, analysis, raw, counters)
+            analysis.counters.merge(counters)
+            analyzed[key] = (input_file, diagnostics, copy_counters(counters))
+        res[input_file] = diagnostics
+        # Counted against --prefetch-memory until done(), not kept here
+        del raw
+        done()
+    analysis.tokenize_tracker.count(analysis.counters)
+    return res
+
+def analyze_files_parallel(input_files, analysis):
+    """Same as analyze_files(), but with files submitted to the executor
+       longest first, see schedule_order()"""
+    opts = analysis.opts
+    if analysis.timing_cache is not None:
+        timings = analysis.timing_cache.load()
+    else:
+        timings = dict()
+    stats = WorkerStats(opts.jobs)
+    # Members of archives are read in the order they are stored in them
+    in_archives = list(filter(analysis.sources.in_archive, input_files))
+    order = schedule_order(list(f for f in input_files
+                                if not analysis.sources.in_archive(f)),
+                           timings, opts.prefetch) + in_archives
+    pending = dict() # result key -> (first file, callable giving result)
+    keys = dict() # file -> result key
+    for (input_file, raw, done) in read_sources(order, analysis):
+        key = result_key(input_file, raw, analysis)
+        keys[input_file] = key
+        if key in pending:
+            if opts.verbose:
+                print("Skipping %s, same contents as %s" % (input_file,
+                                                            pending[key][0]))
+            done()
+        else:
+            if opts.verbose:
+                print("Processing %s" % input_file)
+            pending[key] = (input_file,
+                            submit_file(input_file, raw, analysis, done))
+        # Counted against --prefetch-memory until done(), not kept here
+        del raw
+
+    # Collect in the order of input files, so that results do not depend on
+    # the schedule and timing of workers
+    res = dict()
+    analyzed = dict() # result key -> (diagnostics, their copy_counters())
+    for input_file in input_files:
+        key = keys[input_file]
+        if key not in analyzed:
+            (first_file, result) = pending[key]
+            (worker, elapsed, (diagnostics, identifier_index,
+                               counters)) = result()
+            stats.add(worker, elapsed)
+            timings[first_file] = elapsed
+            if identifier_index is not None:
+                analysis.identifier_index.merge(identifier_index)
+            analysis.counters.merge(counters)
+            analyzed[key] = (diagnostics, copy_counters(counters))
+        else:
+            analysis.counters.merge(analyzed[key][1])
+        res[input_file] = analyzed[key][0]
+
+    if opts.verbose:
+        stats.print_summary()
+    if analysis.timing_cache is not None:
+        analysis.timing_cache.store(timings)
+    analysis.tokenize_tracker.count(analysis.counters)
+    return res
+
+def add_tree_diagnostics(all_diagnostics, identifier_index, enabled_wcodes):
+    "Run checks needing all files at once, see analyze_files()"
+    tree_diagnostics = run_tree_checks(identifier_index, enabled_wcodes)
+    for (first_file, diag) in tree_diagnostics:
+        # Lands in the list shared by all copies of first_file
+        all_diagnostics[first_file].append(diag)
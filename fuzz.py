@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# Differential fuzzing of the scanner and the tokenizer
+#
+# Frozen copies of tokenize(), update_language_context() with its tokens and
+# transitions, and extract_multiline_sequence() below are the reference, so
+# that changes of the scanner cannot change it too: a faster replacement
+# of any of them, and every alternative path already built on them (hashword
+# only tokenizing, context maps, code fragments, extraction without context,
+# parallel extraction, lazy tokens), must give the same results on random
+# C-like inputs, quirks included, and none may raise. A failing input is
+# shrunk and can be saved as a regression fixture test/fuzz-<check>-<hash>,
+# replayed by utest.py.
+#
+#   python3 fuzz.py [--seed N] [--iterations N] [--save]
+
+import os
+import sys
+import random
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from keywords import line_is_preprocessor_directive
+from rolling import Context, update_language_context, code_fragments
+from rolling import context_map
+from tokenizer import tokenize, tokenize_directive, directive_hashword
+from tokenizer import extract_multiline_sequence, extract_directives
+from parallel import extract_directives_parallel
+from diagcodes import Feature
+
+FIXTURE_DIR = "test"
+FIXTURE_PREFIX = "fuzz-"
+
+# Reference implementations, as they were when the harness was written.
+# Since then: only ASCII whitespace separates tokens, and a lone "#" is a
+# directive of its own
+
+reference_whitespace = " \t\n\v\f\r"
+
+def reference_match_special(s):
+    specials = ("(", ")", ",", "\\", "##", "!", "//", "/*")
+    for special in specials:
+        if s.find(special) == 0:
+            return special
+    return None
+
+def reference_tokenize(txt):
+    res = list()
+    i = 0
+    while i < len(txt):
+        if txt[i] in reference_whitespace:
+            i += 1
+            continue
+        matched_special = reference_match_special(txt[i:])
+        if matched_special is not None:
+            i += len(matched_special)
+            res.append(matched_special)
+            continue
+        k = i+1
+        while (k < len(txt)
+               and (reference_match_special(txt[k:]) is None)
+               and txt[k] not in reference_whitespace):
+            k += 1
+        res.append(txt[i:k])
+        i = k
+    return res
+
+reference_tokens = frozenset(("/*", "*/", "//", "\n", "\\", '"'))
+
+def reference_find_next_token(line, tokens):
+    min_pos = len(line) + 1
+    min_token = None
+    for token in tokens:
+        pos = line.find(token)
+        if pos == -1:
+            continue
+        if pos < min_pos:
+            min_pos = pos
+            min_token = token
+    return (min_token, min_pos)
+
+# Context after a token, by context before it. Other tokens keep the context
+reference_transfer_table = {
+    Context.OUTSIDE: {"/*": Context.COMMENT, "//": Context.SLASH_COMMENT,
+                      "*/": Context.OUTSIDE, "\n": Context.OUTSIDE,
+                      "\\": Context.OUTSIDE, '"': Context.QUOTES},
+    Context.COMMENT: {"*/": Context.OUTSIDE},
+    Context.SLASH_COMMENT: {"\n": Context.OUTSIDE},
+    Context.QUOTES: {'"': Context.OUTSIDE},
+}
+
+def reference_transfer(context, token):
+    return reference_transfer_table[context].get(token, context)
+
+def reference_update_language_context(lines, old_state):
+    line = "".join(lines)
+    context = old_state
+    pos = 0
+    while pos < len(line):
+        (next_token, delta) = reference_find_next_token(line[pos:],
+                                                        reference_tokens)
+        if next_token is None:
+            return context
+        if next_token == "\\":
+            pos += delta + len(next_token) + 1
+            continue
+        context = reference_transfer(context, next_token)
+        pos += delta + len(next_token)
+    return context
+
+def reference_line_ends_with_continuation(txt):
+    txt = txt.strip(reference_whitespace)
+    return len(txt) > 0 and txt[-1] == "\\"
+
+def reference_extract_multiline_sequence(lines, start_lineno):
+    lineno = start_lineno
+    res = []
+    while lineno < len(lines):
+        this_line = lines[lineno]
+        res.append(this_line)
+        if not reference_line_ends_with_continuation(this_line):
+            break
+        lineno += 1
+    return res
+
+def reference_directive_tokens(stripped_txt):
+    tokens = reference_tokenize(stripped_txt)
+    if len(tokens) > 1 and len(tokens[0]) == 1:
+        tokens = [tokens[0] + tokens[1]] + tokens[2:]
+    return tokens
+
+def reference_combine_lines(multi_lines):
+    res = ''
+    for line in multi_lines:
+        line = line.strip(reference_whitespace)
+        if reference_line_ends_with_continuation(line):
+            line = line[:-1]
+        if res and res[-1] not in reference_whitespace:
+            res += " "
+        res += line
+    return res
+
+def reference_extract(lines):
+    "Return a list of (lineno, multi_lines, context, tokens) of directives"
+    res = list()
+    context = Context.OUTSIDE
+    lineno = 0
+    while lineno < len(lines):
+        if line_is_preprocessor_directive(lines[lineno]):
+            multi_lines = reference_extract_multiline_sequence(lines, lineno)
+            tokens = reference_directive_tokens(
+                reference_combine_lines(multi_lines).strip(
+                    reference_whitespace))
+            res.append((lineno + 1, multi_lines, context, tokens))
+            lineno += len(multi_lines)
+            context = reference_update_language_context(multi_lines, context)
+        else:
+            context = reference_update_language_context([lines[lineno]],
+                                                        context)
+            lineno += 1
+    return res
+
+# Random inputs
+
+pieces = ("#", "##", "# ", "#define", "#if", "# ifdef", "#endif", "#x",
+          "/*", "*/", "//", "/", "*", '"', "'", "\\", "\\\\", "\\\n", " ",
+          "\t", "a", "b_1", "X", "(", ")", ",", "!", "0", "1", "0x1f", "...",
+          "__LINE__", "__VA_ARGS__", "&&", "||", "<", "=", ";", "{", "}",
+          "\xa0", "\x85")
+
+def random_line(rng):
+    res = ""
+    if rng.random() < 0.5:
+        res += rng.choice(("#", "#", " #", "\t# ", "##", "#define ", "#if "))
+    for _ in range(rng.randrange(8)):
+        res += rng.choice(pieces)
+    if rng.random() < 0.25:
+        res += rng.choice(("\\", " \\", "\\ ", "\\\\"))
+    return res + "\n"
+
+def random_input(rng):
+    res = "".join(random_line(rng) for _ in range(rng.randrange(1, 12)))
+    if rng.random() < 0.2:
+        res = res[:-1] # no newline at the end of file
+    return res
+
+# Checks. Each returns None if the paths agree, or a description otherwise.
+# See run_check() for exceptions
+
+def check_tokenize(txt):
+    for piece in [txt] + txt.splitlines(keepends=True):
+        if tokenize(piece) != reference_tokenize(piece):
+            return "tokenize(%r)" % piece
+        stripped = piece.strip(reference_whitespace)
+        if not line_is_preprocessor_directive(stripped):
+            continue
+        expected = reference_directive_tokens(stripped)
+        if list(tokenize_directive(stripped)[1]) != expected:
+            return "tokenize_directive(%r)" % stripped
+        if directive_hashword(stripped) != expected[0]:
+            return "directive_hashword(%r)" % stripped
+    return None
+
+def check_context(txt):
+    lines = txt.splitlines(keepends=True)
+    for start in Context:
+        expected = reference_update_language_context(lines, start)
+        if update_language_context(lines, start) != expected:
+            return "update_language_context(%r, %s)" % (lines, start)
+        if code_fragments(lines, start)[1] != expected:
+            return "code_fragments(%r, %s)" % (lines, start)
+        by_line = start
+        for line in lines:
+            by_line = reference_update_language_context([line], by_line)
+        if context_map(lines)[start] != by_line:
+            return "context_map(%r)[%s]" % (lines, start)
+    return None
+
+def check_multiline(txt):
+    lines = txt.splitlines(keepends=True)
+    for start in range(len(lines)):
+        expected = reference_extract_multiline_sequence(lines, start)
+        if extract_multiline_sequence(lines, start) != expected:
+            return "extract_multiline_sequence(%r, %d)" % (lines, start)
+    return None
+
+def directive_summary(directives):
+    return list((d.lineno, d.multi_lines, d.context, list(d.tokens))
+                for d in directives)
+
+def check_extract(txt):
+    lines = txt.splitlines(keepends=True)
+    expected = reference_extract(lines)
+    if directive_summary(extract_directives(lines, "f.c")) != expected:
+        return "extract_directives(%r)" % lines
+    spans = list((lineno, multi_lines) for (lineno, multi_lines, _, _)
+                 in expected)
+    res = extract_directives(lines, "f.c", features=Feature.HASHWORD)
+    if list((d.lineno, d.multi_lines) for d in res) != spans:
+        return "extract_directives(%r) without context" % lines
+    eager = extract_directives(lines, "f.c")
+    if (list((d.hashword, d.tokens) for d in res)
+            != list((d.hashword, d.tokens) for d in eager)):
+        return "lazy tokens of %r" % lines
+    with ThreadPoolExecutor(2) as executor:
+        for chunk_count in range(1, 5):
+            res = extract_directives_parallel(lines, "f.c", None, executor,
+                                              chunk_count)
+            if directive_summary(res) != expected:
+                return "extract_directives_parallel(%r, %d)" % (lines,
+                                                               chunk_count)
+    return None
+
+checks = {
+    "tokenize": check_tokenize,
+    "context": check_context,
+    "multiline": check_multiline,
+    "extract": check_extract,
+}
+
+def run_check(check_name, txt):
+    """Return None if paths of the check agree on txt, or a description.
+       An exception of either the reference or a fast path is a failure:
+       every input must be analyzed"""
+    try:
+        return checks[check_name](txt)
+    except Exception as e:
+        return "%s raised on %r" % (type(e).__name__, txt)
+
+def shrink(txt, fails):
+    """Return a smallest found input still failing: drop lines, then single
+       characters, while fails(input) holds"""
+    for unit in ("lines", "chars"):
+        changed = True
+        while changed:
+            changed = False
+            parts = (txt.splitlines(keepends=True) if unit == "lines"
+                     else list(txt))
+            for i in range(len(parts)):
+                candidate = "".join(parts[:i] + parts[i + 1:])
+                if candidate and fails(candidate):
+                    txt = candidate
+                    changed = True
+                    break
+    return txt
+
+def fixture_name(check_name, txt):
+    digest = hashlib.blake2b(txt.encode("latin-1", "replace"),
+                             digest_size=4).hexdigest()
+    return os.path.join(FIXTURE_DIR, "%s%s-%s" % (FIXTURE_PREFIX, check_name,
+                                                  digest))
+
+def save_fixture(check_name, txt):
+    file_name = fixture_name(check_name, txt)
+    with open(file_name, "w", encoding="latin-1", newline="") as f:
+        f.write(txt)
+    return file_name
+
+def fixtures():
+    "Return a list of (check name, input) of saved regression fixtures"
+    res = list()
+    for file_name in sorted(os.listdir(FIXTURE_DIR)):
+        if not file_name.startswith(FIXTURE_PREFIX):
+            continue
+        check_name = file_name[len(FIXTURE_PREFIX):].rsplit("-", 1)[0]
+        with open(os.path.join(FIXTURE_DIR, file_name), encoding="latin-1",
+                  newline="") as f:
+            res.append((check_name, f.read()))
+    return res
+
+def fuzz(seed, iterations):
+    """Run all checks on random inputs. Return a list of (check name, shrunk
+       input, description) of failures"""
+    rng = random.Random(seed)
+    res = list()
+    for _ in range(iterations):
+        txt = random_input(rng)
+        for check_name in checks:
+            if run_check(check_name, txt) is None:
+                continue
+            shrunk = shrink(txt, lambda t: run_check(check_name, t) is not None)
+            res.append((check_name, shrunk, run_check(check_name, shrunk)))
+    return res
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=
+                                     "Compare scanner fast paths with the reference")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--save", action="store_true",
+                        help="Save shrunk failures as fixtures in test/")
+    opts = parser.parse_args(argv[1:])
+
+    failures = fuzz(opts.seed, opts.iterations)
+    seen = set()
+    for (check_name, txt, description) in failures:
+        if (check_name, txt) in seen:
+            continue
+        seen.add((check_name, txt))
+        print("%s: %s" % (check_name, description))
+        if opts.save:
+            print("    saved as %s" % save_fixture(check_name, txt))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,139 @@
+# Cache of extracted directives, keyed by contents of source files
+#
+# Reading directives back from the cache skips context tracking and
+# tokenization, so re-running checks with other -D or thresholds over
+# unchanged sources only costs hashing and the checks themselves.
+
+import os
+import marshal
+import threading
+from array import array
+from sys import intern
+
+from tokenizer import PreprocessorDirective
+from rolling import Context, context_codes
+
+# Increment when extraction or tokenization changes its results
+IR_VERSION = 2
+IR_MAGIC = b"cppsa-ir"
+
+contexts_by_code = list(Context)
+
+def content_hash(raw):
+    # hashlib loads OpenSSL, only runs of several files or with a cache
+    # hash contents
+    import hashlib
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def serialize_directives(directives):
+    """Pack directives into bytes. All strings (lines, texts, tokens) go into
+       a table of unique strings, directives refer to them by index"""
+    strings = list()
+    string_index = dict()
+    def ref(txt):
+        index = string_index.get(txt)
+        if index is None:
+            index = len(strings)
+            string_index[txt] = index
+            strings.append(txt)
+        return index
+
+    lineno = array('I')
+    context = array('B')
+    line_counts = array('I')
+    line_refs = array('I')
+    text_refs = array('I')
+    token_counts = array('I')
+    token_refs = array('I')
+    for directive in directives:
+        lineno.append(directive.lineno)
+        context.append(context_codes[directive.context])
+        line_counts.append(len(directive.multi_lines))
+        line_refs.extend(ref(line) for line in directive.multi_lines)
+        text_refs.append(ref(directive.full_text))
+        token_counts.append(len(directive.tokens))
+        token_refs.extend(ref(token) for token in directive.tokens)
+
+    columns = (lineno, context, line_counts, line_refs, text_refs,
+               token_counts, token_refs)
+    payload = (IR_VERSION, strings) + tuple(c.tobytes() for c in columns)
+    return IR_MAGIC + marshal.dumps(payload)
+
+def deserialize_directives(data):
+    """Restore directives packed by serialize_directives(). Return None if
+       data is of another format version"""
+    if not data.startswith(IR_MAGIC):
+        return None
+    payload = marshal.loads(data[len(IR_MAGIC):])
+    if payload[0] != IR_VERSION:
+        return None
+    strings = payload[1]
+    (lineno, context, line_counts, line_refs, text_refs,
+     token_counts, token_refs) = (array(typecode)
+                                  for typecode in "IBIIIII")
+    for (column, raw) in zip((lineno, context, line_counts, line_refs,
+                              text_refs, token_counts, token_refs),
+                             payload[2:]):
+        column.frombytes(raw)
+
+    # Tokens of equal text are shared, as done by tokenize_directive()
+    tokens_by_text = dict()
+    res = list()
+    line_pos = 0
+    token_pos = 0
+    for index in range(len(lineno)):
+        line_end = line_pos + line_counts[index]
+        multi_lines = list(strings[i] for i in line_refs[line_pos:line_end])
+        line_pos = line_end
+        token_end = token_pos + token_counts[index]
+        full_text = strings[text_refs[index]]
+        tokens = tokens_by_text.get(full_text)
+        if tokens is None:
+            tokens = tuple(intern(strings[i])
+                           for i in token_refs[token_pos:token_end])
+            tokens_by_text[full_text] = tokens
+        token_pos = token_end
+        res.append(PreprocessorDirective.from_parts(multi_lines, lineno[index],
+                                            contexts_by_code[context[index]],
+                                            full_text, tokens))
+    return res
+
+class DirectiveCache:
+    """Directory of serialized directives, one file per source content hash.
+       Failing to read or write it only costs a miss, never the analysis"""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError:
+            pass # every store() fails, every load() misses
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "%s.ir%d" % (key, IR_VERSION))
+
+    def load(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            return deserialize_directives(data)
+        except (ValueError, EOFError, TypeError, IndexError):
+            return None # a damaged entry is the same as a missing one
+
+    def store(self, key, directives):
+        # Write to a temporary file first, parallel runs and worker threads
+        # may share the cache
+        path = self.path(key)
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(serialize_directives(directives))
+            os.replace(tmp_path, path)
+        except OSError:
+            # E.g. a read-only cache or a full disk
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -1,20 +1,39 @@
 # Keywords of C/C++ preprocessor
 
-INCLUDE = "#include"
-DEFINE = "#define"
-UNDEF ="#undef"
-IFDEF = "#ifdef"
-IFNDEF = "#ifndef"
-IF = "#if"
-ELSE = "#else"
-ELIF ="#elif"
-ENDIF ="#endif"
-ERROR = "#error"
-PRAGMA = "#pragma"
+from sys import intern
+
+# Interned, so that hashwords of tokenized directives share these objects
+INCLUDE = intern("#include")
+DEFINE = intern("#define")
+UNDEF = intern("#undef")
+IFDEF = intern("#ifdef")
+IFNDEF = intern("#ifndef")
+IF = intern("#if")
+ELSE = intern("#else")
+ELIF = intern("#elif")
+ENDIF = intern("#endif")
+ERROR = intern("#error")
+PRAGMA = intern("#pragma")
+# A line of a single "#" is valid and does nothing
+NULL_DIRECTIVE = intern("#")
 
 all_directives = (INCLUDE, DEFINE, UNDEF, IFDEF, IFNDEF, IF, ELSE, ELIF, ENDIF,
                   ERROR, PRAGMA)
 
+# Small integer codes of directives, used by checks working on columns of
+# directives (see columns.py). Zero is reserved for unknown directives
+UNKNOWN_CODE = 0
+(INCLUDE_CODE, DEFINE_CODE, UNDEF_CODE, IFDEF_CODE, IFNDEF_CODE, IF_CODE,
+ ELSE_CODE, ELIF_CODE, ENDIF_CODE, ERROR_CODE, PRAGMA_CODE) = range(1,
+                                                        len(all_directives) + 1)
+directive_codes = dict((d, code) for (code, d) in enumerate(all_directives, 1))
+assert directive_codes[PRAGMA] == PRAGMA_CODE, "codes follow all_directives"
+
+open_codes = frozenset((IF_CODE, IFNDEF_CODE, IFDEF_CODE))
+
+def hashword_code(hashword):
+    return directive_codes.get(hashword, UNKNOWN_CODE)
+
 CPLUSPLUS = "__cplusplus"
 # Do not include __cplusplus as it is treated specially
 std_predefined_macros = frozenset(("__FILE__", "__LINE__", "__DATE__", "__TIME__",
@@ -24,6 +43,10 @@ variadic_macros = frozenset(("...", "__VA_ARGS__", "__VA_OPT__"))
 
 preprocessor_prefixes = ("#",)
 
+# Whitespace of C. Sources are decoded byte per character as latin-1, where
+# str.strip(), str.isspace() and \s would also take 0x85 and 0xA0 for it
+whitespace = " \t\n\v\f\r"
+
 def is_open_directive(d):
     return d in (IF, IFNDEF, IFDEF)
 
@@ -31,7 +54,7 @@ def is_close_directive(d):
     return d in (ENDIF, )
 
 def line_is_preprocessor_directive(txt):
-    txt = txt.strip()
+    txt = txt.strip(whitespace)
     return (len(txt) > 0 and txt[0] in preprocessor_prefixes)
 
 def directive_contains_condition(txt):
@@ -0,0 +1,122 @@
+# Limits of work spent on one file
+#
+# Generated sources may have directives continued over thousands of lines or
+# single lines hundreds of KB long. Scanning is linear in the size of a file,
+# but checks of such directives are of no use to anybody, and a file growing
+# without bound should not stall a whole run. Files and directives over the
+# limits get a W21 note: too large files are not read, only their beginning
+# is, too long directives are truncated, and stages of checks are skipped
+# once a file has used up its time. Directives are truncated after
+# extraction, which still reads and, for most checks, tokenizes them whole:
+# their limits bound the work of checks and the size of findings, not of
+# extraction. The time is only looked at before each stage of checks: it
+# bounds neither extraction nor a single stage, only stops the next ones.
+
+import time
+
+from diagcodes import DiagCodes
+from multichecks import BaseMultilineDiagnostic
+from tokenizer import PreprocessorDirective
+from sourcetext import first_source_line
+
+class AnalysisLimitsDiagnostic(BaseMultilineDiagnostic):
+    wcode = DiagCodes.analysis_limits
+    def __init__(self, lineno, first_line, description, *params):
+        # Also given for a whole file, which may have no directives at all
+        self.lineno = lineno
+        self.first_line = first_line
+        self.description = description
+        self.params = params
+
+class AnalysisLimits:
+    "Limits given in options, 0 disables a limit"
+    def __init__(self, opts):
+        self.file_size = opts.max_file_size
+        self.directive_length = opts.max_directive_length
+        self.continuation_lines = opts.max_continuation_lines
+        self.file_time = opts.file_time_budget
+
+def truncated_lines(multi_lines, max_lines, max_length):
+    """Return the leading lines of a directive within the limits, 0 is no
+       limit. A first line alone over max_length is cut"""
+    if max_lines > 0:
+        multi_lines = multi_lines[:max_lines]
+    if max_length <= 0:
+        return multi_lines
+    res = list()
+    length = 0
+    for line in multi_lines:
+        length += len(line)
+        if length > max_length:
+            if not res:
+                res.append(line[:max_length])
+            break
+        res.append(line)
+    return res
+
+class FileBudget:
+    """Limits applied to one file, collects notes about exceeding them. size
+       is the one of the whole file if raw is only its beginning"""
+    def __init__(self, limits, raw, size=None):
+        self.limits = limits
+        self.raw = raw
+        self.size = len(raw) if size is None else size
+        self.start = time.perf_counter()
+        self.notes = list()
+        self.expired_stage = None
+
+    def note(self, lineno, first_line, description, *params):
+        self.notes.append(AnalysisLimitsDiagnostic(lineno, first_line,
+                                                   description, *params))
+
+    def too_large(self):
+        "Return True if the file must not be analyzed at all"
+        if 0 < self.limits.file_size < self.size:
+            self.note(1, first_source_line(self.raw),
+                      "File of %d bytes is larger than the limit of %d bytes,"
+                      " it is not analyzed", self.size,
+                      self.limits.file_size)
+            return True
+        return False
+
+    def truncate(self, pre_lines):
+        """Return pre_lines with directives over the limits truncated. They
+           are already extracted whole, only checks see less of them"""
+        max_lines = self.limits.continuation_lines
+        max_length = self.limits.directive_length
+        if max_lines <= 0 and max_length <= 0:
+            return pre_lines
+        res = list()
+        for directive in pre_lines:
+            if (0 < max_lines < len(directive.multi_lines)
+                    or 0 < max_length < len(directive.full_text)):
+                res.append(self.truncate_directive(directive, max_lines,
+                                                   max_length))
+            else:
+                res.append(directive)
+        return res
+
+    def truncate_directive(self, directive, max_lines, max_length):
+        lines = directive.multi_lines
+        self.note(directive.lineno, directive.first_line,
+                  "Directive of %d lines and %d characters is over the limits,"
+                  " only its beginning is analyzed", len(lines),
+                  len(directive.full_text))
+        return PreprocessorDirective(truncated_lines(lines, max_lines,
+                                                     max_length),
+                                     directive.lineno, directive.context)
+
+    def expired(self, stage):
+        """Return True if the time of the file is over, so that stage and
+           all later ones must be skipped"""
+        if self.expired_stage is not None:
+            return True
+        elapsed = time.perf_counter() - self.start
+        if 0 < self.limits.file_time < elapsed:
+            self.expired_stage = stage
+            self.note(1, first_source_line(self.raw),
+                      "Analysis took %.1f s, more than the limit of %g s,"
+                      " %s and later checks are skipped", elapsed,
+                      self.limits.file_time, stage)
+            return True
+        return False
@@ -0,0 +1,77 @@
+# Tree-wide index of identifiers used in analysed files
+
+import re
+
+from keywords import DEFINE, UNDEF
+from diagcodes import DiagCodes
+from multichecks import BaseMultilineDiagnostic
+from rolling import Context
+
+identifier_re = re.compile(r"\b[A-Za-z_]\w*", re.ASCII)
+
+class IdentifierIndex:
+    """Inverted index mapping identifiers to names of files referencing them,
+       plus the list of all macro definitions met.
+       Indexes built for separate files or by separate workers are combined
+       with merge()"""
+    def __init__(self):
+        self.references = dict() # identifier -> set of file names
+        self.definitions = list() # (file name, macro name, directive)
+
+    def add_identifiers(self, file_name, identifiers):
+        references = self.references
+        for identifier in identifiers:
+            files = references.get(identifier)
+            if files is None:
+                references[identifier] = set((file_name,))
+            else:
+                files.add(file_name)
+
+    def add_code(self, file_name, fragments):
+        # fragments are pieces of text outside of comments and strings
+        for fragment in fragments:
+            self.add_identifiers(file_name,
+                                 set(identifier_re.findall(fragment)))
+
+    def add_directive(self, file_name, directive, fragments):
+        identifiers = list()
+        for fragment in fragments:
+            identifiers += identifier_re.findall(fragment)
+        hashword = directive.hashword
+        if (hashword in (DEFINE, UNDEF) and len(directive.tokens) > 1
+                and directive.context == Context.OUTSIDE):
+            # The macro name itself is not a reference to it
+            name = directive.tokens[1]
+            if name in identifiers:
+                identifiers.remove(name)
+            if hashword == DEFINE:
+                self.definitions.append((file_name, name, directive))
+        self.add_identifiers(file_name, set(identifiers))
+
+    def merge(self, other):
+        for (identifier, files) in other.references.items():
+            mine = self.references.get(identifier)
+            if mine is None:
+                self.references[identifier] = set(files)
+            else:
+                mine.update(files)
+        self.definitions += other.definitions
+
+    def unused_definitions(self):
+        return list(definition for definition in self.definitions
+                    if definition[1] not in self.references)
+
+class UnusedMacroDiagnostic(BaseMultilineDiagnostic):
+    wcode = DiagCodes.unused_macro
+
+def run_tree_checks(identifier_index, enabled_wcodes):
+    """Return a list of (file name, diagnostic) for checks that need to see
+       all files at once"""
+    res = list()
+    if UnusedMacroDiagnostic.wcode not in enabled_wcodes:
+        return res
+    for (file_name, name, directive) in identifier_index.unused_definitions():
+        description = "Macro %s is not used in any of analysed files"
+        res.append((file_name, UnusedMacroDiagnostic(directive, description,
+                                                     name)))
+    return res
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# Memory benchmark of the analysis pipeline on synthetic large inputs
+#
+# Every stage of analysis of a file is run under tracemalloc, and its peak
+# and retained allocations are compared with budgets given as multiples of
+# the input size. A stage making a whole-file copy or leaving garbage per
+# line goes over its budget long before it shows in speed benchmarks.
+#
+#   python3 membench.py [--lines N] [--input NAME] [--check]
+
+import os
+import sys
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+from diagcodes import all_wcodes
+from sourcetext import read_source, split_source_lines, OutputDecoder
+from sourcetext import read_source_lines
+from tokenizer import PreprocessorDirective, extract_directives
+from tokenizer import tokenize_directive, directive_hashword
+from columns import DirectiveColumns
+from simple import run_simple_checks
+from multichecks import run_complex_checks
+
+def directives_input(line_count):
+    "Typical header: guards, constants, function-like macros and code"
+    pieces = ["#ifndef BIG_H\n#define BIG_H\n"]
+    count = 2
+    i = 0
+    while count < line_count - 1:
+        pieces.append("#ifdef FEATURE_%d\n"
+                      "#define CONST_%d %d\n"
+                      "#define MAX_%d(a, b) ((a) > (b) ? (a) : (b))\n"
+                      "#include <header_%d.h>\n"
+                      "int function_%d(int x) { return x * %d; }\n"
+                      "#endif\n" % (i % 50, i, i, i, i % 20, i, i))
+        count += 6
+        i += 1
+    pieces.append("#endif\n")
+    return "".join(pieces).encode("ascii")
+
+def comments_input(line_count):
+    "Mostly comments and strings, where the context tracker does all work"
+    pieces = list()
+    count = 0
+    i = 0
+    while count < line_count:
+        pieces.append("/* Block comment %d\n"
+                      " * with # hashes and \"quotes\" inside\n"
+                      " */\n"
+                      "const char *s_%d = \"// not a comment /* either\";\n"
+                      "// #define COMMENTED_OUT %d\n"
+                      "#define VISIBLE_%d 1\n" % (i, i, i, i))
+        count += 6
+        i += 1
+    return "".join(pieces).encode("ascii")
+
+def continued_input(line_count):
+    "Long multi-line definitions"
+    body_lines = 40
+    pieces = list()
+    count = 0
+    i = 0
+    while count < line_count:
+        pieces.append("#define LONG_%d(x) \\\n" % i)
+        for k in range(body_lines):
+            pieces.append("    do_something_%d(x, %d); \\\n" % (k, i))
+        pieces.append("    finish(x)\n")
+        count += body_lines + 2
+        i += 1
+    return "".join(pieces).encode("ascii")
+
+synthetic_inputs = {
+    "directives": directives_input,
+    "comments": comments_input,
+    "continued": continued_input,
+}
+
+stages = ("read", "split", "extract", "directives", "columns", "simple",
+          "complex", "output")
+
+# (peak, retained) allocations of a stage, as multiples of the input size.
+# Stages not listed for an input are not limited
+budgets = {
+    "directives": {
+        "read": (1.2, 1.1),
+        "split": (8.0, 3.6),
+        "extract": (13.2, 13.2),
+        "directives": (9.3, 9.3),
+        "columns": (0.7, 0.7),
+        "simple": (1.9, 1.9),
+        "complex": (0.1, 0.05),
+        "output": (0.1, 0.05),
+    },
+    "comments": {
+        "read": (1.2, 1.1),
+        "split": (8.0, 3.6),
+        "extract": (3.6, 3.6),
+        "directives": (2.7, 2.7),
+        "columns": (0.15, 0.15),
+        "simple": (1.2, 1.2),
+        "complex": (0.05, 0.05),
+        "output": (0.1, 0.05),
+    },
+    "continued": {
+        "read": (1.2, 1.1),
+        "split": (8.0, 3.6),
+        "extract": (4.0, 4.0),
+        "directives": (3.6, 3.6),
+        "columns": (0.05, 0.05),
+        "simple": (0.6, 0.6),
+        "complex": (0.05, 0.05),
+        "output": (0.1, 0.05),
+    },
+}
+# Allowed on top of budgets, covers fixed costs on small inputs
+BUDGET_SLACK = 64 << 10
+
+class StageMemory:
+    "Allocations of a stage in bytes"
+    def __init__(self, name, peak, retained):
+        self.name = name
+        self.peak = peak
+        self.retained = retained
+
+class StageTracker:
+    "Measures stages one after another, see stage()"
+    def __init__(self):
+        self.results = list()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracemalloc.reset_peak()
+        (start, _) = tracemalloc.get_traced_memory()
+        yield
+        (current, peak) = tracemalloc.get_traced_memory()
+        self.results.append(StageMemory(name, max(0, peak - start),
+                                        max(0, current - start)))
+
+def measure_file(file_name, enabled_wcodes=all_wcodes):
+    """Run analysis of file_name stage by stage.
+       Return a list of StageMemory in order of stages"""
+    # Tokens interned by an untraced run stay alive until the end, so that
+    # growth of the interpreter's table of interned strings, which depends
+    # on everything run before, is not charged to the stages
+    interned = extract_directives(read_source_lines(file_name), file_name)
+    # Strings kept by caches would hide allocations
+    tokenize_directive.cache_clear()
+    directive_hashword.cache_clear()
+    tracker = StageTracker()
+    tracemalloc.start()
+    try:
+        with tracker.stage("read"):
+            raw = read_source(file_name)
+        with tracker.stage("split"):
+            lines = split_source_lines(raw)
+        with tracker.stage("extract"):
+            pre_lines = extract_directives(lines, file_name)
+        # Construction of directives alone, with the same spans and contexts
+        tokenize_directive.cache_clear()
+        del pre_lines
+        found = extract_directives(lines, file_name)
+        spans = list((d.multi_lines, d.lineno, d.context) for d in found)
+        del found
+        tokenize_directive.cache_clear()
+        with tracker.stage("directives"):
+            pre_lines = list(PreprocessorDirective(*span) for span in spans)
+        del spans
+        with tracker.stage("columns"):
+            columns = DirectiveColumns(pre_lines)
+        with tracker.stage("simple"):
+            diagnostics = run_simple_checks(columns, enabled_wcodes)
+        with tracker.stage("complex"):
+            diagnostics += run_complex_checks(columns, enabled_wcodes)
+        with tracker.stage("output"):
+            decode = OutputDecoder()
+            with open(os.devnull, "w") as sink:
+                for diag in diagnostics:
+                    print("%s:%d: W%d: %s" % (file_name, diag.lineno,
+                          diag.wcode, decode(diag.details)), file=sink)
+                    print("    %s" % decode(diag.first_line.strip('\n')),
+                          file=sink)
+    finally:
+        tracemalloc.stop()
+    del interned
+    return tracker.results
+
+def over_budget(input_name, results, input_size):
+    "Return a list of messages about stages exceeding budgets of input_name"
+    res = list()
+    for stage in results:
+        limits = budgets.get(input_name, {}).get(stage.name)
+        if limits is None:
+            continue
+        for (kind, used, ratio) in (("peak", stage.peak, limits[0]),
+                                    ("retained", stage.retained, limits[1])):
+            if used > ratio * input_size + BUDGET_SLACK:
+                res.append("%s: %s %s is %.2f of input size, budget %.2f" %
+                           (input_name, stage.name, kind, used / input_size,
+                            ratio))
+    return res
+
+def run_benchmark(input_name, line_count):
+    """Generate the synthetic input and measure it.
+       Return tuple (input size, list of StageMemory)"""
+    raw = synthetic_inputs[input_name](line_count)
+    (handle, file_name) = tempfile.mkstemp(suffix=".h")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            f.write(raw)
+        return (len(raw), measure_file(file_name))
+    finally:
+        os.remove(file_name)
+
+def print_results(input_name, input_size, results):
+    print("%s: %d bytes" % (input_name, input_size))
+    print("    %-12s %12s %12s" % ("stage", "peak", "retained"))
+    for stage in results:
+        print("    %-12s %12d %12d" % (stage.name, stage.peak, stage.retained))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=
+                                     "Measure memory used by analysis stages")
+    parser.add_argument("--lines", type=int, default=20000,
+                        help="""Number of lines of each synthetic input.
+                                Tracing slows analysis down tenfold""")
+    parser.add_argument("--input", type=str, default=None,
+                        choices=sorted(synthetic_inputs.keys()),
+                        help="Only run this input")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with error code if a budget is exceeded")
+    opts = parser.parse_args(argv[1:])
+
+    names = [opts.input] if opts.input else sorted(synthetic_inputs.keys())
+    failures = list()
+    for input_name in names:
+        (input_size, results) = run_benchmark(input_name, opts.lines)
+        print_results(input_name, input_size, results)
+        failures += over_budget(input_name, results, input_size)
+    for failure in failures:
+        print("Over budget: %s" % failure)
+    return 1 if (opts.check and failures) else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,127 @@
+# Counters of work done by a run, exported for dashboards
+#
+# Every worker counts into its own Counters and hands them over with its
+# results, the parent merges them. Nothing is shared between workers, so
+# counting needs no locks and costs a dict update per file or per check.
+
+import os
+
+from tokenizer import tokenize_directive
+
+METRIC_PREFIX = "cppsa_"
+
+# Name -> help text, in order of output
+metric_help = {
+    "files_total": "Files analyzed, not counting copies of identical files",
+    "lines_total": "Lines of analyzed files",
+    "directives_total": "Preprocessor directives of analyzed files",
+    "check_directives_examined_total":
+        "Directives examined by a diagnostic check",
+    "check_findings_total": "Diagnostics emitted by a check",
+    "whitelist_hits_total": "Diagnostics suppressed by the whitelist",
+    "baseline_hits_total": "Diagnostics suppressed by the baseline",
+    "directive_cache_hits_total": "Files whose directives were cached",
+    "directive_cache_misses_total": "Files missing in the directive cache",
+    "tokenize_cache_hits_total": "Directive texts found tokenized already",
+    "tokenize_cache_misses_total": "Directive texts tokenized",
+    "input_directives_total":
+        "Preprocessor directives of all input files, also of copies of"
+        " identical files, counted with --stats",
+    "conditional_depth_total":
+        "Conditional blocks opened at a nesting depth in all input files,"
+        " counted with --stats",
+    "define_lines_total":
+        "Definitions spanning a number of lines in all input files, counted"
+        " with --stats",
+}
+
+class Counters:
+    "Counters of one worker, keyed by metric name and labels"
+    def __init__(self):
+        self.values = dict() # (name, ((label, value), ...)) -> count
+
+    def add(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def count_check(self, check, examined, findings):
+        labels = {"check": check.__name__, "wcode": str(int(check.wcode))}
+        self.add("check_directives_examined_total", examined, **labels)
+        self.add("check_findings_total", findings, **labels)
+
+    def merge(self, other):
+        for (key, amount) in other.values.items():
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def sorted_items(self):
+        order = list(metric_help.keys())
+        return sorted(self.values.items(),
+                      key=lambda item: (order.index(item[0][0]), item[0][1]))
+
+def count_checks(counters, examined, findings):
+    """Count findings of checks. examined maps check classes to numbers of
+       directives given to them"""
+    found = dict.fromkeys(examined, 0)
+    for diag in findings:
+        found[type(diag)] = found.get(type(diag), 0) + 1
+    for (check, count) in found.items():
+        counters.count_check(check, examined.get(check, 0), count)
+
+def line_count(raw):
+    # Same as the number of lines read from raw, without splitting it
+    res = raw.count(b"\n")
+    if raw and not raw.endswith(b"\n"):
+        res += 1
+    return res
+
+class TokenizeCacheTracker:
+    """Turns cache_info() of tokenize_directive() into increments.
+       The cache is one per process, so one tracker per process is enough"""
+    def __init__(self):
+        self.last = tokenize_directive.cache_info()
+
+    def count(self, counters):
+        info = tokenize_directive.cache_info()
+        counters.add("tokenize_cache_hits_total", info.hits - self.last.hits)
+        counters.add("tokenize_cache_misses_total",
+                     info.misses - self.last.misses)
+        self.last = info
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, value)
+                             for (name, value) in labels)
+
+def prometheus_text(counters):
+    "Return counters in the text exposition format of Prometheus"
+    res = list()
+    names_done = set()
+    for ((name, labels), value) in counters.sorted_items():
+        full_name = METRIC_PREFIX + name
+        if name not in names_done:
+            names_done.add(name)
+            res.append("# HELP %s %s" % (full_name, metric_help[name]))
+            res.append("# TYPE %s counter" % full_name)
+        res.append("%s%s %d" % (full_name, format_labels(labels), value))
+    return "\n".join(res) + "\n"
+
+def json_text(counters):
+    import json
+    metrics = list({"name": METRIC_PREFIX + name, "labels": dict(labels),
+                    "value": value}
+                   for ((name, labels), value) in counters.sorted_items())
+    return json.dumps({"metrics": metrics}, indent=1) + "\n"
+
+def write_metrics(file_name, counters, metrics_format):
+    # Readers, e.g. the textfile collector of node_exporter, must never see
+    # a half written file
+    txt = (json_text(counters) if metrics_format == "json"
+           else prometheus_text(counters))
+    tmp_path = "%s.%d.tmp" % (file_name, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(txt)
+    os.replace(tmp_path, file_name)
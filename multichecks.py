@@ -1,21 +1,36 @@
 from tokenizer import PreprocessorDirective
+from columns import DirectiveColumns
 
-from keywords import is_open_directive, is_close_directive
-from keywords import DEFINE, CPLUSPLUS
-from diagcodes import DiagCodes, filter_diag_codes
-from threshold import Threshold
+from keywords import is_close_directive
+from keywords import DEFINE, CPLUSPLUS, open_codes, ENDIF_CODE, whitespace
+from diagcodes import DiagCodes, Feature, ALL_FEATURES, filter_diag_codes
+from threshold import default_thresholds
+from metrics import count_checks
 
 class BaseMultilineDiagnostic:
     wcode = 0
-    def __init__(self, directive, description):
+    needs = ALL_FEATURES # parts of directives the check reads, see Feature
+    # If set, apply_to_columns() takes the Thresholds of the file as second
+    # argument
+    uses_thresholds = False
+    def __init__(self, directive, description, *params):
+        # description is a format string for params, it is only formatted
+        # when the diagnostic is displayed
         assert isinstance(description, str)
         assert isinstance(directive, PreprocessorDirective)
         self.lineno = directive.lineno
         self.first_line = directive.first_line
-        self.details = description
+        self.description = description
+        self.params = params
+    @property
+    def details(self):
+        return self.description % self.params
     def __repr__(self):
         return "<%s W%d at %d: %s>" % (type(self).__name__,
                                       self.wcode, self.lineno, self.details)
+    @classmethod
+    def apply_to_lines(cls, pre_lines):
+        return cls.apply_to_columns(DirectiveColumns(pre_lines))
 
 def make_deep_warning(opened_if_stack):
     description = "Nesting of if-endif is too deep."
@@ -62,27 +77,38 @@ def sense_for_global_cplusplus_guard(pre_lines):
 
 class IfdefNestingDiagnostic(BaseMultilineDiagnostic):
     wcode = DiagCodes.deepnest
+    # Guards are sensed by tokens of a few directives, which are cheap
+    # to tokenize on demand
+    needs = Feature.HASHWORD
+    uses_thresholds = True
+    def __init__(self, directive, opened_if_stack):
+        super().__init__(directive, "", *opened_if_stack)
+    @property
+    def details(self):
+        return make_deep_warning(self.params)
 
     @staticmethod
-    def apply_to_lines(pre_lines):
+    def apply_to_columns(columns, thresholds=default_thresholds):
         # Complain after level has exceeded threshold until it has been reduced
         res = list()
-        max_level = Threshold.IFDEF_NESTING
+        pre_lines = columns.pre_lines
+        max_level = thresholds.IFDEF_NESTING
         max_level += 1 if sense_for_include_guard(pre_lines) else 0
         max_level += 1 if sense_for_global_cplusplus_guard(pre_lines) else 0
 
         level = 0
         opened_if_stack = [] # To track encompassing if-endif blocks
-        for directive in pre_lines:
-            lineno = directive.lineno
-            if is_open_directive(directive.hashword):
+        linenos = columns.lineno
+        for (index, code) in enumerate(columns.code):
+            if code in open_codes:
                 level += 1
                 if level > max_level:
-                    description = make_deep_warning(opened_if_stack)
-                    diagnostic = IfdefNestingDiagnostic(directive, description)
+                    directive = columns.directive(index)
+                    diagnostic = IfdefNestingDiagnostic(directive,
+                                                        opened_if_stack)
                     res.append(diagnostic)
-                opened_if_stack.append(lineno)
-            elif is_close_directive(directive.hashword):
+                opened_if_stack.append(linenos[index])
+            elif code == ENDIF_CODE:
                 level += -1
                 if len(opened_if_stack) == 0:
                     # Unbalanced #endif. Abort further processing.
@@ -92,16 +118,18 @@ class IfdefNestingDiagnostic(BaseMultilineDiagnostic):
 
 class UnbalancedEndifDiagnostic(BaseMultilineDiagnostic):
     wcode = DiagCodes.unbalanced_endif
+    needs = Feature.HASHWORD
 
     @staticmethod
-    def apply_to_lines(pre_lines):
+    def apply_to_columns(columns):
         res = list()
         depth = 0
-        for directive in pre_lines:
-            if is_open_directive(directive.hashword):
+        for (index, code) in enumerate(columns.code):
+            if code in open_codes:
                 depth += 1
-            elif is_close_directive(directive.hashword):
+            elif code == ENDIF_CODE:
                 if depth == 0:
+                    directive = columns.directive(index)
                     unbalanced_endif = UnbalancedEndifDiagnostic(directive,
                                         "Unbalanced closing directive found")
                     res.append(unbalanced_endif)
@@ -111,22 +139,23 @@ class UnbalancedEndifDiagnostic(BaseMultilineDiagnostic):
 
 class UnbalancedIfDiagnostic(BaseMultilineDiagnostic):
     wcode = DiagCodes.unbalanced_if
+    needs = Feature.HASHWORD
 
     @staticmethod
-    def apply_to_lines(pre_lines):
+    def apply_to_columns(columns):
         res = list()
         opened_if_stack = []
-        for directive in pre_lines:
-            if is_open_directive(directive.hashword):
-                opened_if_stack.append(directive)
-            elif is_close_directive(directive.hashword):
+        for (index, code) in enumerate(columns.code):
+            if code in open_codes:
+                opened_if_stack.append(index)
+            elif code == ENDIF_CODE:
                 if len(opened_if_stack) == 0:
                     # endifs are unbalanced, bail out
                     break
                 opened_if_stack.pop()
 
         while len(opened_if_stack) > 0:
-            directive = opened_if_stack.pop()
+            directive = columns.directive(opened_if_stack.pop())
             unbalanced_if = UnbalancedIfDiagnostic(directive,
                                         "Unbalanced opening directive found")
             res.append(unbalanced_if)
@@ -134,31 +163,37 @@ class UnbalancedIfDiagnostic(BaseMultilineDiagnostic):
 
 class UnmarkedEndifDiagnostic(BaseMultilineDiagnostic):
     wcode = DiagCodes.unmarked_endif
+    needs = Feature.HASHWORD # and tokens of distant #endif only
+    uses_thresholds = True
 
     @staticmethod
-    def apply_to_lines(pre_lines):
+    def apply_to_columns(columns, thresholds=default_thresholds):
         # Check that
             #if COND
             # has matching comment at endif:
             #endif // COND
         # or similar
-        max_distance = Threshold.MAX_IFDEF_ENDIF_DISTANCE
+        max_distance = thresholds.MAX_IFDEF_ENDIF_DISTANCE
         res = list()
         opened_if_stack = []
-        for directive in pre_lines:
-            lineno = directive.lineno
-            if is_open_directive(directive.hashword):
-                opened_if_stack.append((lineno, directive))
-            elif is_close_directive(directive.hashword):
+        linenos = columns.lineno
+        for (index, code) in enumerate(columns.code):
+            lineno = linenos[index]
+            if code in open_codes:
+                opened_if_stack.append(index)
+            elif code == ENDIF_CODE:
                 if len(opened_if_stack) == 0:
                     # unbalanced #endif. Abort further processing.
                     break
-                (start_lineno, start_directive) = opened_if_stack.pop()
-                start_text = start_directive.first_line.strip()
+                start_index = opened_if_stack.pop()
+                start_lineno = linenos[start_index]
                 scope_distance = lineno - start_lineno
                 assert scope_distance > 0
                 if scope_distance <= max_distance:
                     continue # Close lines are visible, no need to warn about
+                directive = columns.directive(index)
+                start_text = columns.directive(start_index).first_line
+                start_text = start_text.strip(whitespace)
                 endif_tokens = directive.tokens
                 # Ideally, we need to check if the text of the comment
                 # matched the #if condition, but given it is a freeform text,
@@ -168,24 +203,32 @@ class UnmarkedEndifDiagnostic(BaseMultilineDiagnostic):
                 #      it can be easily checked
                 if len(endif_tokens) < 2: # #endif plus at least something
                     description = ("No trailing comment to match opening" +
-                            " directive '%s' at line %d (%d lines apart)" %
-                            (start_text, start_lineno, scope_distance))
-                    unmarked_w = UnmarkedEndifDiagnostic(directive, description)
+                            " directive '%s' at line %d (%d lines apart)")
+                    unmarked_w = UnmarkedEndifDiagnostic(directive, description,
+                                    start_text, start_lineno, scope_distance)
                     res.append(unmarked_w)
         return res
 
 
-def run_complex_checks(pre_lines, enabled_wcodes):
-    all_diagnostics = (
+complex_diagnostics = (
                         IfdefNestingDiagnostic,
                         UnbalancedEndifDiagnostic,
                         UnbalancedIfDiagnostic,
                         UnmarkedEndifDiagnostic,
-    )
+)
 
-    enabled_diagnostics = filter_diag_codes(all_diagnostics, enabled_wcodes)
+def run_complex_checks(columns, enabled_wcodes, counters=None,
+                       checks=complex_diagnostics,
+                       thresholds=default_thresholds):
+    enabled_diagnostics = filter_diag_codes(checks, enabled_wcodes)
 
     res = list()
     for dia_class in enabled_diagnostics:
-        res += dia_class.apply_to_lines(pre_lines)
+        if dia_class.uses_thresholds:
+            res += dia_class.apply_to_columns(columns, thresholds)
+        else:
+            res += dia_class.apply_to_columns(columns)
+    if counters is not None:
+        count_checks(counters, dict.fromkeys(enabled_diagnostics,
+                                             len(columns)), res)
     return res
@@ -0,0 +1,379 @@
+# Evaluation of conditional blocks for many build configurations at once
+#
+# A configuration is a set of -D macros. A subset of configurations is stored
+# as a packed bitset (a Python integer) with one bit per configuration, so that
+# a single pass over a file evaluates every #if for all of them together.
+# Included files are not followed: macros come only from configurations and
+# from #define/#undef directives of the file itself.
+
+import re
+import operator
+
+from keywords import IF, IFDEF, IFNDEF, ELIF, ELSE, ENDIF, DEFINE, UNDEF
+from keywords import whitespace
+from diagcodes import DiagCodes, filter_diag_codes
+from multichecks import BaseMultilineDiagnostic, sense_for_include_guard
+from rolling import Context
+from metrics import count_checks
+
+class UnknownCondition(Exception):
+    "Condition cannot be evaluated for all configurations"
+
+def parse_integer(txt):
+    # Accepts C literals like 10, 0x1f, 10UL; returns None for anything else
+    match = re.match(r"^(0[xX][0-9a-fA-F]+|\d+)[uUlL]*$", txt)
+    if match is None:
+        return None
+    literal = match.group(1)
+    if len(literal) > 1 and literal[0] == "0" and literal[1] not in "xX":
+        return int(literal, 8)
+    return int(literal, 0)
+
+def parse_macro_spec(spec):
+    # One of "-DNAME", "NAME", "-DNAME=VALUE", "NAME=VALUE"
+    # Return tuple (name, value); value is None if it is not an integer
+    if spec.startswith("-D"):
+        spec = spec[2:]
+    (name, sep, value) = spec.partition("=")
+    if not sep:
+        return (name, 1)
+    return (name, parse_integer(value))
+
+def read_configs(file_name):
+    """Return a list of configurations, one per non-empty line of the file.
+       Each configuration is a dict mapping macro names to their values"""
+    res = list()
+    with open(file_name) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line[0] == "#":
+                continue
+            config = dict()
+            for spec in line.split():
+                (name, value) = parse_macro_spec(spec)
+                config[name] = value
+            res.append(config)
+    return res
+
+class ConfigSet:
+    "Values of macros across all configurations, as value -> bitset maps"
+    def __init__(self, configs):
+        self.count = len(configs)
+        self.all_mask = (1 << self.count) - 1
+        self.macros = dict()
+        self.uncertain = set() # macros (re)defined in undecidable blocks
+        for (bit, config) in enumerate(configs):
+            for (name, value) in config.items():
+                self.define(name, value, 1 << bit)
+
+    def copy(self):
+        res = ConfigSet([])
+        res.count = self.count
+        res.all_mask = self.all_mask
+        res.macros = dict((name, dict(groups))
+                          for (name, groups) in self.macros.items())
+        res.uncertain = set(self.uncertain)
+        return res
+
+    def define(self, name, value, mask):
+        self.undefine(name, mask)
+        if mask == 0:
+            # Defined in no configuration, e.g. inside #if 0
+            return
+        groups = self.macros.setdefault(name, dict())
+        groups[value] = groups.get(value, 0) | mask
+
+    def undefine(self, name, mask):
+        groups = self.macros.get(name)
+        if groups is None:
+            return
+        for value in list(groups.keys()):
+            groups[value] &= ~mask
+            if groups[value] == 0:
+                del groups[value]
+
+    def defined_mask(self, name):
+        if name in self.uncertain:
+            raise UnknownCondition(name)
+        res = 0
+        for mask in self.macros.get(name, {}).values():
+            res |= mask
+        return res
+
+    def value_groups(self, name):
+        # Undefined macros are evaluated as 0 by #if
+        undefined = self.all_mask & ~self.defined_mask(name)
+        res = dict(self.macros.get(name, {}))
+        if undefined:
+            res[0] = res.get(0, 0) | undefined
+        return res
+
+# Values of an expression are kept as {value: bitset of configurations}
+def bool_groups(mask, all_mask):
+    res = dict()
+    if mask:
+        res[1] = mask
+    if all_mask & ~mask:
+        res[0] = all_mask & ~mask
+    return res
+
+def truth_mask(groups):
+    res = 0
+    for (value, mask) in groups.items():
+        if mask == 0:
+            continue
+        if value is None:
+            raise UnknownCondition("non-numeric value")
+        if value != 0:
+            res |= mask
+    return res
+
+def combine_groups(left, right, op):
+    res = dict()
+    for (lvalue, lmask) in left.items():
+        for (rvalue, rmask) in right.items():
+            mask = lmask & rmask
+            if mask == 0:
+                continue
+            if lvalue is None or rvalue is None:
+                raise UnknownCondition("non-numeric value")
+            value = int(bool(op(lvalue, rvalue)))
+            res[value] = res.get(value, 0) | mask
+    return res
+
+comparisons = {
+        "==": operator.eq,
+        "!=": operator.ne,
+        "<": operator.lt,
+        ">": operator.gt,
+        "<=": operator.le,
+        ">=": operator.ge,
+}
+
+expr_token_re = re.compile(
+    r"\s*((?:0[xX][0-9a-fA-F]+|\d+)[uUlL]*|[A-Za-z_]\w*|&&|\|\||[=!<>]=|[()!<>])",
+    re.ASCII)
+
+def lex_condition(txt):
+    res = list()
+    pos = 0
+    txt = txt.rstrip(whitespace)
+    while pos < len(txt):
+        match = expr_token_re.match(txt, pos)
+        if match is None:
+            raise UnknownCondition("unsupported syntax in '%s'" % txt)
+        res.append(match.group(1))
+        pos = match.end()
+    return res
+
+class ConditionEvaluator:
+    """Recursive descent evaluator of #if expressions supporting defined,
+       !, &&, ||, comparisons, integer literals and macro names"""
+    def __init__(self, tokens, config_set):
+        self.tokens = tokens
+        self.pos = 0
+        self.configs = config_set
+
+    def evaluate(self):
+        res = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise UnknownCondition("trailing tokens")
+        return truth_mask(res)
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise UnknownCondition("unexpected end of expression")
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        res = self.parse_and()
+        while self.peek() == "||":
+            self.take()
+            res = combine_groups(res, self.parse_and(),
+                                 lambda a, b: a != 0 or b != 0)
+        return res
+
+    def parse_and(self):
+        res = self.parse_comparison()
+        while self.peek() == "&&":
+            self.take()
+            res = combine_groups(res, self.parse_comparison(),
+                                 lambda a, b: a != 0 and b != 0)
+        return res
+
+    def parse_comparison(self):
+        res = self.parse_unary()
+        while self.peek() in comparisons:
+            op = comparisons[self.take()]
+            res = combine_groups(res, self.parse_unary(), op)
+        return res
+
+    def parse_unary(self):
+        token = self.take()
+        all_mask = self.configs.all_mask
+        if token == "!":
+            return bool_groups(all_mask & ~truth_mask(self.parse_unary()),
+                               all_mask)
+        if token == "(":
+            res = self.parse_or()
+            if self.take() != ")":
+                raise UnknownCondition("unbalanced brackets")
+            return res
+        if token == "defined":
+            bracketed = self.peek() == "("
+            if bracketed:
+                self.take()
+            name = self.take()
+            if bracketed and self.take() != ")":
+                raise UnknownCondition("unbalanced brackets")
+            return bool_groups(self.configs.defined_mask(name), all_mask)
+        if token[0].isdigit():
+            return {parse_integer(token): all_mask}
+        if token[0].isalpha() or token[0] == "_":
+            return self.configs.value_groups(token)
+        raise UnknownCondition("unexpected token '%s'" % token)
+
+def condition_text(directive):
+    # Text following the hashword, without a trailing comment
+    txt = directive.full_text.strip(whitespace)[1:].lstrip(whitespace)
+    txt = re.sub(r"^\w+", "", txt, flags=re.ASCII)
+    for comment in ("//", "/*"):
+        pos = txt.find(comment)
+        if pos != -1:
+            txt = txt[:pos]
+    return txt
+
+def condition_mask(directive, config_set):
+    hashword = directive.hashword
+    tokens = lex_condition(condition_text(directive))
+    if hashword in (IFDEF, IFNDEF):
+        if len(tokens) != 1:
+            raise UnknownCondition("expected a single macro name")
+        mask = config_set.defined_mask(tokens[0])
+        if hashword == IFNDEF:
+            mask = config_set.all_mask & ~mask
+        return mask
+    return ConditionEvaluator(tokens, config_set).evaluate()
+
+def macro_definition(directive):
+    # Return tuple (name, value) for #define, value is None when not an integer
+    tokens = directive.tokens_without_comment()
+    if len(tokens) < 2:
+        return (None, None)
+    name = tokens[1]
+    if len(tokens) == 3:
+        return (name, parse_integer(tokens[2]))
+    return (name, None)
+
+class BranchFrame:
+    "One #if-#elif-#else-#endif chain being evaluated"
+    def __init__(self, enclosing, enclosing_unknown):
+        self.enclosing = enclosing # configurations reaching the chain
+        self.enclosing_unknown = enclosing_unknown
+        self.taken = 0 # configurations which took an earlier branch
+        self.unknown = enclosing_unknown
+
+def branch_masks(pre_lines, config_set):
+    """Walk conditional directives once for all configurations.
+       Return a list of (directive, reaching_mask, active_mask) for every branch
+       whose condition could be evaluated and which is not nested into dead
+       code. config_set is modified by
+       #define and #undef directives met on the way"""
+    res = list()
+    stack = list()
+    active = config_set.all_mask
+    unknown = False
+    for directive in pre_lines:
+        if directive.context != Context.OUTSIDE:
+            continue
+        hashword = directive.hashword
+        if hashword in (IF, IFDEF, IFNDEF):
+            stack.append(BranchFrame(active, unknown))
+        elif hashword in (ELIF, ELSE):
+            if len(stack) == 0:
+                continue # unbalanced, reported by other diagnostics
+        elif hashword == ENDIF:
+            if len(stack) == 0:
+                continue
+            frame = stack.pop()
+            (active, unknown) = (frame.enclosing, frame.enclosing_unknown)
+            continue
+        elif hashword in (DEFINE, UNDEF):
+            (name, value) = macro_definition(directive)
+            if name is None:
+                continue
+            if unknown:
+                config_set.uncertain.add(name)
+            elif hashword == DEFINE:
+                config_set.define(name, value, active)
+            else:
+                config_set.undefine(name, active)
+            continue
+        else:
+            continue
+
+        # Entering a new branch of the topmost chain
+        frame = stack[-1]
+        if not frame.unknown:
+            try:
+                if hashword == ELSE:
+                    cond = config_set.all_mask
+                else:
+                    cond = condition_mask(directive, config_set)
+            except UnknownCondition:
+                frame.unknown = True
+        if frame.unknown:
+            (active, unknown) = (0, True)
+            continue
+        reaching = frame.enclosing & ~frame.taken
+        active = reaching & cond
+        frame.taken |= active
+        unknown = False
+        if frame.enclosing:
+            # Blocks nested into dead code are not reported on their own
+            res.append((directive, reaching, active))
+    return res
+
+class NeverActiveBlockDiagnostic(BaseMultilineDiagnostic):
+    wcode = DiagCodes.never_active_in_configs
+
+class AlwaysActiveBlockDiagnostic(BaseMultilineDiagnostic):
+    wcode = DiagCodes.always_active_in_configs
+
+config_diagnostics = (NeverActiveBlockDiagnostic, AlwaysActiveBlockDiagnostic)
+
+def run_config_checks(pre_lines, enabled_wcodes, config_set, counters=None):
+    enabled_diagnostics = filter_diag_codes(config_diagnostics, enabled_wcodes)
+    if not enabled_diagnostics or config_set.count == 0:
+        return list()
+
+    # An include guard is always active by design
+    guard = pre_lines[0] if sense_for_include_guard(pre_lines) else None
+    res = list()
+    for (directive, reaching, active) in branch_masks(pre_lines,
+                                                      config_set.copy()):
+        if directive is guard:
+            continue
+        if active == 0 and NeverActiveBlockDiagnostic in enabled_diagnostics:
+            if reaching == 0:
+                description = ("Block is unreachable: preceding branches are"
+                               " taken in all %d configurations")
+            else:
+                description = ("Block is not active in any of %d"
+                               " configurations")
+            res.append(NeverActiveBlockDiagnostic(directive, description,
+                                                  config_set.count))
+        elif (active == reaching and directive.hashword != ELSE
+                and AlwaysActiveBlockDiagnostic in enabled_diagnostics):
+            description = "Block is active in all %d configurations"
+            res.append(AlwaysActiveBlockDiagnostic(directive, description,
+                                                   config_set.count))
+    if counters is not None:
+        count_checks(counters, dict.fromkeys(enabled_diagnostics,
+                                             len(pre_lines)), res)
+    return res
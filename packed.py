@@ -0,0 +1,117 @@
+# Compact form of diagnostics sent back by worker processes
+#
+# A pickled diagnostic object carries its class, attribute names and a copy
+# of the source line. A batch instead keeps five integers per diagnostic and
+# shares format strings and classes between all of them. The source line is
+# not sent at all: it is the line at lineno of the contents the parent has
+# passed to the worker. The parent keeps only lines with diagnostics, not
+# the whole contents.
+
+from array import array
+
+from sourcetext import split_source_lines
+
+RECORD_SIZE = 5
+
+class DiagnosticBatch:
+    "Diagnostics of one file packed by a worker"
+    def __init__(self, diagnostics):
+        self.classes = list()
+        self.strings = list()
+        self.params = list()
+        # (class index, line number, description index or 0, params count,
+        #  block index or 0), see add_block_contexts()
+        self.records = array('I')
+        class_index = dict()
+        string_index = dict()
+        for diag in diagnostics:
+            cls = type(diag)
+            if cls not in class_index:
+                class_index[cls] = len(self.classes)
+                self.classes.append(cls)
+            refs = list()
+            for string in (getattr(diag, "description", None),
+                           getattr(diag, "block", None)):
+                if string is None:
+                    refs.append(0)
+                    continue
+                if string not in string_index:
+                    self.strings.append(string)
+                    string_index[string] = len(self.strings)
+                refs.append(string_index[string])
+            self.records.extend((class_index[cls], diag.lineno, refs[0],
+                                 len(diag.params), refs[1]))
+            self.params += diag.params
+
+    def __len__(self):
+        return len(self.records) // RECORD_SIZE
+
+    def unpack(self, raw):
+        """Return a list of diagnostics found in raw contents of the file.
+           Their text is only formatted when asked for, raw is not kept"""
+        res = list()
+        records = self.records
+        source = referenced_lines(raw, set(records[pos + 1] for pos
+                                           in range(0, len(records),
+                                                    RECORD_SIZE)))
+        params_pos = 0
+        for pos in range(0, len(records), RECORD_SIZE):
+            params_end = params_pos + records[pos + 3]
+            res.append(PackedDiagnostic(self, source, pos, params_pos,
+                                        params_end))
+            params_pos = params_end
+        return res
+
+def referenced_lines(raw, linenos):
+    "Return a dict mapping each of linenos to its line in raw contents"
+    if not linenos:
+        return dict()
+    lines = split_source_lines(raw)
+    return dict((lineno, lines[lineno - 1]) for lineno in linenos)
+
+class PackedDiagnostic:
+    "Diagnostic restored from a batch, see DiagnosticBatch.unpack()"
+    __slots__ = ("batch", "source", "pos", "params_pos", "params_end")
+
+    def __init__(self, batch, source, pos, params_pos, params_end):
+        self.batch = batch
+        self.source = source
+        self.pos = pos
+        self.params_pos = params_pos
+        self.params_end = params_end
+
+    @property
+    def diagnostic_class(self):
+        return self.batch.classes[self.batch.records[self.pos]]
+
+    @property
+    def wcode(self):
+        return self.diagnostic_class.wcode
+
+    @property
+    def lineno(self):
+        return self.batch.records[self.pos + 1]
+
+    @property
+    def first_line(self):
+        return self.source[self.lineno]
+
+    @property
+    def block(self):
+        block_ref = self.batch.records[self.pos + 4]
+        return self.batch.strings[block_ref - 1] if block_ref != 0 else ""
+
+    @property
+    def details(self):
+        # Format with the original class, without running its constructor
+        cls = self.diagnostic_class
+        diag = cls.__new__(cls)
+        description_ref = self.batch.records[self.pos + 2]
+        if description_ref != 0:
+            diag.description = self.batch.strings[description_ref - 1]
+        diag.params = tuple(self.batch.params[self.params_pos:self.params_end])
+        return diag.details
+
+    def __repr__(self):
+        return "<%s W%d at %d: %s>" % (self.diagnostic_class.__name__,
+                                      self.wcode, self.lineno, self.details)
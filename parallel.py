@@ -0,0 +1,78 @@
+# Splitting of analysis work between parallel workers
+
+import sys
+
+from tokenizer import extract_directives, line_ends_with_continuation
+from rolling import Context, context_map
+from macroindex import IdentifierIndex
+from diagcodes import Feature, ALL_FEATURES
+
+def gil_enabled():
+    # sys._is_gil_enabled() only exists since Python 3.13
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return True if is_gil_enabled is None else is_gil_enabled()
+
+def executor_kind(requested):
+    """Resolve --executor into "thread" or "process". With the GIL, threads
+       would run the analysis, which is pure Python, one at a time"""
+    if requested == "auto":
+        return "process" if gil_enabled() else "thread"
+    return requested
+
+def chunk_bounds(lines, chunk_count):
+    """Split lines into at most chunk_count ranges (start, end) of similar
+       size. A range never starts right after a continued line, so that no
+       multi-line directive is cut in two"""
+    res = list()
+    chunk_size = max(1, -(-len(lines) // chunk_count))
+    start = 0
+    while start < len(lines):
+        end = min(start + chunk_size, len(lines))
+        while end < len(lines) and line_ends_with_continuation(lines[end - 1]):
+            end += 1
+        res.append((start, end))
+        start = end
+    return res
+
+def extract_chunk(lines, file_name, with_index, context, first_lineno,
+                  features):
+    # Runs in a worker
+    identifier_index = IdentifierIndex() if with_index else None
+    directives = extract_directives(lines, file_name, identifier_index,
+                                    context, first_lineno, features)
+    return (directives, identifier_index)
+
+def extract_directives_parallel(lines, file_name, identifier_index, executor,
+                                chunk_count, features=ALL_FEATURES):
+    """Same as extract_directives() for a whole file, but with chunks of
+       lines processed by executor's workers.
+       The context tracker is a state machine over four states, so the effect
+       of a chunk is a map from its start context to its end context. Maps
+       are computed for all chunks in parallel, then a prefix scan over them
+       gives the true start context of every chunk, and then directives of
+       all chunks are extracted in parallel"""
+    bounds = chunk_bounds(lines, chunk_count)
+    chunks = list(lines[start:end] for (start, end) in bounds)
+    first_linenos = list(1 + start for (start, _) in bounds)
+
+    with_index = identifier_index is not None
+    start_contexts = list()
+    if Feature.CONTEXT in features or with_index:
+        maps = list(executor.map(context_map, chunks))
+        context = Context.OUTSIDE
+        for chunk_map in maps:
+            start_contexts.append(context)
+            context = chunk_map[context]
+    else:
+        start_contexts = [Context.OUTSIDE] * len(chunks)
+
+    results = executor.map(extract_chunk, chunks,
+                           [file_name] * len(chunks), [with_index] * len(chunks),
+                           start_contexts, first_linenos,
+                           [features] * len(chunks))
+    res = list()
+    for (directives, chunk_index) in results:
+        res += directives
+        if with_index:
+            identifier_index.merge(chunk_index)
+    return res
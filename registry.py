@@ -0,0 +1,132 @@
+# Registry of checks: their codes and where their classes are found
+#
+# Checks are subclasses of BaseDiagnostic, applied to each directive, or of
+# BaseMultilineDiagnostic with apply_to_columns(), applied to whole files.
+# Built-in ones are listed below, checks of other packages come from a
+# plugin file or from entry points of the "cppsa.checks" group, both naming
+# a code and "module:Class". Codes are known without importing anything, a
+# module of checks is only imported when one of its codes is enabled.
+#
+# Checks of build configurations, of the whole tree and of analysis limits
+# need state of the run and are run by their own stages, they only have
+# their codes here.
+
+import importlib
+import functools
+
+from diagcodes import DiagCodes, all_wcodes
+
+PLUGIN_GROUP = "cppsa.checks"
+
+# Modules of built-in checks: (module, tuple of its checks, their codes).
+# The codes are listed here so that no module is imported to learn them,
+# utest checks that they agree with the checks of each module
+builtin_modules = (
+    ("simple", "simple_diagnostics",
+     (DiagCodes.unknown, DiagCodes.multiline, DiagCodes.whitespace,
+      DiagCodes.complex_if_condition, DiagCodes.space_after_leading,
+      DiagCodes.suggest_inline_function, DiagCodes.if_0_dead_code,
+      DiagCodes.if_always_true, DiagCodes.suggest_void_function,
+      DiagCodes.suggest_const, DiagCodes.too_long_define,
+      DiagCodes.multiline_conditional, DiagCodes.wrong_context)),
+    ("multichecks", "complex_diagnostics",
+     (DiagCodes.deepnest, DiagCodes.unbalanced_if, DiagCodes.unmarked_endif,
+      DiagCodes.unbalanced_endif)),
+)
+
+class PluginError(Exception):
+    pass
+
+def parse_plugin_spec(code, target):
+    """Return (wcode, module, class name) of a plugin given as "W<code>" or
+       "<code>" and "module:Class" """
+    undecorated = code[1:] if code.startswith("W") else code
+    (module, sep, name) = target.partition(":")
+    if not undecorated.isdigit() or int(undecorated) == 0:
+        raise PluginError("invalid code '%s' of plugin %s" % (code, target))
+    if not sep or not module or not name:
+        raise PluginError("plugin %s is not given as module:Class" % target)
+    return (int(undecorated), module.strip(), name.strip())
+
+def read_plugin_file(file_name):
+    "Return a list of (wcode, module, class name) of a plugin file"
+    res = list()
+    with open(file_name) as f:
+        for line in f:
+            tokens = line.split("#", 1)[0].split()
+            if not tokens:
+                continue
+            if len(tokens) != 2:
+                raise PluginError("%s: expected 'W<code> module:Class',"
+                                  " got '%s'" % (file_name, line.strip()))
+            res.append(parse_plugin_spec(*tokens))
+    return res
+
+@functools.cache
+def entry_point_plugins():
+    "Return a tuple of (wcode, module, class name) of installed plugins"
+    # Not imported at startup: scanning installed distributions takes
+    # longer than analyzing a file
+    metadata = importlib.import_module("importlib.metadata")
+    return tuple(parse_plugin_spec(entry.name, entry.value)
+                 for entry in metadata.entry_points(group=PLUGIN_GROUP))
+
+class CheckRegistry:
+    "Codes of all known checks, see load() for getting the checks"
+    def __init__(self, plugin_file=None, entry_points=False):
+        self.plugins = list()
+        if plugin_file is not None:
+            self.plugins += read_plugin_file(plugin_file)
+        if entry_points:
+            self.plugins += entry_point_plugins()
+        wcodes = set(all_wcodes)
+        for (wcode, module, name) in self.plugins:
+            if wcode in wcodes:
+                raise PluginError("code W%d of plugin %s:%s is already used"
+                                  % (wcode, module, name))
+            wcodes.add(wcode)
+        self.wcodes = frozenset(wcodes)
+
+    def load(self, enabled_wcodes):
+        """Return a tuple (directive_checks, file_checks, run_directive_checks,
+           run_file_checks) of classes of enabled checks, in a stable order,
+           and the functions running them, None if there are no such checks.
+           Only their modules are imported"""
+        checks = list()
+        for (module, attr, wcodes) in builtin_modules:
+            if any(wcode in enabled_wcodes for wcode in wcodes):
+                checks += getattr(importlib.import_module(module), attr)
+        for (wcode, module, name) in self.plugins:
+            if wcode in enabled_wcodes:
+                checks.append(load_plugin(wcode, module, name))
+        directive_checks = list()
+        file_checks = list()
+        for check in checks:
+            if check.wcode not in enabled_wcodes:
+                continue
+            if hasattr(check, "apply_to_columns"):
+                file_checks.append(check)
+            else:
+                directive_checks.append(check)
+        run_directive_checks = None
+        if directive_checks:
+            run_directive_checks = importlib.import_module(
+                "simple").run_simple_checks
+        run_file_checks = None
+        if file_checks:
+            run_file_checks = importlib.import_module(
+                "multichecks").run_complex_checks
+        return (tuple(directive_checks), tuple(file_checks),
+                run_directive_checks, run_file_checks)
+
+def load_plugin(wcode, module, name):
+    check = getattr(importlib.import_module(module), name, None)
+    if check is None:
+        raise PluginError("module %s has no check %s" % (module, name))
+    if check.wcode != wcode:
+        raise PluginError("check %s:%s has code W%d instead of W%d"
+                          % (module, name, check.wcode, wcode))
+    if not (hasattr(check, "apply") or hasattr(check, "apply_to_columns")):
+        raise PluginError("check %s:%s has neither apply() nor"
+                          " apply_to_columns()" % (module, name))
+    return check
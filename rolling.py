@@ -1,5 +1,6 @@
 # Tracking of rolling context of C-based source file
 
+import re
 from enum import Enum
 
 BACKSLASH = "\\"
@@ -11,6 +12,9 @@ class Context(Enum):
     SLASH_COMMENT = "single-line comment"
     QUOTES = "quoted string"
 
+# Small integer codes of contexts, for columns of directives
+context_codes = dict((context, code) for (code, context) in enumerate(Context))
+
 def find_next_token(line, tokens):
     # Look for the earliest match of any of tokens
     # Return tuple (token, position)
@@ -26,6 +30,18 @@ def find_next_token(line, tokens):
             min_token = token
     return (min_token, min_pos)
 
+# Same as find_next_token(line[pos:], tokens), searching from pos without
+# copying the rest of the line. No two tokens can match at one position
+token_re = re.compile("|".join(re.escape(token) for token in sorted(tokens)))
+
+def next_token(line, pos):
+    """Return tuple (token, its position) of the earliest token at pos or
+       later, or (None, _) if there is none"""
+    m = token_re.search(line, pos)
+    if m is None:
+        return (None, len(line))
+    return (m.group(), m.start())
+
 map_outside = {
         "/*": Context.COMMENT,
         "//": Context.SLASH_COMMENT,
@@ -82,15 +98,64 @@ def update_language_context(lines, old_state):
     context = old_state
     pos = 0
     while pos < len(line):
-        (next_token, delta) = find_next_token(line[pos:], tokens)
-        if next_token is None: # EOL
+        (token, token_pos) = next_token(line, pos)
+        if token is None: # EOL
             return context
-        if next_token == BACKSLASH:
+        if token == BACKSLASH:
             # Skip everything up to the backslash and one following symbol
             # XXX this does not sound too reliable
-            pos += delta + len(next_token) + 1
+            pos = token_pos + len(token) + 1
             continue
-        context = transfer(context, next_token)
-        pos += delta + len(next_token)
+        context = transfer(context, token)
+        pos = token_pos + len(token)
 
     return context
+
+def code_fragments(lines, old_state):
+    """Same as update_language_context, but also collect pieces of text lying
+       outside of comments and quoted strings.
+       Return tuple (fragments, new_state)"""
+    line = "".join(lines)
+    context = old_state
+    fragments = list()
+    start = 0
+    pos = 0
+    while pos < len(line):
+        (token, token_pos) = next_token(line, pos)
+        if token is None: # EOL
+            break
+        if token == BACKSLASH:
+            pos = token_pos + len(token) + 1
+            continue
+        new_context = transfer(context, token)
+        pos = token_pos + len(token)
+        if (context == Context.OUTSIDE and new_context != Context.OUTSIDE
+                and start < token_pos):
+            fragments.append(line[start:token_pos])
+        elif context != Context.OUTSIDE and new_context == Context.OUTSIDE:
+            start = pos
+        context = new_context
+
+    if context == Context.OUTSIDE and start < len(line):
+        fragments.append(line[start:])
+    return (fragments, context)
+
+def context_map(lines):
+    """Summarize the effect of lines on the context: return a dict mapping
+       every possible start context to the context after the lines.
+       Each line is scanned once per distinct context reached from the
+       starts so far, so this costs up to len(Context) passes. Once all
+       starts have reached the same context, the rest is scanned once"""
+    current = dict((context, context) for context in Context)
+    for (index, line) in enumerate(lines):
+        distinct = set(current.values())
+        if len(distinct) == 1:
+            (context,) = distinct
+            for line in lines[index:]:
+                context = update_language_context([line], context)
+            return dict((start, context) for start in current)
+        after = dict((context, update_language_context([line], context))
+                     for context in distinct)
+        current = dict((start, after[context])
+                       for (start, context) in current.items())
+    return current
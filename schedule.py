@@ -0,0 +1,111 @@
+# Ordering of files for parallel runs and accounting of workers' time
+#
+# Workers take files in the order they are submitted. A giant file submitted
+# last keeps one worker busy long after all others are done, so files are
+# submitted longest first: by their analysis time measured in an earlier run
+# when it is known, otherwise by size. Files are only sized when some of them
+# have no time yet, by as many threads as read them.
+
+import os
+import time
+import threading
+
+from sourcetext import source_sizes
+
+TIMINGS_VERSION = 1
+
+def schedule_order(input_files, timings, depth=0):
+    """Return input_files sorted by expected analysis time, longest first.
+       timings maps file names to seconds measured earlier. Times of other
+       files are estimated from their sizes at the rate seen for timed ones,
+       sizes are looked up by depth threads, see source_sizes()"""
+    if all(f in timings for f in input_files):
+        return sorted(input_files, key=lambda f: -timings[f])
+    sizes = source_sizes(input_files, depth)
+    timed = list(f for f in sizes if f in timings)
+    timed_size = sum(sizes[f] for f in timed)
+    if timed_size == 0:
+        # Nothing to compare sizes with, sizes alone define the order
+        expected = sizes
+    else:
+        rate = sum(timings[f] for f in timed) / timed_size
+        expected = dict((f, timings[f] if f in timings else sizes[f] * rate)
+                        for f in sizes)
+    return sorted(input_files, key=lambda f: -expected[f])
+
+class TimingCache:
+    "Analysis times of files from earlier runs, kept in the cache directory"
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, "timings.json")
+
+    def load(self):
+        import json
+        try:
+            with open(self.path, encoding="utf-8",
+                      errors="surrogateescape") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        if data.get("version") != TIMINGS_VERSION:
+            return dict()
+        return data["timings"]
+
+    def store(self, timings):
+        # Files of other runs sharing the cache are kept
+        merged = self.load()
+        import json
+        merged.update(timings)
+        # Named as entries of DirectiveCache, runs in threads of one
+        # process may share the cache
+        tmp_path = "%s.%d.%d.tmp" % (self.path, os.getpid(),
+                                     threading.get_ident())
+        try:
+            with open(tmp_path, "w", encoding="utf-8",
+                      errors="surrogateescape") as f:
+                json.dump({"version": TIMINGS_VERSION, "timings": merged}, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # Timings only order files, a run goes on without them
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+# Huge files are split into chunks from the parent, see submit_file()
+PARENT_WORKER = "parent"
+
+def worker_name():
+    return "%d/%s" % (os.getpid(), threading.current_thread().name)
+
+def timed_call(function, *args):
+    """Call function in a worker. Return tuple (worker name, seconds spent,
+       result)"""
+    start = time.perf_counter()
+    res = function(*args)
+    return (worker_name(), time.perf_counter() - start, res)
+
+class WorkerStats:
+    "Time spent by workers on tasks since the start of a parallel run"
+    def __init__(self, worker_count):
+        self.worker_count = worker_count
+        self.start = time.perf_counter()
+        self.busy = dict() # worker name -> seconds
+
+    def add(self, worker, elapsed):
+        self.busy[worker] = self.busy.get(worker, 0.0) + elapsed
+
+    def summary(self):
+        """Return a list of (worker name, busy seconds, idle seconds).
+           Workers which got no task at all are listed as "unused", time
+           of files split into chunks is listed for the parent"""
+        wall = time.perf_counter() - self.start
+        res = list((worker, busy, max(0.0, wall - busy))
+                   for (worker, busy) in sorted(self.busy.items()))
+        used = len(self.busy) - (PARENT_WORKER in self.busy)
+        for _ in range(self.worker_count - used):
+            res.append(("unused", 0.0, wall))
+        return res
+
+    def print_summary(self):
+        for (worker, busy, idle) in self.summary():
+            print("Worker %s: busy %.3f s, idle %.3f s" % (worker, busy, idle))
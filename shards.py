@@ -0,0 +1,151 @@
+# Splitting a run between several machines and merging their results
+
+import re
+
+from tokenizer import PreprocessorDirective
+from macroindex import IdentifierIndex
+from rolling import Context
+from metrics import Counters
+
+RESULT_VERSION = 3
+
+def parse_shard_spec(spec):
+    """Parse "i/N" into tuple (i, N), where shards are numbered from 1.
+       Return None for a malformed specification"""
+    match = re.match(r"^(\d+)/(\d+)$", spec)
+    if match is None:
+        return None
+    (index, count) = (int(match.group(1)), int(match.group(2)))
+    if not 1 <= index <= count:
+        return None
+    return (index, count)
+
+def shard_of(input_file, count):
+    # Stable across machines and runs, unlike hash()
+    import hashlib
+    digest = hashlib.blake2b(input_file.encode("utf-8", "surrogateescape"),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, "little") % count + 1
+
+def select_shard(input_files, index, count):
+    return list(f for f in input_files if shard_of(f, count) == index)
+
+class StoredDiagnostic:
+    "Diagnostic restored from a shard result, already formatted"
+    def __init__(self, wcode, lineno, first_line, details, block):
+        self.wcode = wcode
+        self.lineno = lineno
+        self.first_line = first_line
+        self.details = details
+        self.block = block
+    def __repr__(self):
+        return "<%s W%d at %d: %s>" % (type(self).__name__,
+                                      self.wcode, self.lineno, self.details)
+
+def write_shard_result(file_name, shard, input_files, all_diagnostics,
+                       identifier_index, enabled_wcodes, counters):
+    """Save diagnostics of the shard's files, not yet filtered against the
+       whitelist, and counters of its analysis. shard is tuple (index, count)
+       of the shard. input_files is the complete list of the run, positions
+       in it let merging restore the order of a single-node run"""
+    import json
+    position = dict((f, pos) for (pos, f) in enumerate(input_files))
+    files = list()
+    first_position = dict() # id of list of diagnostics -> its first file
+    for (input_file, diagnostics) in all_diagnostics.items():
+        if id(diagnostics) in first_position:
+            # Files with identical contents share the list of diagnostics
+            records = first_position[id(diagnostics)]
+        else:
+            first_position[id(diagnostics)] = position[input_file]
+            records = list((diag.wcode, diag.lineno, diag.first_line,
+                            diag.details, getattr(diag, "block", ""))
+                           for diag in diagnostics)
+        files.append((position[input_file], input_file, records))
+    result = {
+        "version": RESULT_VERSION,
+        "shard": list(shard),
+        "enabled_wcodes": sorted(enabled_wcodes),
+        "files": files,
+        "counters": list((name, labels, value) for ((name, labels), value)
+                         in counters.values.items()),
+    }
+    if identifier_index is not None:
+        result["references"] = dict((identifier, sorted(referencing))
+            for (identifier, referencing)
+            in identifier_index.references.items())
+        result["definitions"] = list((input_file, name, directive.lineno,
+                                      directive.multi_lines)
+            for (input_file, name, directive) in identifier_index.definitions)
+    with open(file_name, "w", encoding="utf-8",
+              errors="surrogateescape") as f:
+        json.dump(result, f)
+
+def read_shard_results(file_names):
+    """Merge shard results. Return tuple (all_diagnostics, identifier_index,
+       enabled_wcodes, counters); identifier_index is None if shards did not
+       collect identifiers. Raise ValueError unless the results are of all
+       shards of one run, each given once: without some of them unused
+       macros would be reported for uses in missing files"""
+    import json
+    files = list()
+    shards = dict() # index -> file name
+    shard_count = None
+    identifier_index = None
+    enabled_wcodes = set()
+    counters = Counters()
+    for file_name in file_names:
+        with open(file_name, encoding="utf-8", errors="surrogateescape") as f:
+            result = json.load(f)
+        if result.get("version") != RESULT_VERSION:
+            raise ValueError("%s: unsupported shard result version" %
+                             file_name)
+        (index, count) = result["shard"]
+        if shard_count is None:
+            shard_count = count
+        elif count != shard_count:
+            raise ValueError("%s: shard %d/%d of another run of %d shards" %
+                             (file_name, index, count, shard_count))
+        if index in shards:
+            raise ValueError("%s: shard %d/%d is also in %s" %
+                             (file_name, index, count, shards[index]))
+        shards[index] = file_name
+        enabled_wcodes.update(result["enabled_wcodes"])
+        files += result["files"]
+        shard_counters = Counters()
+        shard_counters.values = dict(((name, tuple(tuple(label)
+                                                   for label in labels)),
+                                      value)
+                                     for (name, labels, value)
+                                     in result["counters"])
+        counters.merge(shard_counters)
+        if "references" in result:
+            shard_index = IdentifierIndex()
+            shard_index.references = dict((identifier, set(referencing))
+                for (identifier, referencing)
+                in result["references"].items())
+            shard_index.definitions = list((input_file, name,
+                    PreprocessorDirective(multi_lines, lineno, Context.OUTSIDE))
+                for (input_file, name, lineno, multi_lines)
+                in result["definitions"])
+            if identifier_index is None:
+                identifier_index = shard_index
+            else:
+                identifier_index.merge(shard_index)
+    missing = sorted(set(range(1, shard_count + 1)) - set(shards))
+    if missing:
+        raise ValueError("missing results of shard(s) %s of %d" %
+                         (", ".join(str(index) for index in missing),
+                          shard_count))
+
+    all_diagnostics = dict()
+    by_position = dict()
+    for (position, input_file, records) in sorted(files, key=lambda f: f[0]):
+        if isinstance(records, int):
+            diagnostics = by_position[records]
+        else:
+            diagnostics = list(StoredDiagnostic(*record)
+                               for record in records)
+        by_position[position] = diagnostics
+        all_diagnostics[input_file] = diagnostics
+    return (all_diagnostics, identifier_index, enabled_wcodes, counters)
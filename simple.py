@@ -1,29 +1,54 @@
 # Collection of simple diagnostics working on a single text line
 
+import threading
+
 from keywords import all_directives, preprocessor_prefixes, non_expr_keywords
 from keywords import directive_contains_condition, directive_is_definition
-from diagcodes import DiagCodes, filter_diag_codes
-from rolling import Context
-from threshold import Threshold
+from keywords import IF_CODE, DEFINE_CODE, NULL_DIRECTIVE, whitespace
+from diagcodes import DiagCodes, Feature, ALL_FEATURES, filter_diag_codes
+from rolling import Context, context_codes
+from threshold import default_thresholds
+from metrics import count_checks
 
 class BaseDiagnostic:
     wcode = 0
-    def __init__(self, directive):
+    codes = None # hashword codes the check applies to, None for all
+    needs = ALL_FEATURES # parts of directives apply() reads, see Feature
+    # If set, apply() takes the Thresholds of the file as second argument
+    uses_thresholds = False
+    # Looked up in columns before fetching a directive: context codes the
+    # check applies to, None for all, and name of the Threshold directives
+    # must have more lines than, None for any number of lines
+    contexts = None
+    line_limit = None
+    message = "unknown diagnostic"
+    def __init__(self, directive, *params):
+        # Keep only what is needed to format the message later: most of
+        # diagnostics are never printed in quiet or whitelisted runs
         self.lineno = directive.lineno
         self.first_line = directive.first_line
-        self.details = "unknown diagnostic"
+        self.params = params
+    @property
+    def details(self):
+        return self.message % self.params
     def __repr__(self):
         return "<%s W%d at %d: %s>" % (type(self).__name__,
                                       self.wcode, self.lineno, self.details)
 
 def hashword_is_known(hashword):
-    return hashword in all_directives
+    return hashword in all_directives or hashword == NULL_DIRECTIVE
+
+OUTSIDE_CODES = frozenset((context_codes[Context.OUTSIDE], ))
+INSIDE_CODES = frozenset(code for (context, code) in context_codes.items()
+                         if context != Context.OUTSIDE)
 
 class UnknownDirectiveDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.unknown
+    needs = Feature.CONTEXT
+    contexts = OUTSIDE_CODES
+    message = "Unknown directive %s"
     def __init__(self, directive):
-        super().__init__(directive)
-        self.details = "Unknown directive %s" % directive.hashword
+        super().__init__(directive, directive.hashword)
     @staticmethod
     def apply(directive):
         hashword = directive.hashword
@@ -38,21 +63,19 @@ class UnknownDirectiveDiagnostic(BaseDiagnostic):
 
 class MultiLineDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.multiline
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = "Multi-line preprocessor directive"
+    needs = Feature.HASHWORD
+    message = "Multi-line preprocessor directive"
     @staticmethod
     def apply(directive):
-        first_line = directive.first_line.strip()
+        first_line = directive.first_line.strip(whitespace)
         last_token = first_line[-1]
         if last_token == "\\":
             return MultiLineDiagnostic(directive)
 
 class LeadingWhitespaceDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.whitespace
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = "Preprocessor directive starts with whitespace"
+    needs = Feature.CONTEXT
+    message = "Preprocessor directive starts with whitespace"
     @staticmethod
     def apply(directive):
         if (directive.first_line[0] in preprocessor_prefixes):
@@ -88,12 +111,13 @@ def count_noncomment_tokens(directive):
 
 class ComplexIfConditionDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.complex_if_condition
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = "Logical condition looks to be overly complex"
+    needs = Feature.TOKENS
+    codes = (IF_CODE, )
+    uses_thresholds = True
+    message = "Logical condition looks to be overly complex"
 
     @staticmethod
-    def apply(directive):
+    def apply(directive, thresholds=default_thresholds):
         if not directive_contains_condition(directive.hashword):
             return
         # We want to allow only expressions using a single variable, e.g.
@@ -105,7 +129,7 @@ class ComplexIfConditionDiagnostic(BaseDiagnostic):
         has_operators = has_any_operators(directive)
 
         # Consider wordiness a bad sign
-        tokens_threshold = Threshold.TOKENS_THRESHOLD
+        tokens_threshold = thresholds.TOKENS_THRESHOLD
         too_many_tokens = count_noncomment_tokens(directive) > tokens_threshold
 
         # In absence of proper tokenizer, consider all non-alphanumeric symbols as
@@ -114,18 +138,17 @@ class ComplexIfConditionDiagnostic(BaseDiagnostic):
 
         if (has_operators
             or too_many_tokens
-            or non_alphanum > Threshold.NON_ALPHANUM_THRESHOLD):
+            or non_alphanum > thresholds.NON_ALPHANUM_THRESHOLD):
             return ComplexIfConditionDiagnostic(directive)
 
 class SpaceAfterHashDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.space_after_leading
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = "Space between leading symbol and keyword"
+    needs = Feature.CONTEXT
+    message = "Space between leading symbol and keyword"
 
     @staticmethod
     def apply(directive):
-        txt = directive.full_text.strip()
+        txt = directive.full_text.strip(whitespace)
         if len(txt) < 2:
             return
         if not (txt[1] in (" ", "\t")):
@@ -138,10 +161,10 @@ class SpaceAfterHashDiagnostic(BaseDiagnostic):
 
 class SuggestInlineDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.suggest_inline_function
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = ("Suggest defining a static or inline function returning"
-                         " the expression value")
+    needs = Feature.TOKENS
+    codes = (DEFINE_CODE, )
+    message = ("Suggest defining a static or inline function returning"
+               " the expression value")
 
     @staticmethod
     def apply(directive):
@@ -166,7 +189,7 @@ class SuggestInlineDiagnostic(BaseDiagnostic):
         brack_symbol_pos = unsplit_text.find("(")
         assert brack_symbol_pos > 0
         prev_symbol = unsplit_text[brack_symbol_pos - 1]
-        if prev_symbol.isspace(): # first bracket did not open a parameter list
+        if prev_symbol in whitespace: # bracket did not open a parameter list
             return
         if param_candidate == ")": # no parameters between brackets
             return
@@ -187,9 +210,9 @@ class SuggestInlineDiagnostic(BaseDiagnostic):
 
 class If0DeadCodeDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.if_0_dead_code
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = "Code block is always discarded. Consider removing it"
+    needs = Feature.TOKENS
+    codes = (IF_CODE, )
+    message = "Code block is always discarded. Consider removing it"
     @staticmethod
     def apply(directive):
         if len(directive.tokens) < 2:
@@ -202,10 +225,10 @@ class If0DeadCodeDiagnostic(BaseDiagnostic):
 
 class IfAlwaysTrueDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.if_always_true
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = ("Code block is always included." +
-                        " Remove surrounding directives")
+    needs = Feature.TOKENS
+    codes = (IF_CODE, )
+    message = ("Code block is always included." +
+               " Remove surrounding directives")
     @staticmethod
     def apply(directive):
         if len(directive.tokens) < 2:
@@ -218,9 +241,9 @@ class IfAlwaysTrueDiagnostic(BaseDiagnostic):
 
 class SuggestVoidDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.suggest_void_function
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = "Suggest defining a void function instead of do {} while"
+    needs = Feature.TOKENS
+    codes = (DEFINE_CODE, )
+    message = "Suggest defining a void function instead of do {} while"
 
     @staticmethod
     def apply(directive):
@@ -246,10 +269,11 @@ class SuggestConstantDiagnostic(BaseDiagnostic):
     ))
 
     wcode = DiagCodes.suggest_const
+    needs = Feature.TOKENS
+    codes = (DEFINE_CODE, )
+    message = "Suggest using an enum, constant or typedef for %s"
     def __init__(self, directive, symbol):
-        super().__init__(directive)
-        self.details = (
-            "Suggest using an enum, constant or typedef for %s" % symbol)
+        super().__init__(directive, symbol)
 
     @staticmethod
     def apply(directive):
@@ -304,27 +328,31 @@ class SuggestConstantDiagnostic(BaseDiagnostic):
 
 class TooLongDefineDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.too_long_define
-    line_limit = Threshold.DEFINE_LINES_LIMIT
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = ("Multi-line definition is longer than %d lines" %
-                        self.line_limit)
+    needs = Feature.HASHWORD
+    codes = (DEFINE_CODE, )
+    uses_thresholds = True
+    line_limit = "DEFINE_LINES_LIMIT"
+    message = "Multi-line definition is longer than %d lines"
+    def __init__(self, directive, line_limit):
+        super().__init__(directive, line_limit)
 
     @staticmethod
-    def apply(directive):
+    def apply(directive, thresholds=default_thresholds):
         if not directive_is_definition(directive.hashword):
             return
         number_of_lines = len(directive.multi_lines)
 
-        if number_of_lines > TooLongDefineDiagnostic.line_limit:
-            return TooLongDefineDiagnostic(directive)
+        line_limit = thresholds.DEFINE_LINES_LIMIT
+        if number_of_lines > line_limit:
+            return TooLongDefineDiagnostic(directive, line_limit)
 
 class WrongContextDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.wrong_context
+    needs = Feature.CONTEXT
+    contexts = INSIDE_CODES
+    message = "Preprocessor directive inside %s"
     def __init__(self, directive):
-        super().__init__(directive)
-        str_context = directive.context.value
-        self.details = "Preprocessor directive inside %s" % str_context
+        super().__init__(directive, directive.context.value)
 
     @staticmethod
     def apply(directive):
@@ -337,41 +365,94 @@ class WrongContextDiagnostic(BaseDiagnostic):
 
 class MultilineConditionalDiagnostic(BaseDiagnostic):
     wcode = DiagCodes.multiline_conditional
-    def __init__(self, directive):
-        super().__init__(directive)
-        self.details = "Multi-line conditional statement"
+    needs = Feature.HASHWORD
+    codes = (IF_CODE, )
+    uses_thresholds = True
+    line_limit = "MULTILINE_CONDITIONAL"
+    message = "Multi-line conditional statement"
 
     @staticmethod
-    def apply(directive):
+    def apply(directive, thresholds=default_thresholds):
         if not directive_contains_condition(directive.hashword):
             return
         number_of_lines = len(directive.multi_lines)
 
-        if number_of_lines > Threshold.MULTILINE_CONDITIONAL:
+        if number_of_lines > thresholds.MULTILINE_CONDITIONAL:
             return MultilineConditionalDiagnostic(directive)
 
 
-def run_simple_checks(pre_lines, enabled_wcodes):
-    all_diagnostics    = (UnknownDirectiveDiagnostic,
-                          MultiLineDiagnostic,
-                          LeadingWhitespaceDiagnostic,
-                          ComplexIfConditionDiagnostic,
-                          SpaceAfterHashDiagnostic,
-                          SuggestInlineDiagnostic,
-                          If0DeadCodeDiagnostic,
-                          IfAlwaysTrueDiagnostic,
-                          SuggestVoidDiagnostic,
-                          SuggestConstantDiagnostic,
-                          TooLongDefineDiagnostic,
-                          MultilineConditionalDiagnostic,
-                          WrongContextDiagnostic,
-    )
-
-    enabled_diagnostics = filter_diag_codes(all_diagnostics, enabled_wcodes)
+# Dispatch tables of run_simple_checks() for each set of checks and enabled
+# codes.
+# Worker threads of one run share them, hence the lock
+dispatch_tables = dict()
+dispatch_tables_lock = threading.Lock()
+
+def dispatch_table(all_diagnostics, enabled_wcodes):
+    "Return a list mapping hashword code -> checks applicable to directives"
+    key = (all_diagnostics, frozenset(enabled_wcodes))
+    with dispatch_tables_lock:
+        dispatch = dispatch_tables.get(key)
+        if dispatch is None:
+            enabled_diagnostics = filter_diag_codes(all_diagnostics,
+                                                    enabled_wcodes)
+            dispatch = list()
+            for code in range(len(all_directives) + 1):
+                dispatch.append(tuple(dia_class
+                                for dia_class in all_diagnostics
+                                if dia_class in enabled_diagnostics
+                                and (dia_class.codes is None
+                                     or code in dia_class.codes)))
+            dispatch_tables[key] = dispatch
+    return dispatch
+
+simple_diagnostics = (UnknownDirectiveDiagnostic,
+                      MultiLineDiagnostic,
+                      LeadingWhitespaceDiagnostic,
+                      ComplexIfConditionDiagnostic,
+                      SpaceAfterHashDiagnostic,
+                      SuggestInlineDiagnostic,
+                      If0DeadCodeDiagnostic,
+                      IfAlwaysTrueDiagnostic,
+                      SuggestVoidDiagnostic,
+                      SuggestConstantDiagnostic,
+                      TooLongDefineDiagnostic,
+                      MultilineConditionalDiagnostic,
+                      WrongContextDiagnostic,
+)
+
+def run_simple_checks(columns, enabled_wcodes, counters=None,
+                      checks=simple_diagnostics, thresholds=default_thresholds):
+    dispatch = dispatch_table(checks, enabled_wcodes)
     res = list()
-    for pre_line in pre_lines:
-        for dia_class in enabled_diagnostics:
-            w = dia_class.apply(pre_line)
+    for (index, code) in enumerate(columns.code):
+        applicable = dispatch[code]
+        if not applicable:
+            continue
+        context = columns.context[index]
+        line_count = columns.line_count[index]
+        pre_line = None
+        for dia_class in applicable:
+            if dia_class.contexts is not None and (context
+                                                   not in dia_class.contexts):
+                continue
+            if dia_class.line_limit is not None and (
+                    line_count <= getattr(thresholds, dia_class.line_limit)):
+                continue
+            if pre_line is None:
+                pre_line = columns.directive(index)
+            if dia_class.uses_thresholds:
+                w = dia_class.apply(pre_line, thresholds)
+            else:
+                w = dia_class.apply(pre_line)
             if w is not None:
                 res.append(w)
+    if counters is not None:
+        # Counted per hashword code, not in the loop above
+        examined = dict()
+        for (code, applicable) in enumerate(dispatch):
+            if applicable:
+                count = columns.code.count(code)
+                for dia_class in applicable:
+                    examined[dia_class] = examined.get(dia_class, 0) + count
+        count_checks(counters, examined, res)
     return res
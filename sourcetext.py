@@ -0,0 +1,172 @@
+# Reading of analyzed source files and decoding of their text for display
+#
+# Only ASCII characters matter for preprocessor syntax. Sources are therefore
+# read with a byte-transparent codec: every byte becomes exactly one character,
+# whatever the real encoding of the file is. Reading never fails on Latin-1,
+# Shift-JIS or mixed-encoding files and costs no more than a copy. The real
+# encoding only matters when text is shown to the user, see OutputDecoder.
+
+import io
+import os
+from collections import deque
+from functools import partial
+
+SOURCE_ENCODING = "latin-1"
+
+def read_source(input_file):
+    with open(input_file, "rb") as f:
+        return f.read()
+
+def split_source_lines(raw):
+    # Same universal newlines handling as for files opened in text mode
+    return io.StringIO(raw.decode(SOURCE_ENCODING), newline=None).readlines()
+
+def first_source_line(raw):
+    "Same as split_source_lines(raw)[0], without splitting all of raw"
+    ends = list(pos for pos in (raw.find(b"\n"), raw.find(b"\r")) if pos >= 0)
+    if not raw:
+        return ""
+    if not ends:
+        return split_source_lines(raw)[0]
+    # One more byte for \r\n
+    return split_source_lines(raw[:min(ends) + 2])[0]
+
+def read_source_lines(input_file):
+    return split_source_lines(read_source(input_file))
+
+def source_size(input_file):
+    try:
+        return os.path.getsize(input_file)
+    except OSError:
+        return 0 # reading it will report the error
+
+class MemoryCap:
+    """Bytes of files read ahead and not yet dropped by the caller. Files
+       get their bytes in the order they are yielded, so that a later file
+       never holds up an earlier one the caller is waiting for. Also counts
+       bytes a reader keeps for later files on its way, see take_ahead()"""
+    def __init__(self, cap):
+        import threading
+        self.cap = cap
+        self.used = 0
+        self.ahead = 0 # part of used kept for later files
+        self.turn = 0 # position of the next file to get its bytes
+        self.closed = False
+        self.changed = threading.Condition()
+
+    def acquire(self, position, size):
+        "Wait for size bytes. Return False if the caller has gone"
+        with self.changed:
+            # A file bigger than the cap is read alone. Bytes kept for
+            # later files are only freed by reading them after this one
+            self.changed.wait_for(lambda: self.closed or
+                                  (self.turn == position and
+                                   (self.used == self.ahead or
+                                    self.used + size <= self.cap)))
+            if self.closed:
+                return False
+            self.used += size
+            self.turn += 1
+            self.changed.notify_all()
+            return True
+
+    def release(self, size):
+        with self.changed:
+            self.used -= size
+            self.changed.notify_all()
+
+    def take_ahead(self, size):
+        """Take size bytes for a later file without waiting. Return False
+           if they do not fit"""
+        with self.changed:
+            if self.used + size > self.cap:
+                return False
+            self.used += size
+            self.ahead += size
+            return True
+
+    def release_ahead(self, size):
+        with self.changed:
+            self.used -= size
+            self.ahead -= size
+            self.changed.notify_all()
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+def source_sizes(input_files, depth, size=source_size):
+    """Return a dict mapping input_files to their sizes, looked up by depth
+       threads as prefetch_sources() does, in this thread if depth < 1"""
+    if depth < 1:
+        return dict((f, size(f)) for f in input_files)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(depth) as readers:
+        return dict(zip(input_files, readers.map(size, input_files)))
+
+def prefetch_sources(input_files, depth, cap, read=read_source,
+                     size=source_size):
+    """Yield tuples (input_file, raw contents, done) in order of input_files.
+       Up to depth files ahead are read by as many reader threads while the
+       caller analyzes the current one, so that latency of slow (e.g.
+       network) file systems overlaps with analysis. Files read ahead and
+       not yet done take no more bytes than cap, a MemoryCap, allows, unless
+       a single one is bigger: the caller calls done() once it has dropped
+       raw contents, possibly from another thread. Files are read with
+       read(input_file), which returns size(input_file) bytes"""
+    if depth < 1:
+        for input_file in input_files:
+            yield (input_file, read(input_file), lambda: None)
+        return
+    def read_ahead(position, input_file):
+        # Also the size is looked up here, a stat waits as long as a read
+        nbytes = size(input_file)
+        if not cap.acquire(position, nbytes):
+            return (nbytes, None)
+        try:
+            return (nbytes, read(input_file))
+        except BaseException:
+            cap.release(nbytes)
+            raise
+    # Not imported at startup, most runs read files in one thread
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(depth) as readers:
+        try:
+            pending = deque() # (input_file, future)
+            position = 0
+            while position < len(input_files) or pending:
+                while position < len(input_files) and len(pending) < depth:
+                    input_file = input_files[position]
+                    pending.append((input_file, readers.submit(
+                        read_ahead, position, input_file)))
+                    position += 1
+                (input_file, future) = pending.popleft()
+                (nbytes, raw) = future.result()
+                yield (input_file, raw, partial(cap.release, nbytes))
+        finally:
+            # Readers still waiting for memory must not wait for the caller
+            cap.close()
+
+class OutputDecoder:
+    """Restore original bytes of text read by read_source_lines() and decode
+       them with the first of encodings that fits. The last encoding is
+       applied with the given errors policy"""
+    def __init__(self, encodings=("utf-8",), errors="replace"):
+        assert encodings
+        self.encodings = tuple(encodings)
+        self.errors = errors
+
+    def __call__(self, txt):
+        if txt.isascii():
+            return txt
+        try:
+            raw = txt.encode(SOURCE_ENCODING)
+        except UnicodeEncodeError:
+            return txt # it did not come from a source file
+        for encoding in self.encodings[:-1]:
+            try:
+                return raw.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+        return raw.decode(self.encodings[-1], self.errors)
@@ -0,0 +1,107 @@
+# Aggregate statistics of a run, reported instead of single diagnostics
+#
+# For reports over whole trees only numbers matter: findings by code,
+# directory and file, and distributions of shapes of directives. Nothing is
+# formatted per diagnostic. Histograms are counted per file into Counters,
+# so that results of workers and shards merge like all other counters. Unlike
+# other counters, they describe every input file: a file analyzed once for
+# all of its identical copies is counted once per copy, see copy_counters().
+
+import os
+
+from keywords import is_open_directive, is_close_directive, DEFINE
+from metrics import Counters
+
+# Counters of a file added again for each of its copies
+copied_counters = frozenset(("input_directives_total",
+                             "conditional_depth_total", "define_lines_total"))
+
+def count_directive_shapes(counters, pre_lines):
+    """Add the number of directives, nesting depths of conditional blocks and
+       lines of #define to counters"""
+    counters.add("input_directives_total", len(pre_lines))
+    depth = 0
+    for directive in pre_lines:
+        hashword = directive.hashword
+        if is_open_directive(hashword):
+            depth += 1
+            counters.add("conditional_depth_total", depth=str(depth))
+        elif is_close_directive(hashword):
+            depth = max(0, depth - 1)
+        elif hashword == DEFINE:
+            counters.add("define_lines_total",
+                         lines=str(len(directive.multi_lines)))
+
+def copy_counters(counters):
+    "Return counters of a file to be added for each of its copies"
+    res = Counters()
+    res.values = dict((key, count) for (key, count) in counters.values.items()
+                      if key[0] in copied_counters)
+    return res
+
+class Stats:
+    "Numbers of input files and of findings by file and code"
+    def __init__(self):
+        self.files = 0
+        self.findings = dict() # (file, wcode) -> count
+
+    def add_findings(self, input_file, diagnostics):
+        "Called once for each input file"
+        self.files += 1
+        for diag in diagnostics:
+            key = (input_file, int(diag.wcode))
+            self.findings[key] = self.findings.get(key, 0) + 1
+
+def add_to(table, key, count):
+    table[key] = table.get(key, 0) + count
+
+def histogram(counters, name, label):
+    "Return a dict mapping values of label to counts, in numeric order"
+    res = dict()
+    for ((counter_name, labels), count) in counters.values.items():
+        if counter_name == name:
+            add_to(res, int(dict(labels)[label]), count)
+    return dict((str(value), res[value]) for value in sorted(res))
+
+def stats_report(stats, counters):
+    "Return the report of a run as a dict of numbers, see print_stats()"
+    by_code = dict()
+    by_directory = dict()
+    by_file = dict()
+    for ((input_file, wcode), count) in stats.findings.items():
+        add_to(by_code, wcode, count)
+        add_to(by_directory, os.path.dirname(input_file) or ".", count)
+        add_to(by_file, input_file, count)
+    return {
+        "files": stats.files,
+        "directives": counters.get("input_directives_total"),
+        "findings": sum(by_code.values()),
+        "findings_by_code": dict(("W%d" % wcode, by_code[wcode])
+                                 for wcode in sorted(by_code)),
+        "findings_by_directory": dict(sorted(by_directory.items())),
+        "findings_by_file": dict(sorted(by_file.items())),
+        "conditional_depth": histogram(counters, "conditional_depth_total",
+                                       "depth"),
+        "define_lines": histogram(counters, "define_lines_total", "lines"),
+    }
+
+table_titles = {
+    "findings_by_code": "Findings by code",
+    "findings_by_directory": "Findings by directory",
+    "findings_by_file": "Findings by file",
+    "conditional_depth": "Conditional blocks by nesting depth",
+    "define_lines": "Definitions by number of lines",
+}
+
+def print_stats(report, stats_format):
+    if stats_format == "json":
+        import json
+        print(json.dumps(report, indent=1))
+        return
+    for name in ("files", "directives", "findings"):
+        print("%s: %d" % (name.capitalize(), report[name]))
+    for (name, title) in table_titles.items():
+        print()
+        print("%s:" % title)
+        for (key, count) in report[name].items():
+            print("    %-60s %10d" % (key, count))
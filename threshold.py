@@ -9,3 +9,19 @@ class Threshold(IntEnum):
     DEFINE_LINES_LIMIT = 5 # used by TooLongDefineDiagnostic
     MULTILINE_CONDITIONAL = 1 # used by MultilineConditionalDiagnostic
     MAX_IFDEF_ENDIF_DISTANCE = 7 # used by UnmarkedEndifDiagnostic
+
+class Thresholds:
+    """Threshold values in effect for a file: defaults of Threshold, changed
+       by configurations of its directories, see dirconfig"""
+    def __init__(self, values=None):
+        # Not by iterating Threshold, which skips names of equal values
+        for (name, member) in Threshold.__members__.items():
+            setattr(self, name, int(member))
+        if values is not None:
+            for (name, value) in values.items():
+                setattr(self, name, value)
+
+    def key(self):
+        return tuple(getattr(self, name) for name in Threshold.__members__)
+
+default_thresholds = Thresholds()
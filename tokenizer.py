@@ -1,53 +1,57 @@
 # Tokenizing directives and routines
 
 import re
+from itertools import islice
+from functools import lru_cache
+from sys import intern
 from keywords import IFNDEF, IF, IFDEF, std_predefined_macros, variadic_macros
-from rolling import Context
+from keywords import line_is_preprocessor_directive, whitespace
+from rolling import Context, update_language_context, code_fragments
+from diagcodes import Feature, ALL_FEATURES
 
 def is_alnum_underscore(s):
     return re.match(r'^[A-Za-z0-9_]+$', s) is not None
 
-def match_special(s):
-    specials = ("(", ")", ",", "\\", "##",
-                "!",
-                "//", "/*",
-    )
-    matched_special = None
-    for special in specials:
-        if s.find(special) == 0:
-            matched_special = special
-            break
-    return matched_special
+# A token is either a special: ( ) , \ ## ! // /*
+# or everything until the next space or special. Matching with one regular
+# expression takes linear time, also on directives hundreds of KB long.
+# Spaces are ASCII only, see keywords.whitespace
+special_pattern = r"[(),\\!]|##|//|/\*"
+token_re = re.compile(r"%s|(?:(?!##|//|/\*)[^\s(),\\!])+" % special_pattern,
+                      re.ASCII)
 
-def tokenize(txt):
-    res = list()
-    i = 0
-    while i < len(txt):
-        if txt[i].isspace():
-            i += 1
-            continue
-
-        # Try to match a special
-        matched_special = match_special(txt[i:])
-        if matched_special is not None:
-            i += len(matched_special)
-            res.append(matched_special)
-            continue
-
-        # Otherwise consume everything until the next space/special
-        k = i+1
-        while (k < len(txt)
-               and (match_special(txt[k:]) is None)
-               and not txt[k].isspace()):
-            k += 1
-        misc_token = txt[i:k]
-        i = k
-        res.append(misc_token)
-    return res
+def tokenize(txt, max_tokens=None):
+    if max_tokens is None:
+        return token_re.findall(txt)
+    return list(m.group() for m in islice(token_re.finditer(txt), max_tokens))
+
+
+# Number of distinct directive texts whose tokenization is kept around.
+# Large trees repeat the same #endif, #else, #include <...> lines many times.
+# The cache is safe to share between worker threads.
+DIRECTIVE_CACHE_SIZE = 8192
+
+@lru_cache(maxsize=DIRECTIVE_CACHE_SIZE)
+def tokenize_directive(stripped_txt):
+    """Return tuple (text, tokens) shared between all directives with the same
+       combined text. Tokens are interned"""
+    tokens = merge_hash(tokenize(stripped_txt))
+    return (stripped_txt, tuple(intern(token) for token in tokens))
 
+def merge_hash(tokens):
+    # A lone "#" is the null directive, with no keyword to merge
+    if len(tokens) > 1 and len(tokens[0]) == 1: # space after leading hash
+        # Merge them
+        tokens = [tokens[0] + tokens[1]] + tokens[2:]
+    return tokens
+
+@lru_cache(maxsize=DIRECTIVE_CACHE_SIZE)
+def directive_hashword(stripped_txt):
+    "Same as tokenize_directive(stripped_txt)[1][0], without the other tokens"
+    return intern(merge_hash(tokenize(stripped_txt, 2))[0])
 
 def line_ends_with_continuation(txt):
-    txt = txt.strip()
+    txt = txt.strip(whitespace)
     # BUG: does not handle the case when the final backslash is escaped by
     #      itself by a preceding backslash
     return len(txt) > 0 and txt[-1] == "\\"
@@ -64,8 +68,10 @@ def extract_multiline_sequence(lines, start_lineno):
     return res
 
 class PreprocessorDirective:
-    "Tokenized preprocessor line(s)"
-    def __init__(self, line_or_lines, lineno, context = Context.OUTSIDE):
+    """Tokenized preprocessor line(s). With tokenize=False, only the hashword
+       is found at once, and tokens are computed on their first use"""
+    def __init__(self, line_or_lines, lineno, context = Context.OUTSIDE,
+                 tokenize=True):
         assert line_or_lines
         if isinstance(line_or_lines, str):
             first_line = line_or_lines
@@ -78,26 +84,54 @@ class PreprocessorDirective:
         self.full_text = self.combine_all_lines()
         self.lineno = lineno
         self.context = context
-        stripped_txt = self.full_text.strip()
+        stripped_txt = self.full_text.strip(whitespace)
         assert stripped_txt, "Line must have at least one symbol (# or similar)"
-        tokens = tokenize(stripped_txt)
-        if len(tokens[0]) == 1: # space between leading hash symbol and keyword
-            # Merge them
-            tokens = [tokens[0] + tokens[1]] + tokens[2:]
+        if not tokenize:
+            self.hashword = directive_hashword(stripped_txt)
+            return
+        (shared_txt, tokens) = tokenize_directive(stripped_txt)
+        if shared_txt == self.full_text:
+            self.full_text = shared_txt
 
         self.tokens = tokens
         self.hashword = self.tokens[0]
 
+    def __getattr__(self, name):
+        # Only called for attributes not set yet, i.e. tokens not computed
+        if name != "tokens":
+            raise AttributeError(name)
+        (_, tokens) = tokenize_directive(self.full_text.strip(whitespace))
+        self.tokens = tokens
+        return tokens
+
+    @classmethod
+    def from_parts(cls, multi_lines, lineno, context, full_text, tokens):
+        "Restore a directive tokenized earlier, see ircache.py"
+        res = cls.__new__(cls)
+        res.multi_lines = multi_lines
+        res.first_line = multi_lines[0]
+        res.full_text = full_text
+        res.lineno = lineno
+        res.context = context
+        res.tokens = tokens
+        res.hashword = tokens[0]
+        return res
+
     def combine_all_lines(self):
-        res = ''
+        # Joined once at the end, for thousands of continued lines
+        res = list()
+        last = "" # last character of the text so far
         for line in self.multi_lines:
-            line = line.strip()
+            line = line.strip(whitespace)
             if line_ends_with_continuation(line):
                 line = line[:-1]
-            if res and (not res[-1].isspace()):
-                res += " "
-            res += line
-        return res
+            if last and last not in whitespace:
+                res.append(" ")
+                last = " "
+            res.append(line)
+            if line:
+                last = line[-1]
+        return "".join(res)
 
     def __repr__(self):
         if len(self.multi_lines) > 1:
@@ -161,6 +195,11 @@ class PreprocessorDirective:
     def uses_macro_tricks(self):
         """Return True if the expression contains things that indeed can be best
         done by preprocessor"""
+        # Every trick needs a second "#", "__" or "...", this spares
+        # tokenizing of most of directives
+        txt = self.full_text
+        if txt.count("#") < 2 and "__" not in txt and "..." not in txt:
+            return False
         all_tokens = self.tokens_without_comment()
         for token in all_tokens[1:]:
             if token == "##":
@@ -175,3 +214,55 @@ class PreprocessorDirective:
             if token in variadic_macros:
                 return True
         return False
+
+def extract_directives(lines, file_name, identifier_index=None,
+                       context=Context.OUTSIDE, first_lineno=1,
+                       features=ALL_FEATURES):
+    """Return the list of directives found in lines, which start at line
+       first_lineno of file_name in the given context. If identifier_index
+       is given, identifiers used in lines are added to it on the way.
+       Without Feature.CONTEXT in features, the context is not tracked and
+       all directives keep the starting one"""
+    if Feature.CONTEXT not in features and identifier_index is None:
+        return extract_directives_only(lines, context, first_lineno, features)
+    eager_tokens = Feature.TOKENS in features
+    res = list()
+    lineno = 0
+    while lineno < len(lines):
+        cur_line = lines[lineno]
+        if line_is_preprocessor_directive(cur_line):
+            multi_lines = extract_multiline_sequence(lines, lineno)
+            human_lineno = lineno + first_lineno
+            directive = PreprocessorDirective(multi_lines, human_lineno,
+                                              context, eager_tokens)
+            res.append(directive)
+            lineno += len(multi_lines)
+            if identifier_index is None:
+                context = update_language_context(multi_lines, context)
+            else:
+                (fragments, context) = code_fragments(multi_lines, context)
+                identifier_index.add_directive(file_name, directive,
+                                               fragments)
+        else:
+            lineno += 1
+            if identifier_index is None:
+                context = update_language_context([cur_line], context)
+            else:
+                (fragments, context) = code_fragments([cur_line], context)
+                identifier_index.add_code(file_name, fragments)
+    return res
+
+def extract_directives_only(lines, context, first_lineno, features):
+    # Same as extract_directives() without tracking the context
+    eager_tokens = Feature.TOKENS in features
+    res = list()
+    lineno = 0
+    while lineno < len(lines):
+        if line_is_preprocessor_directive(lines[lineno]):
+            multi_lines = extract_multiline_sequence(lines, lineno)
+            res.append(PreprocessorDirective(multi_lines, lineno + first_lineno,
+                                             context, eager_tokens))
+            lineno += len(multi_lines)
+        else:
+            lineno += 1
+    return res
@@ -3,15 +3,58 @@
 from cppsa import main as cppsa_main
 from cppsa import parse_diag_spec_line
 from cppsa import line_is_preprocessor_directive
+from cppsa import extract_preprocessor_lines, parse_args
+from cppsa import parse_common_args, parse_full_args
+from driver import Analysis, analyze_files, add_tree_diagnostics
+from shards import parse_shard_spec, select_shard
+from diagcodes import all_wcodes, Feature, ALL_FEATURES, required_features
 from tokenizer import extract_multiline_sequence, line_ends_with_continuation
-from tokenizer import PreprocessorDirective, tokenize
-from keywords import is_open_directive, is_close_directive
-from rolling import update_language_context, Context
+from tokenizer import PreprocessorDirective, tokenize, extract_directives
+from keywords import is_open_directive, is_close_directive, ENDIF
+from keywords import hashword_code, UNKNOWN_CODE, IFDEF_CODE, DEFINE_CODE
+from keywords import ENDIF_CODE
+from columns import DirectiveColumns
+from sourcetext import read_source_lines, read_source, OutputDecoder
+from sourcetext import prefetch_sources, MemoryCap
+from ircache import serialize_directives, deserialize_directives
+from ircache import DirectiveCache, content_hash
+from rolling import update_language_context, code_fragments, Context
+from rolling import context_codes, context_map
+from parallel import chunk_bounds, extract_directives_parallel
+from parallel import executor_kind, gil_enabled
+from packed import DiagnosticBatch, referenced_lines
+import membench
+import fuzz
+from schedule import schedule_order, TimingCache, WorkerStats, PARENT_WORKER
+from metrics import Counters
+from limits import truncated_lines
+from archives import ArchiveSources, TOO_LARGE_PREFIX
+from baseline import block_contexts, fingerprints, normalized
+from stats import count_directive_shapes, Stats, stats_report
+from registry import CheckRegistry, PluginError, parse_plugin_spec
+from registry import builtin_modules
+from dirconfig import DirConfigs, DirConfigError
 
 from simple import *
 from multichecks import *
+from multiconfig import ConfigSet, read_configs, parse_macro_spec
+from multiconfig import branch_masks, run_config_checks
+from macroindex import IdentifierIndex, run_tree_checks
 
 import unittest
+import io
+import contextlib
+import tempfile
+import pickle
+import tarfile
+import zipfile
+import json
+import importlib
+import sys
+import subprocess
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 class TestTokenizer(unittest.TestCase):
     def test_tokenize_empty(self):
@@ -192,6 +235,100 @@ class TestDirectiveTokens(unittest.TestCase):
         self.assertFalse(is_close_directive("#if"))
         self.assertFalse(is_close_directive("#else"))
 
+class TestDirectiveCache(unittest.TestCase):
+    def test_repeated_directives_share_tokens(self):
+        first = PreprocessorDirective("#include <stdint.h>\n", 1)
+        second = PreprocessorDirective("  #include <stdint.h>", 20)
+        self.assertIs(first.tokens, second.tokens)
+        self.assertIs(first.full_text, second.full_text)
+        self.assertEqual(second.lineno, 20)
+
+    def test_hashword_is_interned(self):
+        directive = PreprocessorDirective("# endif // comment", 1)
+        self.assertIs(directive.hashword, ENDIF)
+
+class TestRequiredFeatures(unittest.TestCase):
+    def test_block_checks_need_hashword_only(self):
+        self.assertEqual(required_features(complex_diagnostics,
+                                           {4, 7, 8, 10}), Feature.HASHWORD)
+        self.assertEqual(required_features(simple_diagnostics, {17}),
+                         Feature.CONTEXT)
+        self.assertEqual(required_features(simple_diagnostics, all_wcodes),
+                         ALL_FEATURES)
+
+    def test_context_is_not_tracked(self):
+        lines = TestIntraFileParallel.lines
+        full = extract_directives(lines, "f.c")
+        res = extract_directives(lines, "f.c", features=Feature.HASHWORD)
+        self.assertEqual(list((d.lineno, d.multi_lines, d.hashword)
+                              for d in res),
+                         list((d.lineno, d.multi_lines, d.hashword)
+                              for d in full))
+        self.assertEqual(set(d.context for d in res), {Context.OUTSIDE})
+        self.assertNotEqual(set(d.context for d in full), {Context.OUTSIDE})
+
+    def test_tokens_on_demand(self):
+        for txt in ("#define A(x) x", "# if 1", "  #  endif // A", "#!",
+                    "##x y"):
+            directive = PreprocessorDirective(txt, 1, tokenize=False)
+            expected = PreprocessorDirective(txt, 1)
+            self.assertNotIn("tokens", directive.__dict__)
+            self.assertEqual(directive.hashword, expected.hashword)
+            self.assertEqual(directive.tokens, expected.tokens)
+            self.assertEqual(directive.uses_macro_tricks(),
+                             expected.uses_macro_tricks())
+
+    def test_macro_tricks_without_tokens(self):
+        for (txt, expected) in (("#define A 1", False),
+                                ("#define S(x) #x", True),
+                                ("#define C(a, b) a ## b", True),
+                                ("#if __LINE__ > 1", True),
+                                ("#define V(...) f(__VA_ARGS__)", True),
+                                ("#define U __UINT_MAX__", False)):
+            directive = PreprocessorDirective(txt, 1, tokenize=False)
+            self.assertEqual(directive.uses_macro_tricks(), expected, txt)
+
+class TestDirectiveColumns(unittest.TestCase):
+    def test_columns(self):
+        dirs = (
+            PreprocessorDirective("#ifdef A", 3),
+            PreprocessorDirective(["#define B \\", "1"], 4, Context.COMMENT),
+            PreprocessorDirective("#strange", 6),
+        )
+        columns = DirectiveColumns(dirs)
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(list(columns.lineno), [3, 4, 6])
+        self.assertEqual(list(columns.code),
+                         [IFDEF_CODE, DEFINE_CODE, UNKNOWN_CODE])
+        self.assertEqual(list(columns.context),
+                         [context_codes[Context.OUTSIDE],
+                          context_codes[Context.COMMENT],
+                          context_codes[Context.OUTSIDE]])
+        self.assertEqual(list(columns.line_count), [1, 2, 1])
+        self.assertIs(columns.directive(2), dirs[2])
+
+    def test_checks_filtered_by_columns(self):
+        dirs = (
+            PreprocessorDirective("#ifdef A", 3),
+            PreprocessorDirective(["#define B \\", "1"], 4),
+            PreprocessorDirective("#if X", 6, Context.COMMENT),
+        )
+        columns = DirectiveColumns(dirs)
+        fetched = list()
+        directive = columns.directive
+        columns.directive = lambda index: fetched.append(index) or directive(
+                                                                      index)
+        enabled = {DiagCodes.wrong_context, DiagCodes.too_long_define}
+        res = run_simple_checks(columns, enabled)
+        self.assertEqual(list(type(d) for d in res), [WrongContextDiagnostic])
+        # Neither the directive outside of comments nor the short definition
+        # is looked at
+        self.assertEqual(fetched, [2])
+
+    def test_hashword_code(self):
+        self.assertEqual(hashword_code("#endif"), ENDIF_CODE)
+        self.assertEqual(hashword_code("#unknown"), UNKNOWN_CODE)
+
 class TestContinuedMultilineDirective(unittest.TestCase):
     def test_full_text_combining(self):
         directive = PreprocessorDirective(["aa\\", "bb"], 1)
@@ -270,6 +407,16 @@ class TestSimpleDirectives(unittest.TestCase):
         res = UnknownDirectiveDiagnostic.apply(directive)
         self.assertIsNone(res)
 
+    def test_null_directive(self):
+        # Found by fuzzing, see test/fuzz-extract-f1b2af37
+        pre_lines = extract_preprocessor_lines('test/fuzz-extract-f1b2af37')
+        self.assertEqual(list(d.tokens for d in pre_lines), [("#",)])
+        self.assertIsNone(UnknownDirectiveDiagnostic.apply(pre_lines[0]))
+        argv = [TestInputFiles.script, '-Dall', 'test/fuzz-extract-f1b2af37']
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(cppsa_main(argv), 0)
+        self.assertEqual(output.getvalue(), "")
+
     def test_multi_line_define_separate(self):
         directive = PreprocessorDirective("#define TEXT \\", 1)
         res = MultiLineDiagnostic.apply(directive)
@@ -706,6 +853,35 @@ class TestScopeDirectives(unittest.TestCase):
         self.assertTrue(len(res) == 0)
 
 
+class TestLazyDetails(unittest.TestCase):
+    def test_details_are_formatted_from_params(self):
+        directive = PreprocessorDirective("#unknown directive", 5)
+        res = UnknownDirectiveDiagnostic.apply(directive)
+        self.assertEqual(res.params, ("#unknown",))
+        self.assertEqual(res.details, "Unknown directive #unknown")
+
+    def test_deep_nesting_details(self):
+        dirs = (
+            PreprocessorDirective("#ifdef A", 1),
+            PreprocessorDirective("#ifdef B", 2),
+            PreprocessorDirective("#ifdef C", 3),
+            PreprocessorDirective("#endif", 4),
+            PreprocessorDirective("#endif", 5),
+            PreprocessorDirective("#endif", 6),
+        )
+        res = IfdefNestingDiagnostic.apply_to_lines(dirs)
+        self.assertEqual(res[0].params, (1, 2))
+        self.assertEqual(res[0].details, make_deep_warning([1, 2]))
+
+    def test_unmarked_endif_details(self):
+        dirs = (
+            PreprocessorDirective("#ifdef A", 1),
+            PreprocessorDirective("#endif", 1000),
+        )
+        res = UnmarkedEndifDiagnostic.apply_to_lines(dirs)
+        self.assertEqual(res[0].details, "No trailing comment to match opening"
+                         " directive '#ifdef A' at line 1 (999 lines apart)")
+
 class TestIncludeGuards(unittest.TestCase):
     def test_include_guard_detection_ifndef(self):
         dirs = (
@@ -877,12 +1053,1256 @@ class TestLanguageContext(unittest.TestCase):
         new_context = update_language_context(lines, Context.OUTSIDE)
         self.assertEqual(new_context, Context.SLASH_COMMENT)
 
+    def test_code_fragments(self):
+        lines = ['a = "b"; /* c \n', 'd */ e // f\n']
+        (fragments, new_context) = code_fragments(lines, Context.OUTSIDE)
+        self.assertEqual(fragments, ['a = ', '; ', ' e '])
+        self.assertEqual(new_context, Context.OUTSIDE)
+
+        (fragments, new_context) = code_fragments(["x */ y /* z"],
+                                                  Context.COMMENT)
+        self.assertEqual(fragments, [' y '])
+        self.assertEqual(new_context, Context.COMMENT)
+
 class TestDirectivesInContext(unittest.TestCase):
     def test_directive_insize_wrong_context(self):
         directive = PreprocessorDirective("#define A", 1, Context.COMMENT)
         res = WrongContextDiagnostic.apply(directive)
         self.assertIsInstance(res, WrongContextDiagnostic)
 
+class TestMultiConfig(unittest.TestCase):
+    configs = ({"LINUX": 1, "VERSION": 2}, {"LINUX": 1, "VERSION": 3},
+               {"WINDOWS": 1, "VERSION": 3})
+
+    def masks(self, dirs):
+        config_set = ConfigSet(self.configs)
+        return list((reaching, active)
+                    for (_, reaching, active) in branch_masks(dirs, config_set))
+
+    def test_parse_macro_spec(self):
+        self.assertEqual(parse_macro_spec("-DA"), ("A", 1))
+        self.assertEqual(parse_macro_spec("B=0x10"), ("B", 16))
+        self.assertEqual(parse_macro_spec("-DC=text"), ("C", None))
+
+    def test_ifdef_else(self):
+        dirs = (
+            PreprocessorDirective("#ifdef LINUX", 1),
+            PreprocessorDirective("#else", 3),
+            PreprocessorDirective("#endif", 5),
+        )
+        self.assertEqual(self.masks(dirs), [(0b111, 0b011), (0b100, 0b100)])
+
+    def test_expression(self):
+        dirs = (
+            PreprocessorDirective("#if !defined(WINDOWS) && VERSION > 2", 1),
+            PreprocessorDirective("#elif (VERSION == 3) || LINUX", 3),
+            PreprocessorDirective("#endif", 5),
+        )
+        self.assertEqual(self.masks(dirs), [(0b111, 0b010), (0b101, 0b101)])
+
+    def test_define_in_file(self):
+        dirs = (
+            PreprocessorDirective("#ifdef WINDOWS", 1),
+            PreprocessorDirective("#define VERSION 7", 2),
+            PreprocessorDirective("#endif", 3),
+            PreprocessorDirective("#if VERSION == 7", 4),
+            PreprocessorDirective("#endif", 5),
+        )
+        self.assertEqual(self.masks(dirs), [(0b111, 0b100), (0b111, 0b100)])
+
+    def test_define_in_dead_code(self):
+        dirs = (
+            PreprocessorDirective("#if 0", 1),
+            PreprocessorDirective("#define LINUX bar", 2),
+            PreprocessorDirective("#endif", 3),
+            PreprocessorDirective("#if LINUX", 4),
+            PreprocessorDirective("#endif", 5),
+        )
+        self.assertEqual(self.masks(dirs), [(0b111, 0b000), (0b111, 0b011)])
+
+    def test_unknown_condition_is_skipped(self):
+        dirs = (
+            PreprocessorDirective("#if VERSION + 1 > 3", 1),
+            PreprocessorDirective("#ifdef MACOS", 2),
+            PreprocessorDirective("#endif", 3),
+            PreprocessorDirective("#endif", 4),
+        )
+        self.assertEqual(self.masks(dirs), [])
+
+    def test_dead_and_live_blocks(self):
+        dirs = (
+            PreprocessorDirective("#ifdef MACOS", 1),
+            PreprocessorDirective("#elif VERSION", 3),
+            PreprocessorDirective("#else", 5),
+            PreprocessorDirective("#endif", 7),
+        )
+        res = run_config_checks(dirs, all_wcodes, ConfigSet(self.configs))
+        self.assertEqual(list((d.lineno, d.wcode) for d in res),
+                         [(1, 18), (3, 19), (5, 18)])
+        self.assertEqual(res[0].details,
+                         "Block is not active in any of 3 configurations")
+        self.assertEqual(res[2].details, "Block is unreachable: preceding"
+                         " branches are taken in all 3 configurations")
+
+    def test_include_guard_is_not_reported(self):
+        dirs = (
+            PreprocessorDirective("#ifndef HEADER_GUARD", 1),
+            PreprocessorDirective("#define HEADER_GUARD", 2),
+            PreprocessorDirective("#endif", 3),
+        )
+        res = run_config_checks(dirs, all_wcodes, ConfigSet(self.configs))
+        self.assertEqual(len(res), 0)
+
+    def test_main_on_multi_config(self):
+        argv = [TestInputFiles.script, '-q', '-D18,19', '--configs',
+                'test/configs', 'test/multi-config']
+        self.assertEqual(cppsa_main(argv), 1)
+        self.assertEqual(len(read_configs('test/configs')), 3)
+
+class TestIdentifierIndex(unittest.TestCase):
+    def test_definition_is_not_a_reference(self):
+        index = IdentifierIndex()
+        directive = PreprocessorDirective("#define A B", 1)
+        index.add_directive("f.h", directive, ["#define A B"])
+        self.assertEqual(index.references, {"define": {"f.h"}, "B": {"f.h"}})
+        self.assertEqual(len(index.unused_definitions()), 1)
+
+    def test_merge(self):
+        index_a = IdentifierIndex()
+        directive = PreprocessorDirective("#define A 1", 1)
+        index_a.add_directive("a.h", directive, ["#define A 1"])
+        index_b = IdentifierIndex()
+        index_b.add_code("b.c", ["int x = A;"])
+        index_a.merge(index_b)
+        self.assertEqual(index_a.references["A"], {"b.c"})
+        self.assertEqual(index_a.unused_definitions(), [])
+
+    def test_unused_macros_across_files(self):
+        index = IdentifierIndex()
+        for input_file in ('test/unused-macro-def', 'test/unused-macro-use'):
+            extract_preprocessor_lines(input_file, index)
+        res = run_tree_checks(index, all_wcodes)
+        self.assertEqual(list((f, d.lineno) for (f, d) in res),
+                         [('test/unused-macro-def', 3),
+                          ('test/unused-macro-def', 4),
+                          ('test/unused-macro-def', 5)])
+
+    def test_main_on_unused_macros(self):
+        argv = [TestInputFiles.script, '-q', '-D20', '--unused-macros',
+                'test/unused-macro-def', 'test/unused-macro-use']
+        self.assertEqual(cppsa_main(argv), 1)
+        argv = [TestInputFiles.script, '-q', '-D20', '--unused-macros',
+                'test/basic']
+        self.assertEqual(cppsa_main(argv), 0)
+
+class TestSourceEncoding(unittest.TestCase):
+    def test_any_bytes_are_readable(self):
+        lines = read_source_lines('test/mixed-encoding')
+        self.assertEqual(len(lines), 3)
+        pre_lines = extract_preprocessor_lines('test/mixed-encoding')
+        self.assertEqual(list(d.hashword for d in pre_lines),
+                         ["#define", "#unknown"])
+
+    def test_output_decoder(self):
+        sjis_text = "\u3053\u3093".encode("shift_jis").decode("latin-1")
+        decode = OutputDecoder(("utf-8", "shift_jis"), "strict")
+        self.assertEqual(decode(sjis_text), "\u3053\u3093")
+        self.assertEqual(decode("ascii only"), "ascii only")
+
+        decode = OutputDecoder(("utf-8",), "replace")
+        self.assertEqual(decode("caf\xe9"), "caf\ufffd")
+        decode = OutputDecoder(("utf-8",), "backslashreplace")
+        self.assertEqual(decode("caf\xe9"), "caf\\xe9")
+
+    def test_strict_errors_are_rejected(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                parse_args(['--encoding-errors', 'strict', 'test/basic'])
+
+    def test_only_ascii_spaces_separate_tokens(self):
+        # UTF-8 of "\u00c5" has byte 0x85 and of NBSP byte 0xA0, which are
+        # spaces for str.isspace() in the byte per character text
+        txt = '#define MSG "\u00c5ngstr\u00f6m" x'
+        txt = txt.encode("utf-8").decode("latin-1")
+        directive = PreprocessorDirective(txt, 1)
+        msg = '"\u00c5ngstr\u00f6m"'.encode("utf-8").decode("latin-1")
+        self.assertEqual(directive.tokens[2], msg)
+        self.assertEqual(directive.tokens[3], "x")
+        txt = "#ifdef A\u00a0".encode("utf-8").decode("latin-1")
+        directive = PreprocessorDirective(txt, 1)
+        self.assertEqual(directive.tokens[1], "A\xc2\xa0")
+
+    def test_unknown_encoding(self):
+        argv = [TestInputFiles.script, '--encoding', 'utf-8,nosuch',
+                'test/basic']
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit) as cm:
+                cppsa_main(argv)
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_main_on_mixed_encoding(self):
+        argv = [TestInputFiles.script, '--encoding', 'shift_jis,latin-1',
+                'test/mixed-encoding']
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            res = cppsa_main(argv)
+        self.assertEqual(res, 1)
+        self.assertIn("\u3053\u3093\u306b\u3061\u306f", output.getvalue())
+        self.assertIn("#unknown \xe9t\xe9", output.getvalue())
+
+class TestIntraFileParallel(unittest.TestCase):
+    lines = ["int a; /* open\n", "#define IN_COMMENT\n", "*/\n",
+             "#define A \\\n", "  1\n", 'char *s = "\\\n', "#x\n",
+             '";\n', "// \\\n", "#include <a>\n", "#endif\n"]
+
+    def test_chunk_bounds_keep_continued_lines(self):
+        self.assertEqual(chunk_bounds(self.lines, 3),
+                         [(0, 5), (5, 10), (10, 11)])
+        self.assertEqual(chunk_bounds(self.lines, 1), [(0, 11)])
+
+    def test_context_map(self):
+        res = context_map(["a */ b /* c\n"])
+        self.assertEqual(res[Context.OUTSIDE], Context.COMMENT)
+        self.assertEqual(res[Context.COMMENT], Context.COMMENT)
+        self.assertEqual(res[Context.QUOTES], Context.QUOTES)
+
+    def test_parallel_matches_sequential(self):
+        def summary(directives):
+            return list((d.lineno, d.context, d.multi_lines)
+                        for d in directives)
+        expected = summary(extract_directives(self.lines, "f.c"))
+        with ThreadPoolExecutor(2) as executor:
+            for chunk_count in range(1, len(self.lines) + 1):
+                res = extract_directives_parallel(self.lines, "f.c", None,
+                                                  executor, chunk_count)
+                self.assertEqual(summary(res), expected)
+
+    def test_parallel_identifier_index(self):
+        index = IdentifierIndex()
+        with ThreadPoolExecutor(2) as executor:
+            extract_directives_parallel(self.lines, "f.c", index, executor, 4)
+        self.assertEqual(list(name for (_, name, _) in index.definitions),
+                         ["A"])
+        self.assertNotIn("IN_COMMENT", index.references)
+
+    def test_main_with_jobs(self):
+        argv = [TestInputFiles.script, '-q', '-j', '2', '--split-lines', '1',
+                'test/unmarked-endif']
+        self.assertEqual(cppsa_main(argv), 1)
+
+class TestPrefetch(unittest.TestCase):
+    input_files = ['test/unknown', 'test/basic', 'test/unmarked-endif',
+                   'test/unknown-copy']
+
+    def test_order_and_contents(self):
+        expected = list((f, read_source(f)) for f in self.input_files)
+        for depth in (0, 1, 3, 10):
+            for memory_cap in (1, 1 << 20):
+                res = list()
+                for (input_file, raw, done) in prefetch_sources(
+                        self.input_files, depth, MemoryCap(memory_cap)):
+                    res.append((input_file, raw))
+                    done()
+                self.assertEqual(res, expected)
+
+    def test_memory_is_taken_until_done(self):
+        sizes = dict((f, len(read_source(f))) for f in self.input_files)
+        memory_cap = sizes['test/unknown'] + sizes['test/basic']
+        read = list()
+        def read_logged(input_file):
+            read.append(input_file)
+            return read_source(input_file)
+        files = prefetch_sources(self.input_files, 3, MemoryCap(memory_cap),
+                                 read_logged)
+        (_, _, done) = next(files)
+        time.sleep(0.1)
+        # The third file does not fit next to the first two
+        self.assertNotIn(self.input_files[2], read)
+        done()
+        for (_, _, done) in files:
+            done()
+        self.assertEqual(read, self.input_files)
+
+    def test_abandoned_prefetch_stops_readers(self):
+        files = prefetch_sources(self.input_files, 3, MemoryCap(1))
+        next(files)
+        files.close()
+
+    def test_read_error_is_reported(self):
+        with self.assertRaises(OSError):
+            for (_, _, done) in prefetch_sources(['test/basic',
+                                                  'test/no-such-file'], 2,
+                                                 MemoryCap(1)):
+                done()
+
+    def test_main_with_prefetch(self):
+        argv = [TestInputFiles.script, '-q', '--prefetch', '2',
+                '--prefetch-memory', '1'] + self.input_files
+        self.assertEqual(cppsa_main(argv), 1)
+
+class TestParallelFiles(unittest.TestCase):
+    input_files = ['test/unknown', 'test/unknown-copy', 'test/basic',
+                   'test/unmarked-endif', 'test/unused-macro-def',
+                   'test/unused-macro-use', 'test/file-with-problems']
+
+    def summary(self, argv):
+        opts = parse_args(argv + self.input_files)
+        analysis = Analysis(opts, all_wcodes)
+        try:
+            res = analyze_files(opts.input_files, analysis)
+        finally:
+            analysis.close()
+        add_tree_diagnostics(res, analysis.identifier_index, all_wcodes)
+        return dict((input_file, list((d.lineno, d.wcode, d.details)
+                                      for d in diagnostics))
+                    for (input_file, diagnostics) in res.items())
+
+    def test_executor_kind(self):
+        self.assertEqual(executor_kind("thread"), "thread")
+        self.assertEqual(executor_kind("process"), "process")
+        self.assertEqual(executor_kind("auto"),
+                         "process" if gil_enabled() else "thread")
+
+    def test_workers_match_sequential(self):
+        expected = self.summary(['-u'])
+        for executor in ("thread", "process"):
+            for split_lines in ("0", "10"):
+                res = self.summary(['-u', '-j', '2', '--executor', executor,
+                                    '--split-lines', split_lines])
+                self.assertEqual(res, expected)
+
+    def test_threads_share_analysis(self):
+        opts = parse_args(['-j', '2', '--executor', 'thread',
+                           'test/unknown', 'test/unknown-copy'])
+        analysis = Analysis(opts, all_wcodes)
+        try:
+            self.assertTrue(analysis.threads)
+            res = analyze_files(opts.input_files, analysis)
+        finally:
+            analysis.close()
+        self.assertIs(res['test/unknown'], res['test/unknown-copy'])
+
+class TestPackedDiagnostics(unittest.TestCase):
+    def setUp(self):
+        # Many findings of a few kinds, as in a real tree
+        handle, self.input_file = tempfile.mkstemp(suffix=".h")
+        with os.fdopen(handle, "w") as f:
+            for i in range(100):
+                f.write("#define CONST_%d %d\n#frobnicate %d\n" % (i, i, i))
+        self.addCleanup(os.remove, self.input_file)
+
+    def analyze(self):
+        opts = parse_args(['-Dall', self.input_file])
+        return analyze_files(opts.input_files, Analysis(opts, all_wcodes))
+
+    def summary(self, diagnostics):
+        return list((d.wcode, d.lineno, d.first_line, d.details)
+                    for d in diagnostics)
+
+    def test_round_trip(self):
+        diagnostics = self.analyze()[self.input_file]
+        self.assertGreater(len(diagnostics), 1)
+        batch = pickle.loads(pickle.dumps(DiagnosticBatch(diagnostics)))
+        self.assertEqual(len(batch), len(diagnostics))
+        res = batch.unpack(read_source(self.input_file))
+        self.assertEqual(self.summary(res), self.summary(diagnostics))
+
+    def test_smaller_than_objects(self):
+        diagnostics = self.analyze()[self.input_file]
+        self.assertLess(len(pickle.dumps(DiagnosticBatch(diagnostics))),
+                        len(pickle.dumps(diagnostics)))
+
+    def test_only_lines_with_diagnostics_are_kept(self):
+        diagnostics = self.analyze()[self.input_file]
+        res = DiagnosticBatch(diagnostics).unpack(read_source(self.input_file))
+        self.assertEqual(sorted(res[0].source),
+                         sorted(set(d.lineno for d in diagnostics)))
+        self.assertEqual(DiagnosticBatch([]).unpack(b"#x\n"), [])
+        self.assertEqual(referenced_lines(b"a\nb\r\nc", {2, 3}),
+                         {2: "b\n", 3: "c"})
+
+class TestDifferentialFuzz(unittest.TestCase):
+    def test_paths_match_reference(self):
+        self.assertEqual(fuzz.fuzz(seed=1, iterations=100), [])
+
+    def test_fixtures(self):
+        saved = fuzz.fixtures()
+        self.assertIn(("extract", "#\n"), saved)
+        for (check_name, txt) in saved:
+            self.assertIsNone(fuzz.run_check(check_name, txt), txt)
+
+    def test_broken_path_is_found_and_shrunk(self):
+        def no_quotes(lines, old_state):
+            txt = "".join(lines).replace('"', " ")
+            return update_language_context([txt], old_state)
+        original = fuzz.update_language_context
+        fuzz.update_language_context = no_quotes
+        try:
+            failures = fuzz.fuzz(seed=1, iterations=20)
+        finally:
+            fuzz.update_language_context = original
+        self.assertTrue(failures)
+        for (check_name, txt, _) in failures:
+            self.assertEqual(check_name, "context")
+            self.assertLessEqual(len(txt), 3)
+            self.assertIn('"', txt)
+
+    def test_save_fixture(self):
+        with tempfile.TemporaryDirectory() as fixture_dir:
+            original = fuzz.FIXTURE_DIR
+            fuzz.FIXTURE_DIR = fixture_dir
+            try:
+                fuzz.save_fixture("tokenize", "#a \\\r\n")
+                self.assertEqual(fuzz.fixtures(), [("tokenize", "#a \\\r\n")])
+            finally:
+                fuzz.FIXTURE_DIR = original
+
+class TestMemoryBudgets(unittest.TestCase):
+    def test_stages_within_budgets(self):
+        for input_name in sorted(membench.synthetic_inputs):
+            (input_size, results) = membench.run_benchmark(input_name, 1500)
+            self.assertEqual(list(stage.name for stage in results),
+                             list(membench.stages))
+            self.assertEqual(membench.over_budget(input_name, results,
+                                                  input_size), [])
+
+    def test_whole_file_copy_is_caught(self):
+        results = [membench.StageMemory("extract", 10 << 20, 0)]
+        self.assertEqual(len(membench.over_budget("comments", results,
+                                                  1 << 20)), 1)
+
+class TestSchedule(unittest.TestCase):
+    input_files = ['test/file-with-problems', 'test/unknown', 'test/basic',
+                   'test/unmarked-endif']
+
+    def test_largest_first(self):
+        self.assertEqual(schedule_order(self.input_files, {}),
+                         ['test/unmarked-endif', 'test/basic', 'test/unknown',
+                          'test/file-with-problems'])
+
+    def test_timings_override_sizes(self):
+        # The smallest file took the longest; untimed files are estimated
+        # at the average rate of timed ones, about 26 ms per byte
+        timings = {'test/unknown': 0.032, 'test/file-with-problems': 1.0}
+        self.assertEqual(schedule_order(self.input_files, timings),
+                         ['test/unmarked-endif', 'test/basic',
+                          'test/file-with-problems', 'test/unknown'])
+
+    def test_sizes_only_when_needed(self):
+        # Sized by reader threads as by this one
+        self.assertEqual(schedule_order(self.input_files, {}, 3),
+                         schedule_order(self.input_files, {}))
+        # Files all timed are not even looked up
+        timings = {'missing/a': 1.0, 'missing/b': 2.0}
+        self.assertEqual(schedule_order(['missing/a', 'missing/b'], timings),
+                         ['missing/b', 'missing/a'])
+
+    def test_timing_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = TimingCache(cache_dir)
+            self.assertEqual(cache.load(), {})
+            cache.store({'a': 1.0})
+            cache.store({'b': 2.0})
+            self.assertEqual(cache.load(), {'a': 1.0, 'b': 2.0})
+            # A directory in place of the file is not replaced, nor left
+            # with temporary files
+            os.remove(cache.path)
+            os.makedirs(os.path.join(cache.path, "entry"))
+            cache.store({'c': 3.0})
+            self.assertEqual(os.listdir(cache_dir), ["timings.json"])
+
+    def test_worker_summary(self):
+        stats = WorkerStats(3)
+        stats.add("w1", 0.0)
+        stats.add(PARENT_WORKER, 0.0)
+        self.assertEqual(list(worker for (worker, _, _) in stats.summary()),
+                         [PARENT_WORKER, "w1", "unused", "unused"])
+
+    def test_main_stores_timings(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            output = io.StringIO()
+            argv = [TestInputFiles.script, '-v', '-j', '2', '--cache-dir',
+                    cache_dir] + self.input_files
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(cppsa_main(argv), 1)
+            self.assertIn("Worker ", output.getvalue())
+            self.assertEqual(sorted(TimingCache(cache_dir).load()),
+                             sorted(self.input_files))
+
+class TestAnalysisLimits(unittest.TestCase):
+    def setUp(self):
+        handle, self.input_file = tempfile.mkstemp(suffix=".h")
+        with os.fdopen(handle, "w") as f:
+            f.write("#define LONG(x) \\\n")
+            for i in range(10):
+                f.write("    call_%d(x); \\\n" % i)
+            f.write("    done(x)\n#frobnicate\n")
+        self.addCleanup(os.remove, self.input_file)
+
+    def summary(self, argv):
+        opts = parse_args(['-Dall'] + argv + [self.input_file])
+        res = analyze_files(opts.input_files, Analysis(opts, all_wcodes))
+        return list((d.lineno, d.wcode) for d in res[self.input_file])
+
+    def test_truncated_lines(self):
+        lines = ["#define X \\\n", "  a \\\n", "  b\n"]
+        self.assertEqual(truncated_lines(lines, 2, 0), lines[:2])
+        self.assertEqual(truncated_lines(lines, 0, 18), lines[:2])
+        self.assertEqual(truncated_lines(lines, 0, 5), ["#defi"])
+        self.assertEqual(truncated_lines(lines, 0, 0), lines)
+
+    def test_within_limits(self):
+        self.assertNotIn(21, list(wcode for (_, wcode) in self.summary([])))
+
+    def test_long_directive_is_truncated(self):
+        for argv in (['--max-continuation-lines', '3'],
+                     ['--max-directive-length', '50']):
+            res = self.summary(argv)
+            self.assertIn((1, 21), res)
+            # TooLongDefineDiagnostic only sees the beginning
+            self.assertNotIn((1, 15), res)
+            self.assertIn((13, 1), res)
+        self.assertIn((1, 15), self.summary([]))
+
+    def test_large_file_is_skipped(self):
+        self.assertEqual(self.summary(['--max-file-size', '100']), [(1, 21)])
+        self.assertEqual(self.summary(['-j', '2', '--executor', 'process',
+                                       '--max-file-size', '100']), [(1, 21)])
+
+    def test_large_file_is_not_read(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_file = os.path.join(tmp, "large.h")
+            with open(input_file, "wb") as f:
+                f.write(b"#define X 1\n" * 1000)
+            sources = ArchiveSources(max_size=100)
+            self.assertEqual(sources.size(input_file), TOO_LARGE_PREFIX)
+            self.assertEqual(sources.read(input_file),
+                             read_source(input_file)[:TOO_LARGE_PREFIX])
+            self.assertEqual(sources.truncated_size(input_file), 12000)
+            sources = ArchiveSources(max_size=12000)
+            self.assertEqual(len(sources.read(input_file)), 12000)
+            self.assertIsNone(sources.truncated_size(input_file))
+
+    def test_time_budget(self):
+        self.assertEqual(self.summary(['--file-time-budget', '1e-9']),
+                         [(1, 21)])
+
+    def test_disabled_note(self):
+        opts = parse_args(['-D-21', '--max-file-size', '100',
+                           self.input_file])
+        res = analyze_files(opts.input_files, Analysis(opts, all_wcodes - {21}))
+        self.assertEqual(res[self.input_file], [])
+
+    def scaling(self, function, make_input, size):
+        "Return how much longer function takes on a ten times larger input"
+        times = list()
+        for n in (size, 10 * size):
+            arg = make_input(n)
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                function(arg)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best)
+        return times[1] / times[0]
+
+    @unittest.skipUnless(os.environ.get("CPPSA_BENCHMARKS"),
+                         "compares timings, set CPPSA_BENCHMARKS=1 to run")
+    def test_near_linear_scaling(self):
+        # Quadratic behavior would give a ratio of about 100
+        shapes = (
+            (tokenize, lambda n: "#define X " + "a(b),c " * n),
+            (lambda lines: update_language_context(lines, Context.OUTSIDE),
+             lambda n: ['"x" /* y */ // z\\\n' * n]),
+            (lambda lines: PreprocessorDirective(lines, 1),
+             lambda n: ["#define X \\\n"] + ["  a \\\n"] * n + ["b\n"]),
+            (lambda lines: extract_directives(lines, "f.c"),
+             lambda n: ["#if X \\\n"] + ["  && Y \\\n"] * n + ["\n"]),
+        )
+        for (function, make_input) in shapes:
+            self.assertLess(self.scaling(function, make_input, 5000), 40)
+
+class TestArchives(unittest.TestCase):
+    members = ['test/unknown', 'test/basic', 'test/unmarked-endif']
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.archives = list()
+        for (suffix, mode) in ((".tar", "w"), (".tar.gz", "w:gz")):
+            archive = os.path.join(tmp_dir.name, "src" + suffix)
+            with tarfile.open(archive, mode) as tar:
+                for member in self.members:
+                    tar.add(member, arcname=member + ".h")
+                tar.add('test/unknown', arcname='README')
+            self.archives.append(archive)
+        archive = os.path.join(tmp_dir.name, "src.zip")
+        with zipfile.ZipFile(archive, "w") as z:
+            for member in self.members:
+                z.write(member, arcname=member + ".h")
+            z.write('test/unknown', arcname='README')
+        self.archives.append(archive)
+
+    def test_expand(self):
+        sources = ArchiveSources()
+        for archive in self.archives:
+            self.assertEqual(sources.expand(['test/basic', archive]),
+                             ['test/basic'] + list("%s!%s.h" % (archive, m)
+                                                   for m in self.members))
+
+    def test_read_in_any_order(self):
+        sources = ArchiveSources()
+        for archive in self.archives:
+            names = sources.expand([archive])
+            for name in [names[2], names[0], names[1], names[0]]:
+                member = name.split("!")[1][:-len(".h")]
+                self.assertEqual(sources.read(name), read_source(member))
+        sources.close()
+
+    def test_member_sizes(self):
+        sources = ArchiveSources()
+        for archive in self.archives:
+            names = sources.expand([archive])
+            for (name, member) in zip(names, self.members):
+                self.assertEqual(sources.size(name),
+                                 len(read_source(member)))
+        self.assertIsNone(sources.member_size('test/basic'))
+        self.assertEqual(sources.size('test/basic'),
+                         len(read_source('test/basic')))
+
+    def test_members_kept_for_later_take_memory(self):
+        sizes = list(len(read_source(member)) for member in self.members)
+        for (cap, kept) in ((1 << 20, sizes[0] + sizes[1]), (1, 0)):
+            sources = ArchiveSources()
+            names = sources.expand([self.archives[0]])
+            memory = MemoryCap(cap)
+            sources.expect(names, memory)
+            # Passes over the first two members
+            self.assertEqual(sources.read(names[2]),
+                             read_source(self.members[2]))
+            self.assertEqual((memory.used, memory.ahead), (kept, kept))
+            self.assertEqual(sources.read(names[0]),
+                             read_source(self.members[0]))
+            self.assertEqual(memory.used, kept - sizes[0] if kept else 0)
+            sources.close()
+
+    def test_large_member_is_not_read(self):
+        tmp_dir = os.path.dirname(self.archives[0])
+        large = os.path.join(tmp_dir, "large.h")
+        with open(large, "w") as f:
+            f.write("#frobnicate\n" * 1000)
+        archives = list()
+        for (suffix, mode) in ((".tar", "w"), (".tar.gz", "w:gz")):
+            archives.append(os.path.join(tmp_dir, "large" + suffix))
+            with tarfile.open(archives[-1], mode) as tar:
+                tar.add('test/basic', arcname='basic.h')
+                tar.add(large, arcname='large.h')
+        archives.append(os.path.join(tmp_dir, "large.zip"))
+        with zipfile.ZipFile(archives[-1], "w") as z:
+            z.write('test/basic', arcname='basic.h')
+            z.write(large, arcname='large.h')
+        for archive in archives:
+            sources = ArchiveSources(max_size=100)
+            name = sources.expand([archive])[-1]
+            self.assertEqual(sources.member_size(name), 12000)
+            self.assertEqual(len(sources.read(name)), TOO_LARGE_PREFIX)
+            sources.close()
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                for argv in ([], ['-j', '2', '--executor', 'process']):
+                    cppsa_main([TestInputFiles.script, '--max-file-size',
+                                '100'] + argv + [archive])
+            self.assertEqual(output.getvalue().count(
+                "%s:1: W21: File of 12000 bytes" % name), 2)
+
+    def test_main_reports_members(self):
+        for archive in self.archives:
+            for argv in ([], ['-j', '2', '--prefetch', '2']):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    res = cppsa_main([TestInputFiles.script] + argv
+                                     + [archive])
+                self.assertEqual(res, 1)
+                self.assertIn("%s!test/unknown.h:1: W1: " % archive,
+                              output.getvalue())
+                self.assertNotIn("README", output.getvalue())
+
+class TestBaseline(unittest.TestCase):
+    source = ("#ifdef A\n"
+              "#frobnicate\n"
+              "#  ifdef B\n"
+              "#frobnicate\n"
+              "#  endif\n"
+              "#endif\n"
+              "#frobnicate\n")
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.input_file = os.path.join(tmp_dir.name, "f.h")
+        self.baseline = os.path.join(tmp_dir.name, "baseline")
+
+    def run_main(self, source, argv):
+        with open(self.input_file, "w") as f:
+            f.write(source)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            res = cppsa_main([TestInputFiles.script, '-D1'] + argv
+                             + [self.input_file])
+        return (res, output.getvalue())
+
+    def test_block_contexts(self):
+        pre_lines = extract_directives(self.source.splitlines(True), "f.h")
+        self.assertEqual(block_contexts(pre_lines, range(1, 9)),
+                         {1: "", 2: "#ifdef A", 3: "#ifdef A",
+                          4: "#ifdef B", 5: "#ifdef B", 6: "#ifdef A",
+                          7: "", 8: ""})
+
+    def test_only_ascii_whitespace_is_normalized(self):
+        self.assertEqual(normalized(" #if  A \t&&\vB\n"), "#if A && B")
+        # NBSP and 0x85 of UTF-8 read as latin-1 are parts of tokens
+        self.assertEqual(normalized("#if A\xa0\x85B"), "#if A\xa0\x85B")
+
+    def test_fingerprints(self):
+        opts = parse_args(['-D1', 'test/unknown', 'test/unknown-copy'])
+        diagnostics = analyze_files(opts.input_files,
+                                    Analysis(opts, all_wcodes))['test/unknown']
+        prints = fingerprints('test/unknown', diagnostics)
+        self.assertEqual(len(set(prints.values())), len(diagnostics))
+        self.assertNotEqual(prints, fingerprints('test/unknown-copy',
+                                                 diagnostics))
+
+    def test_only_new_findings(self):
+        (res, output) = self.run_main(self.source, ['--write-baseline',
+                                                    self.baseline])
+        self.assertEqual((res, output.count(": W1: ")), (1, 3))
+        # Shifted lines are no new findings
+        shifted = "\n\n" + self.source.replace("#ifdef A", "#ifdef A // x")
+        for argv in ([], ['-j', '2', '--executor', 'process']):
+            (res, output) = self.run_main(shifted, ['--baseline',
+                                                    self.baseline] + argv)
+            self.assertEqual((res, output), (0, ""))
+        # A finding in a block which had none before is new
+        (res, output) = self.run_main(self.source + "#ifdef C\n#frobnicate\n"
+                                      "#endif\n", ['--baseline', self.baseline])
+        self.assertEqual(res, 1)
+        self.assertIn(":9: W1: ", output)
+        self.assertEqual(output.count(": W1: "), 1)
+
+class TestMetrics(unittest.TestCase):
+    input_files = ['test/unknown', 'test/unknown-copy', 'test/basic',
+                   'test/unmarked-endif', 'test/file-with-problems']
+
+    def counters(self, argv):
+        opts = parse_args(['-Dall'] + argv + self.input_files)
+        analysis = Analysis(opts, all_wcodes)
+        try:
+            analyze_files(opts.input_files, analysis)
+        finally:
+            analysis.close()
+        # Hits of the tokenizer cache depend on what ran before
+        return dict((key, value)
+                    for (key, value) in analysis.counters.values.items()
+                    if not key[0].startswith("tokenize_"))
+
+    def test_counts(self):
+        counters = Counters()
+        counters.values = self.counters([])
+        self.assertEqual(counters.get("files_total"), 4)
+        self.assertEqual(counters.get("directives_total"), 7)
+        self.assertEqual(counters.get("check_findings_total",
+                                      check="UnknownDirectiveDiagnostic",
+                                      wcode="1"), 1)
+        self.assertEqual(counters.get("check_directives_examined_total",
+                                      check="UnmarkedEndifDiagnostic",
+                                      wcode="8"), 7)
+
+    def test_workers_match_sequential(self):
+        expected = self.counters([])
+        for executor in ("thread", "process"):
+            res = self.counters(['-j', '2', '--executor', executor])
+            self.assertEqual(res, expected)
+
+    def test_merge(self):
+        (first, second) = (Counters(), Counters())
+        first.add("files_total")
+        second.add("files_total", 2)
+        second.add("whitelist_hits_total")
+        first.merge(second)
+        self.assertEqual(first.get("files_total"), 3)
+        self.assertEqual(first.get("whitelist_hits_total"), 1)
+
+    def test_main_writes_metrics(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            file_name = os.path.join(out_dir, "cppsa.prom")
+            argv = [TestInputFiles.script, '-q', '--whitelist',
+                    'test/unknown-wl', '--metrics', file_name, 'test/unknown']
+            self.assertEqual(cppsa_main(argv), 0)
+            with open(file_name) as f:
+                txt = f.read()
+            self.assertIn("# TYPE cppsa_files_total counter\n", txt)
+            self.assertIn("cppsa_whitelist_hits_total 1\n", txt)
+            self.assertEqual(os.listdir(out_dir), ["cppsa.prom"])
+
+            file_name = os.path.join(out_dir, "cppsa.json")
+            argv = [TestInputFiles.script, '-q', '--metrics', file_name,
+                    '--metrics-format', 'json', 'test/unknown']
+            self.assertEqual(cppsa_main(argv), 1)
+            with open(file_name) as f:
+                metrics = json.load(f)["metrics"]
+            self.assertIn({"name": "cppsa_lines_total", "labels": {},
+                           "value": 1}, metrics)
+
+class TestDirectiveCacheFiles(unittest.TestCase):
+    def summary(self, directives):
+        return list((d.lineno, d.context, d.multi_lines, d.full_text, d.tokens,
+                     d.hashword) for d in directives)
+
+    def test_serialization_round_trip(self):
+        directives = extract_directives(TestIntraFileParallel.lines, "f.c")
+        data = serialize_directives(directives)
+        self.assertEqual(self.summary(deserialize_directives(data)),
+                         self.summary(directives))
+        self.assertIsNone(deserialize_directives(b"something else"))
+
+    def test_cache_hit(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DirectiveCache(cache_dir)
+            first = extract_preprocessor_lines('test/unmarked-endif',
+                                               directive_cache=cache)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            key = content_hash(read_source('test/unmarked-endif'))
+            self.assertEqual(self.summary(cache.load(key)),
+                             self.summary(first))
+            second = extract_preprocessor_lines('test/unmarked-endif',
+                                                directive_cache=cache)
+            self.assertEqual(self.summary(second), self.summary(first))
+
+    def test_unwritable_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Neither created nor written, as its parent is a file
+            not_a_dir = os.path.join(tmp, "file")
+            with open(not_a_dir, "w"):
+                pass
+            cache = DirectiveCache(os.path.join(not_a_dir, "cache"))
+            expected = extract_preprocessor_lines('test/unmarked-endif')
+            res = extract_preprocessor_lines('test/unmarked-endif',
+                                             directive_cache=cache)
+            self.assertEqual(self.summary(res), self.summary(expected))
+            self.assertEqual(os.listdir(tmp), ["file"])
+            # Written, but not replacing the entry
+            cache = DirectiveCache(tmp)
+            key = content_hash(read_source('test/unmarked-endif'))
+            os.makedirs(os.path.join(cache.path(key), "entry"))
+            cache.store(key, expected)
+            entry = os.path.basename(cache.path(key))
+            self.assertEqual(sorted(os.listdir(tmp)), sorted(["file", entry]))
+
+    def test_main_with_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            argv = [TestInputFiles.script, '-q', '--cache-dir', cache_dir,
+                    'test/unmarked-endif']
+            self.assertEqual(cppsa_main(argv), 1)
+            argv = [TestInputFiles.script, '-q', '-D-8', '--cache-dir',
+                    cache_dir, 'test/unmarked-endif']
+            self.assertEqual(cppsa_main(argv), 0)
+
+class TestContentDeduplication(unittest.TestCase):
+    def test_identical_contents_are_analyzed_once(self):
+        opts = parse_args(['-q', 'test/unknown', 'test/unknown-copy',
+                           'test/basic'])
+        analysis = Analysis(opts, all_wcodes)
+        res = analyze_files(opts.input_files, analysis)
+        self.assertIs(res['test/unknown'], res['test/unknown-copy'])
+        self.assertEqual(len(res['test/unknown-copy']), 1)
+        self.assertEqual(res['test/basic'], [])
+
+    def test_whitelist_is_applied_per_path(self):
+        argv = [TestInputFiles.script, '-q', '--whitelist', 'test/unknown-wl',
+                'test/unknown']
+        self.assertEqual(cppsa_main(argv), 0)
+        argv = [TestInputFiles.script, '-q', '--whitelist', 'test/unknown-wl',
+                'test/unknown', 'test/unknown-copy']
+        self.assertEqual(cppsa_main(argv), 1)
+
+class TestShards(unittest.TestCase):
+    input_files = ['test/unknown', 'test/unknown-copy', 'test/basic',
+                   'test/unmarked-endif', 'test/unused-macro-def',
+                   'test/unused-macro-use', 'test/inline-func',
+                   'test/file-with-problems']
+
+    def run_main(self, argv):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            res = cppsa_main([TestInputFiles.script] + argv)
+        return (res, output.getvalue())
+
+    def test_shard_spec(self):
+        self.assertEqual(parse_shard_spec("2/3"), (2, 3))
+        self.assertIsNone(parse_shard_spec("0/3"))
+        self.assertIsNone(parse_shard_spec("4/3"))
+        self.assertIsNone(parse_shard_spec("x"))
+
+    def test_shards_cover_all_files_once(self):
+        shards = list(select_shard(self.input_files, i, 3) for i in (1, 2, 3))
+        self.assertEqual(sorted(sum(shards, [])), sorted(self.input_files))
+        self.assertEqual(select_shard(self.input_files, 1, 1),
+                         self.input_files)
+
+    def test_merge_matches_single_run(self):
+        options = ['-u', '--whitelist', 'test/unknown-wl']
+        expected = self.run_main(options + self.input_files)
+        self.assertEqual(expected[0], 1)
+        with tempfile.TemporaryDirectory() as result_dir:
+            result_files = list()
+            for i in (1, 2, 3):
+                result_file = os.path.join(result_dir, "shard%d" % i)
+                res = self.run_main(['-u', '--shard', '%d/3' % i,
+                                     '--shard-output', result_file]
+                                    + self.input_files)
+                self.assertEqual(res, (0, ''))
+                result_files.append(result_file)
+            merged = self.run_main(['merge', '--whitelist', 'test/unknown-wl']
+                                   + result_files)
+        self.assertEqual(merged, expected)
+
+    def test_merge_needs_every_shard_once(self):
+        with tempfile.TemporaryDirectory() as result_dir:
+            result_files = list()
+            for spec in ('1/3', '2/3', '1/2'):
+                result_file = os.path.join(result_dir, spec.replace('/', '-'))
+                self.run_main(['-u', '--shard', spec, '--shard-output',
+                               result_file] + self.input_files)
+                result_files.append(result_file)
+            (shard1, shard2, other_run) = result_files
+            for (files, error) in (([shard1, shard2], "shard\\(s\\) 3 of 3"),
+                                   ([shard1, shard1], "also in"),
+                                   ([shard1, other_run], "another run")):
+                (res, output) = self.run_main(['merge'] + files)
+                self.assertEqual(res, 2)
+                self.assertRegex(output, error)
+
+
+class TestStats(unittest.TestCase):
+    input_files = TestShards.input_files
+
+    def run_main(self, argv):
+        return TestShards.run_main(self, argv)
+
+    def test_directive_shapes(self):
+        lines = ["#ifdef A", "#if B", "#define X 1", "#endif",
+                 "#define Y \\", "  2", "#endif", "#ifndef C", "#endif"]
+        counters = Counters()
+        count_directive_shapes(counters, extract_directives(lines, "f.c"))
+        report = stats_report(Stats(), counters)
+        self.assertEqual(report["conditional_depth"], {"1": 2, "2": 1})
+        self.assertEqual(report["define_lines"], {"1": 1, "2": 1})
+
+    def test_findings(self):
+        stats = Stats()
+        stats.add_findings("a/f.c", [UnknownDirectiveDiagnostic(
+            PreprocessorDirective(["#foo"], 1))] * 2)
+        stats.add_findings("g.c", [UnknownDirectiveDiagnostic(
+            PreprocessorDirective(["#bar"], 3))])
+        report = stats_report(stats, Counters())
+        self.assertEqual(report["findings"], 3)
+        self.assertEqual(report["findings_by_code"], {"W1": 3})
+        self.assertEqual(report["findings_by_directory"], {".": 1, "a": 2})
+        self.assertEqual(report["findings_by_file"], {"a/f.c": 2, "g.c": 1})
+
+    def test_json_report(self):
+        (res, output) = self.run_main(['--stats', '--stats-format', 'json']
+                                      + self.input_files)
+        self.assertEqual(res, 1)
+        report = json.loads(output)
+        self.assertEqual(report["files"], 8)
+        self.assertEqual(report["findings_by_code"]["W1"], 2)
+        self.assertEqual(report["findings_by_directory"],
+                         {"test": report["findings"]})
+        self.assertEqual(sum(report["conditional_depth"].values()), 3)
+
+    def test_copies_are_counted(self):
+        for argv in ([], ['-j', '2']):
+            (res, output) = self.run_main(['--stats', '--stats-format', 'json']
+                                          + argv + ['test/unknown',
+                                                    'test/unknown-copy'])
+            report = json.loads(output)
+            self.assertEqual((report["files"], report["directives"],
+                              report["findings"]), (2, 2, 2))
+
+    def test_workers_and_shards_match_sequential(self):
+        expected = self.run_main(['-u', '--stats'] + self.input_files)
+        self.assertIn("Findings by code:\n", expected[1])
+        res = self.run_main(['-u', '--stats', '-j', '2', '--executor',
+                             'process'] + self.input_files)
+        self.assertEqual(res, expected)
+        with tempfile.TemporaryDirectory() as result_dir:
+            result_files = list()
+            for i in (1, 2):
+                result_file = os.path.join(result_dir, "shard%d" % i)
+                self.run_main(['-u', '--stats', '--shard', '%d/2' % i,
+                               '--shard-output', result_file]
+                              + self.input_files)
+                result_files.append(result_file)
+            merged = self.run_main(['merge', '--stats'] + result_files)
+        self.assertEqual(merged, expected)
+
+
+class TestRegistry(unittest.TestCase):
+    plugin_source = """
+from simple import BaseDiagnostic
+from diagcodes import Feature
+
+class PragmaDiagnostic(BaseDiagnostic):
+    wcode = 100
+    needs = Feature.HASHWORD
+    message = "Pragma %s"
+    @staticmethod
+    def apply(directive):
+        if directive.hashword == "#pragma":
+            return PragmaDiagnostic(directive, directive.lineno)
+"""
+
+    def setUp(self):
+        self.plugin_dir = tempfile.TemporaryDirectory()
+        module_file = os.path.join(self.plugin_dir.name, "sitechecks.py")
+        with open(module_file, "w") as f:
+            f.write(self.plugin_source)
+        self.plugin_file = os.path.join(self.plugin_dir.name, "plugins")
+        with open(self.plugin_file, "w") as f:
+            f.write("# Site checks\nW100 sitechecks:PragmaDiagnostic\n")
+        self.input_file = os.path.join(self.plugin_dir.name, "f.c")
+        with open(self.input_file, "w") as f:
+            f.write("#pragma once\n#include <a.h>\n")
+        sys.path.insert(0, self.plugin_dir.name)
+
+    def tearDown(self):
+        sys.path.remove(self.plugin_dir.name)
+        sys.modules.pop("sitechecks", None)
+        self.plugin_dir.cleanup()
+
+    def test_builtin_checks(self):
+        registry = CheckRegistry()
+        self.assertEqual(registry.wcodes, all_wcodes)
+        self.assertEqual(registry.load(all_wcodes),
+                         (simple_diagnostics, complex_diagnostics,
+                          run_simple_checks, run_complex_checks))
+        self.assertEqual(registry.load({1, 8})[:2],
+                         ((UnknownDirectiveDiagnostic,),
+                          (UnmarkedEndifDiagnostic,)))
+        self.assertEqual(registry.load({8}),
+                         ((), (UnmarkedEndifDiagnostic,), None,
+                          run_complex_checks))
+
+    def test_builtin_codes_match_modules(self):
+        for (module, attr, wcodes) in builtin_modules:
+            checks = getattr(importlib.import_module(module), attr)
+            self.assertEqual(sorted(check.wcode for check in checks),
+                             sorted(wcodes), module)
+
+    def test_driver_imports_checks_only_when_enabled(self):
+        code = ("import sys, driver, cppsa\n"
+                "assert 'simple' not in sys.modules\n"
+                "opts = cppsa.parse_full_args(['-D8', 'x.c'])\n"
+                "driver.Analysis(opts, {8})\n"
+                "assert 'simple' not in sys.modules\n"
+                "driver.Analysis(opts, {1})\n"
+                "assert 'simple' in sys.modules\n")
+        subprocess.run([sys.executable, "-c", code], check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_plugin_is_imported_only_when_enabled(self):
+        registry = CheckRegistry(self.plugin_file)
+        self.assertIn(100, registry.wcodes)
+        registry.load(all_wcodes)
+        self.assertNotIn("sitechecks", sys.modules)
+        (directive_checks, file_checks, _, _) = registry.load({1, 100})
+        self.assertEqual(list(check.__name__ for check in directive_checks),
+                         ["UnknownDirectiveDiagnostic", "PragmaDiagnostic"])
+        self.assertEqual(file_checks, ())
+
+    def test_main_runs_plugin(self):
+        for executor in ("thread", "process"):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                res = cppsa_main([TestInputFiles.script, '--plugins',
+                                  self.plugin_file, '-D100', '-j', '2',
+                                  '--executor', executor, self.input_file])
+            self.assertEqual(res, 1)
+            self.assertEqual(output.getvalue(),
+                             "%s:1: W100: Pragma 1\n    #pragma once\n"
+                             % self.input_file)
+
+    def test_bad_plugins(self):
+        self.assertEqual(parse_plugin_spec("W100", "a.b:C"), (100, "a.b", "C"))
+        self.assertRaises(PluginError, parse_plugin_spec, "W0", "a:C")
+        self.assertRaises(PluginError, parse_plugin_spec, "100", "a")
+        with open(self.plugin_file, "w") as f:
+            f.write("W8 sitechecks:PragmaDiagnostic\n")
+        self.assertRaises(PluginError, CheckRegistry, self.plugin_file)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            res = cppsa_main([TestInputFiles.script, '--plugins',
+                              self.plugin_file, self.input_file])
+        self.assertEqual(res, 2)
+        self.assertIn("W8 of plugin sitechecks:PragmaDiagnostic",
+                      output.getvalue())
+
+    def test_plugins_failing_to_load(self):
+        for (spec, error) in (("W100 nosuchmodule:Check", "nosuchmodule"),
+                              ("W100 sitechecks:NoSuchCheck", "NoSuchCheck"),
+                              ("W101 sitechecks:PragmaDiagnostic", "W100")):
+            with open(self.plugin_file, "w") as f:
+                f.write(spec + "\n")
+            for jobs in ("1", "2"):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    res = cppsa_main([TestInputFiles.script, '--plugins',
+                                      self.plugin_file, '-j', jobs,
+                                      self.input_file])
+                self.assertEqual(res, 2)
+                self.assertTrue(output.getvalue().startswith(
+                                "Loading plugins failed: "), spec)
+                self.assertIn(error, output.getvalue())
+
+
+class TestColdStart(unittest.TestCase):
+    # Modules a run on a single file must do without, see parse_args()
+    deferred_modules = ("argparse", "json", "hashlib", "concurrent.futures",
+                        "multiprocessing", "tarfile", "zipfile")
+    # Microseconds of imports of a single file run, as measured by
+    # -X importtime. Interpreter startup itself is not included
+    import_budget = 50000
+
+    def test_common_args_match_full_parser(self):
+        for argv in (['f.c'], ['-q', 'a.c', 'b.c'], ['-v', '-D-8', 'f.c'],
+                     ['-D', '1,2', '-W', 'wl', '-a', '-u', 'f.c'],
+                     ['--quiet', '--diagnostics', 'all', '--stats', 'f.c']):
+            opts = parse_common_args(argv)
+            self.assertIsNotNone(opts, argv)
+            self.assertEqual(vars(opts), vars(parse_full_args(argv)))
+        for argv in (['-j', '2', 'f.c'], ['-q', '-v', 'f.c'], ['-q'],
+                     ['f.c', '-D'], ['-W', '-q', 'f.c'], ['-'],
+                     ['--metrics', 'm', 'f.c']):
+            self.assertIsNone(parse_common_args(argv), argv)
+
+    def import_times(self, code):
+        """Return a dict mapping modules imported by running code to their
+           cumulative import times, of the fastest of several runs"""
+        # Bytecode written by the first run is used by later ones, as it is
+        # for an installed tool
+        env = dict(os.environ)
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        res = dict()
+        for attempt in range(3):
+            output = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                                     code], capture_output=True, text=True,
+                                    cwd=os.path.dirname(__file__) or ".",
+                                    env=env, check=True).stderr
+            times = dict()
+            for line in output.splitlines()[1:]:
+                (_, cumulative, name) = line.split("|")
+                times[name.strip()] = (int(cumulative), name)
+            if not res or sum(t for (t, _) in times.values()) < sum(
+                    t for (t, _) in res.values()):
+                res = times
+        return res
+
+    def test_single_file_imports(self):
+        times = self.import_times("import cppsa; cppsa.main(['cppsa', '-q',"
+                                  " 'test/unknown'])")
+        for module in self.deferred_modules:
+            self.assertFalse(module in times, module)
+        # Top level imports after startup are the ones of the run
+        names = list(times)
+        own = names[names.index("site") + 1:]
+        total = sum(times[name][0] for name in own
+                    if not times[name][1].startswith("  "))
+        self.assertLess(total, self.import_budget)
+
+
+class TestDirConfig(unittest.TestCase):
+    nested = "#ifdef A\n#ifdef B\n#ifdef C\n#endif\n#endif\n#endif\n"
+
+    def setUp(self):
+        self.root_dir = tempfile.TemporaryDirectory()
+        self.root = self.root_dir.name
+        os.mkdir(os.path.join(self.root, "legacy"))
+        for directory in ("", "legacy"):
+            with open(os.path.join(self.root, directory, "f.c"), "w") as f:
+                f.write(self.nested)
+
+    def tearDown(self):
+        self.root_dir.cleanup()
+
+    def write_config(self, directory, txt):
+        with open(os.path.join(self.root, directory, ".cppsa"), "w") as f:
+            f.write(txt)
+
+    def test_merged_from_root_down(self):
+        self.write_config("", "IFDEF_NESTING = 4\ndiagnostics = -8\n")
+        self.write_config("legacy", "# Old code\ndiagnostics = 8,-5,1\n"
+                          "DEFINE_LINES_LIMIT=9\n")
+        configs = DirConfigs(".cppsa", all_wcodes - {1}, all_wcodes)
+        top = configs.config_of(os.path.join(self.root, "f.c"))
+        self.assertEqual(top.thresholds.IFDEF_NESTING, 4)
+        self.assertEqual(top.wcodes, all_wcodes - {1, 8})
+        legacy = configs.config_of(os.path.join(self.root, "legacy", "f.c"))
+        self.assertEqual((legacy.thresholds.IFDEF_NESTING,
+                          legacy.thresholds.DEFINE_LINES_LIMIT,
+                          legacy.thresholds.TOKENS_THRESHOLD), (4, 9, 5))
+        # Codes disabled by -D stay disabled
+        self.assertEqual(legacy.wcodes, all_wcodes - {1, 5})
+        member = os.path.join(self.root, "legacy", "a.tar!src/f.c")
+        self.assertIs(configs.config_of(member), legacy)
+        self.assertEqual(DirConfigs("", all_wcodes, all_wcodes).config_of(
+            os.path.join(self.root, "f.c")).thresholds.IFDEF_NESTING, 2)
+
+    def test_directory_is_resolved_once(self):
+        self.write_config("legacy", "IFDEF_NESTING = 4\n")
+        configs = DirConfigs(".cppsa", all_wcodes, all_wcodes)
+        first = configs.config_of(os.path.join(self.root, "legacy", "f.c"))
+        os.remove(os.path.join(self.root, "legacy", ".cppsa"))
+        second = configs.config_of(os.path.join(self.root, "legacy", "g.c"))
+        self.assertIs(second, first)
+
+    def test_main(self):
+        input_files = list(os.path.join(self.root, directory, "f.c")
+                           for directory in ("", "legacy"))
+        argv = [TestInputFiles.script, '-D4'] + input_files
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(cppsa_main(argv), 1)
+        self.assertEqual(output.getvalue().count(": W4: "), 2)
+        # Copies of identical contents no longer share results
+        self.write_config("legacy", "IFDEF_NESTING = 3\n")
+        for jobs in ("1", "2"):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(cppsa_main(argv + ['-j', jobs]), 1)
+            self.assertEqual(output.getvalue().count(": W4: "), 1, jobs)
+            self.assertNotIn("legacy", output.getvalue())
+        argv = [TestInputFiles.script, '-q', '--dir-config', ''] + argv[1:]
+        self.assertEqual(cppsa_main(argv), 1)
+
+    def test_errors(self):
+        configs = DirConfigs(".cppsa", all_wcodes, all_wcodes)
+        for (txt, error) in (("IFDEF_NESTING\n", "expected NAME = VALUE"),
+                             ("IFDEF_NESTING = -1\n", "non-negative"),
+                             ("diagnostics = 99\n", "unknown diagnostics"),
+                             ("NESTING = 1\n", "unknown setting NESTING")):
+            self.write_config("", txt)
+            configs.resolved.clear()
+            with self.assertRaisesRegex(DirConfigError, error):
+                configs.config_of(os.path.join(self.root, "f.c"))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            res = cppsa_main([TestInputFiles.script,
+                              os.path.join(self.root, "f.c")])
+        self.assertEqual(res, 2)
+        self.assertIn(".cppsa:1: unknown setting", output.getvalue())
+
 
 if __name__ == '__main__':
     unittest.main()